@@ -2,6 +2,7 @@ import React, { useEffect, useState } from 'react';
 import { ArrowRight, CheckCircle, RefreshCcw, Loader } from 'lucide-react';
 import { ComicProject, ComicPage } from '../types';
 import { ImageGenerationService } from '../services/imageGeneratorService';
+import { llmService } from '../services/llmService';
 
 // Initialize the service with configuration from environment variables
 const imageGenerationService = new ImageGenerationService();
@@ -45,8 +46,24 @@ export const Step3Generation: React.FC<Step3Props> = ({ project, setProject, onN
     let count = 0;
 
     try {
+      // Use the backend's LORA adapter for the chosen style if it has one (e.g. "Pixel Art" -> pixel_art)
+      const styleKey = project.style.toLowerCase().replace(/[^a-z0-9]+/g, '_');
+      const styleAdapter = (await imageGenerationService.getAvailableModels()).find(name => name === styleKey);
+
       // Process each scene to generate images
       for (let pIdx = 0; pIdx < newPages.length; pIdx++) {
+        // One LLM call writes the image prompts for the whole page; scenes without one use their description
+        try {
+          const imagePrompts = await llmService.generateImagePrompts(newPages[pIdx].scenes, project.style);
+          newPages[pIdx].scenes.forEach(scene => {
+            if (imagePrompts[scene.id]) {
+              scene.imagePrompt = imagePrompts[scene.id];
+            }
+          });
+        } catch (error) {
+          console.warn(`Could not generate image prompts for page ${newPages[pIdx].pageNumber}:`, error);
+        }
+
         for (let sIdx = 0; sIdx < newPages[pIdx].scenes.length; sIdx++) {
           const scene = newPages[pIdx].scenes[sIdx];
           
@@ -56,13 +73,14 @@ export const Step3Generation: React.FC<Step3Props> = ({ project, setProject, onN
           try {
             // Generate image using the fine-tuned model
             const imageUrl = await imageGenerationService.generateImage({
-              prompt: scene.prompt,
+              prompt: scene.imagePrompt || scene.prompt,
               // Adjust parameters based on comic style
               steps: project.style === 'Pixel Art' ? 15 : 20,
               width: project.style === 'Webtoon' ? 1024 : 1024, // Adjust dimensions as needed
               height: project.style === 'Webtoon' ? 2048 : 1024, // Webtoons are typically taller
               // Add negative prompts specific to comic art
               negative_prompt: "blurry, deformed, disfigured, bad anatomy, extra limbs, missing limbs, poorly drawn face",
+              adapter: styleAdapter,
             }, 3); // Retry up to 3 times
 
             // Update the scene with the generated image
@@ -3,6 +3,26 @@ import { ComicPage } from "../types";
 // Configuration - these can be set via environment variables
 const DEFAULT_API_ENDPOINT = import.meta.env.VITE_SD_API_ENDPOINT || 'http://localhost:7860';
 const DEFAULT_API_TIMEOUT = parseInt(import.meta.env.VITE_SD_TIMEOUT || '60000');
+// Ask for /outputs URLs instead of inline base64, so projects keep short URLs rather than multi-MB data URLs
+const USE_IMAGE_URLS = (import.meta.env.VITE_SD_IMAGE_URLS || '1') === '1';
+// Side length the model was trained at; larger images are drawn at this size first and upscaled by the hires fix
+const NATIVE_RESOLUTION = parseInt(import.meta.env.VITE_SD_NATIVE_RESOLUTION || '512');
+// Largest hires fix side the server renders; keep it equal to the server's SD_MAX_RESOLUTION
+const MAX_RESOLUTION = parseInt(import.meta.env.VITE_SD_MAX_RESOLUTION || '1024');
+
+/**
+ * First pass size for a target size: the target scaled down so its longer
+ * side is the native resolution, in multiples of 8. Targets the hires fix
+ * can't reach (above MAX_RESOLUTION, e.g. Webtoon panels) are drawn in a
+ * single pass at their full size instead.
+ */
+function firstPassSize(width: number, height: number): [number, number] {
+  if (Math.max(width, height) > MAX_RESOLUTION) {
+    return [width, height];
+  }
+  const scale = Math.min(1, NATIVE_RESOLUTION / Math.max(width, height));
+  return [Math.floor(width * scale / 8) * 8, Math.floor(height * scale / 8) * 8];
+}
 
 interface GenerationRequest {
   prompt: string;
@@ -13,11 +33,14 @@ interface GenerationRequest {
   cfg_scale?: number;
   sampler_name?: string;
   seed?: number;
-  model?: string;
+  model?: string; // Base model id; a multi-worker server routes by it
+  adapter?: string; // LORA adapter from /sdapi/v1/sd-models
+  preview?: boolean; // Fast low-step, reduced-size draft
 }
 
 interface GenerationResponse {
-  images: string[];
+  images?: string[]; // Base64 images (default response_format)
+  urls?: string[]; // /outputs paths with response_format "url"
   parameters: any;
   info: any;
 }
@@ -47,28 +70,38 @@ class ImageGenerationService {
         const controller = new AbortController();
         const timeoutId = setTimeout(() => controller.abort(), this.timeout);
 
+        // Sizes above the native resolution are drawn natively, then upscaled and refined (hires fix)
+        const width = request.width || 1024;
+        const height = request.height || 1024;
+        const [firstWidth, firstHeight] = firstPassSize(width, height);
+        const hires = firstWidth < width || firstHeight < height;
+
         // Configure default parameters based on comic style
         const payload = {
           prompt: request.prompt,
           negative_prompt: request.negative_prompt || "ugly, deformed, disfigured, poor details, bad anatomy",
           steps: request.steps || 20,
-          width: request.width || 1024,
-          height: request.height || 1024,
+          width: firstWidth,
+          height: firstHeight,
           cfg_scale: request.cfg_scale || 7,
           sampler_name: request.sampler_name || "Euler a",
           seed: request.seed || -1,
-          model: request.model || undefined, // Use your fine-tuned model name here if needed
-          // Additional parameters that might be useful for comic art
-          enable_hr: true,
-          hr_scale: 1.5,
+          model: request.model || undefined,
+          adapter: request.adapter || undefined,
+          preview: request.preview || undefined,
+          response_format: USE_IMAGE_URLS ? 'url' : undefined,
+          // Second pass at the requested size: 10 steps at the default strength of 0.7 run 7 of them
+          enable_hr: hires,
           hr_upscaler: "Latent",
           hr_second_pass_steps: 10,
-          hr_resize_x: 0,
-          hr_resize_y: 0,
+          hr_resize_x: hires ? width : 0,
+          hr_resize_y: hires ? height : 0,
         };
 
         const headers: Record<string, string> = {
           'Content-Type': 'application/json',
+          // Lets the server stop generating once this attempt has been aborted
+          'X-Request-Timeout': String(this.timeout / 1000),
         };
         
         // Add API key to headers if provided
@@ -93,15 +126,14 @@ class ImageGenerationService {
         }
 
         const data: GenerationResponse = await response.json();
+        const images = this.imageUrls(data);
         
-        if (!data.images || data.images.length === 0) {
+        if (images.length === 0) {
           throw new Error('No images returned from the model');
         }
 
-        // Return the first generated image as base64 string
-        // You can convert this to a data URL or upload it somewhere based on your needs
-        const imageData = data.images[0];
-        return `data:image/png;base64,${imageData}`;
+        // Return the first generated image as a URL the browser can load
+        return images[0];
       } catch (error) {
         lastError = error as Error;
         
@@ -122,6 +154,16 @@ class ImageGenerationService {
     throw lastError || new Error('Unknown error during image generation');
   }
 
+  /**
+   * Image URLs of a generation response: absolute /outputs URLs, or data URLs for inline base64 images
+   */
+  private imageUrls(data: GenerationResponse): string[] {
+    if (data.urls) {
+      return data.urls.map(url => `${this.apiEndpoint}${url}`);
+    }
+    return (data.images || []).map(image => `data:image/png;base64,${image}`);
+  }
+
   /**
    * Batch generate images for multiple prompts
    */
@@ -133,6 +175,7 @@ class ImageGenerationService {
     cfg_scale?: number;
     sampler_name?: string;
     model?: string;
+    adapter?: string;
   }): Promise<string[]> {
     const results: string[] = [];
     
@@ -146,7 +189,8 @@ class ImageGenerationService {
           height: options?.height,
           cfg_scale: options?.cfg_scale,
           sampler_name: options?.sampler_name,
-          model: options?.model
+          model: options?.model,
+          adapter: options?.adapter
         });
         results.push(image);
       } catch (error) {
@@ -161,6 +205,57 @@ class ImageGenerationService {
     return results;
   }
 
+  /**
+   * Generate every panel of a page in one request. Panels that share a main
+   * character start from the same seed, so the character looks consistent.
+   * Returns image data URLs keyed by scene id.
+   */
+  async generatePage(page: ComicPage, options?: {
+    negative_prompt?: string;
+    steps?: number;
+    width?: number;
+    height?: number;
+    cfg_scale?: number;
+    sampler_name?: string;
+    seed?: number; // Story seed; keep it fixed across pages
+    adapter?: string; // LORA adapter from /sdapi/v1/sd-models
+    preview?: boolean;
+  }): Promise<Record<string, string>> {
+    const timeout = this.timeout * page.scenes.length;
+    const headers: Record<string, string> = {
+      'Content-Type': 'application/json',
+      'X-Request-Timeout': String(timeout / 1000),
+    };
+    if (this.apiKey) {
+      headers['Authorization'] = `Bearer ${this.apiKey}`;
+    }
+
+    const controller = new AbortController();
+    const timeoutId = setTimeout(() => controller.abort(), timeout);
+    try {
+      const response = await fetch(`${this.apiEndpoint}/sdapi/v1/page`, {
+        method: 'POST',
+        headers,
+        body: JSON.stringify({ page, response_format: USE_IMAGE_URLS ? 'url' : undefined, ...options }),
+        signal: controller.signal,
+      });
+      if (!response.ok) {
+        const errorData = await response.text();
+        throw new Error(`Page generation failed: ${response.status} ${response.statusText}. Details: ${errorData}`);
+      }
+
+      const data = await response.json();
+      const urls = this.imageUrls(data);
+      const images: Record<string, string> = {};
+      data.panels.forEach((panel: { scene_id: string }, index: number) => {
+        images[panel.scene_id] = urls[index];
+      });
+      return images;
+    } finally {
+      clearTimeout(timeoutId);
+    }
+  }
+
   /**
    * Get the list of available models (optional, for model selection)
    */
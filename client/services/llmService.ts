@@ -1,10 +1,12 @@
-import { ComicPage } from "../types";
+import { ComicPage, Scene } from "../types";
 
 // Configuration for the APIs
 const DEFAULT_OLLAMA_ENDPOINT = import.meta.env.VITE_OLLAMA_ENDPOINT || 'http://localhost:11434';
 const DEFAULT_OPENROUTER_API_KEY = import.meta.env.VITE_OPENROUTER_API_KEY || '';
 const DEFAULT_OPENROUTER_MODEL = import.meta.env.VITE_OPENROUTER_MODEL || 'google/gemma-2-9b-it';
 const DEFAULT_GEMMA_MODEL = import.meta.env.VITE_OLLAMA_MODEL || 'gemma:2b'; // Default to gemma 2b
+// The image server's Ollama gateway (e.g. http://localhost:7860/llm); empty skips image prompt generation
+const DEFAULT_LLM_GATEWAY_ENDPOINT = import.meta.env.VITE_LLM_GATEWAY_ENDPOINT || '';
 
 interface GenerationRequest {
   title: string;
@@ -26,6 +28,15 @@ interface OllamaResponse {
   done: boolean;
 }
 
+interface ScenePromptsResponse {
+  scenes: Array<{
+    id: string;
+    imagePrompt: string;
+  }>;
+  missing: string[];
+  cached: boolean;
+}
+
 interface OpenRouterResponse {
   choices: Array<{
     message: {
@@ -39,9 +50,11 @@ class LLMService {
   private openRouterApiKey: string;
   private openRouterModel: string;
   private gemmaModel: string;
+  private gatewayEndpoint: string;
 
   constructor() {
     this.ollamaEndpoint = DEFAULT_OLLAMA_ENDPOINT;
+    this.gatewayEndpoint = DEFAULT_LLM_GATEWAY_ENDPOINT;
     this.openRouterApiKey = DEFAULT_OPENROUTER_API_KEY;
     this.openRouterModel = DEFAULT_OPENROUTER_MODEL;
     this.gemmaModel = DEFAULT_GEMMA_MODEL;
@@ -80,6 +93,55 @@ class LLMService {
     this.gemmaModel = model;
   }
 
+  getGatewayEndpoint(): string {
+    return this.gatewayEndpoint;
+  }
+
+  setGatewayEndpoint(endpoint: string): void {
+    this.gatewayEndpoint = endpoint;
+  }
+
+  /**
+   * Turn every scene of a page into a diffusion image prompt with a single LLM call
+   * through the image server's gateway. Returns image prompts by scene id, or an
+   * empty map when no gateway is configured.
+   */
+  async generateImagePrompts(scenes: Scene[], style: string): Promise<Record<string, string>> {
+    if (!this.gatewayEndpoint) {
+      return {};
+    }
+
+    const response = await fetch(`${this.gatewayEndpoint}/scene-prompts`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        model: this.gemmaModel,
+        style: style,
+        scenes: scenes.map(scene => ({
+          id: scene.id,
+          prompt: scene.prompt,
+          characters: scene.characters,
+          narrator: scene.narrator,
+        })),
+      }),
+    });
+
+    if (!response.ok) {
+      throw new Error(`LLM gateway error: ${response.status} ${response.statusText}`);
+    }
+
+    const data: ScenePromptsResponse = await response.json();
+    const prompts: Record<string, string> = {};
+    for (const scene of data.scenes) {
+      if (!data.missing.includes(scene.id)) {
+        prompts[scene.id] = scene.imagePrompt;
+      }
+    }
+    return prompts;
+  }
+
   /**
    * Check if Ollama is available
    */
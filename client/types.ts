@@ -36,6 +36,7 @@ export interface Scene {
   dialogue: DialogueLine[];
   imagePrompt?: string; // Optimized prompt for diffusion
   imageUrl?: string; // The generated image URL
+  characters?: string[]; // Characters shown; defaults to the dialogue speakers for page generation
 }
 
 export interface ComicPage {
@@ -0,0 +1,176 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+
+from snapshot import file_sha256
+
+logger = logging.getLogger(__name__)
+
+LORA_EXTENSIONS = (".safetensors",)
+
+
+def adapter_key(name):
+    """Normalised adapter name, so "Pixel Art" and "pixel-art" both select pixel_art"""
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+class AdapterRegistry:
+    """
+    LoRA adapters available in a weights directory, loaded into the resident pipeline on demand.
+
+    ``weights_dir`` is scanned for ``<name>.safetensors`` files and
+    ``<name>/<weights>.safetensors`` subdirectories. The configured default
+    weights file is registered as ``default_name``. At most ``max_loaded``
+    adapters stay in the pipeline; the least recently used one is deleted
+    when another has to be loaded. Methods taking ``pipe`` must be called
+    under the pipeline lock.
+    """
+
+    def __init__(self, weights_dir, default_weight_name, default_name="comic_style", max_loaded=4):
+        self.weights_dir = weights_dir
+        self.default_weight_name = default_weight_name
+        self.default_name = default_name
+        self.max_loaded = max(1, max_loaded)
+        self.fused = None  # Adapter fused into the base weights (snapshot fast path) and its scale
+        self.loads = 0
+        self.evictions = 0
+        self._entries = {}
+        self._hashes = {}  # path -> (mtime, sha256)
+        self._loaded = OrderedDict()  # adapter name -> None, least recently used first
+        self._enabled = True
+        self._lock = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        """Re-read the weights directory and return the adapter entries"""
+        entries = {}
+        default_path = os.path.join(self.weights_dir, self.default_weight_name)
+        if os.path.exists(default_path):
+            entries[self.default_name] = {"name": self.default_name, "directory": self.weights_dir, "weight_name": self.default_weight_name}
+
+        if os.path.isdir(self.weights_dir):
+            for filename in sorted(os.listdir(self.weights_dir)):
+                path = os.path.join(self.weights_dir, filename)
+                if os.path.isdir(path):
+                    weight_files = sorted(f for f in os.listdir(path) if f.endswith(LORA_EXTENSIONS))
+                    if not weight_files:
+                        continue
+                    weight_name = self.default_weight_name if self.default_weight_name in weight_files else weight_files[0]
+                    entries.setdefault(adapter_key(filename), {"name": adapter_key(filename), "directory": path, "weight_name": weight_name})
+                elif filename.endswith(LORA_EXTENSIONS) and filename != self.default_weight_name:
+                    name = adapter_key(os.path.splitext(filename)[0])
+                    entries.setdefault(name, {"name": name, "directory": self.weights_dir, "weight_name": filename})
+
+        with self._lock:
+            self._entries = entries
+            return list(entries.values())
+
+    def names(self):
+        with self._lock:
+            return list(self._entries)
+
+    def get(self, name):
+        """Return the entry for an adapter name, raising ValueError if there is none"""
+        key = adapter_key(name)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            # New weights may have been copied in since the last scan
+            self.scan()
+            with self._lock:
+                entry = self._entries.get(key)
+        if entry is None:
+            raise ValueError(f"Unknown LORA adapter: {name}")
+        return entry
+
+    def sha256(self, name):
+        """sha256 of an adapter's weights file, recomputed only when the file changes"""
+        entry = self.get(name)
+        path = os.path.join(entry["directory"], entry["weight_name"])
+        mtime = os.path.getmtime(path)
+        cached = self._hashes.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, file_sha256(path))
+            self._hashes[path] = cached
+        return cached[1]
+
+    def selection(self, adapters):
+        """
+        Normalise a request's adapters, a list of ``(name, scale)`` pairs, into
+        a hashable tuple usable in batch and cache keys.
+        """
+        selection = tuple((self.get(name)["name"], round(float(scale), 4)) for name, scale in adapters)
+        if self.fused is not None and selection != (self.fused,):
+            fused_name, fused_scale = self.fused
+            raise ValueError(
+                f"{fused_name} is fused into the snapshot at scale {fused_scale}; "
+                "other adapters or scales need the standard load path (remove the snapshot)"
+            )
+        return selection
+
+    def is_loaded(self, name):
+        with self._lock:
+            return name in self._loaded
+
+    def _load(self, pipe, name, keep):
+        entry = self.get(name)
+        while len(self._loaded) >= self.max_loaded:
+            victim = next((loaded for loaded in self._loaded if loaded not in keep), None)
+            if victim is None:
+                break
+            logger.info(f"Unloading LORA adapter {victim}")
+            pipe.delete_adapters(victim)
+            with self._lock:
+                del self._loaded[victim]
+            self.evictions += 1
+
+        logger.info(f"Loading LORA adapter {name} from {os.path.join(entry['directory'], entry['weight_name'])}")
+        pipe.load_lora_weights(entry["directory"], weight_name=entry["weight_name"], adapter_name=name)
+        with self._lock:
+            self._loaded[name] = None
+        self.loads += 1
+
+    def preload(self, pipe, names):
+        """Load adapters ahead of the requests that will use them"""
+        names = [self.get(name)["name"] for name in names]
+        for name in names:
+            if self.fused is not None and name == self.fused[0]:
+                continue
+            if self.is_loaded(name):
+                with self._lock:
+                    self._loaded.move_to_end(name)
+            else:
+                self._load(pipe, name, names)
+        return names
+
+    def activate(self, pipe, selection):
+        """Load the selected adapters if needed and make them the only active ones, at their scales"""
+        if self.fused is not None:
+            return  # The only valid selection is already part of the weights
+
+        names = [name for name, _ in selection]
+        self.preload(pipe, names)
+
+        if not selection:
+            if self._enabled and self._loaded:
+                pipe.disable_lora()
+                self._enabled = False
+            return
+
+        if not self._enabled:
+            pipe.enable_lora()
+            self._enabled = True
+        pipe.set_adapters(names, adapter_weights=[scale for _, scale in selection])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available": sorted(self._entries),
+                "loaded": list(self._loaded),
+                "max_loaded": self.max_loaded,
+                "fused": self.fused[0] if self.fused else None,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
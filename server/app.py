@@ -1,5 +1,5 @@
-from flask import Flask, request, jsonify, send_file
-from diffusers import AutoPipelineForText2Image
+from flask import Flask, request, jsonify, send_file, Response, g
+from diffusers import AutoPipelineForText2Image, AutoPipelineForImage2Image
 import torch
 import os
 import io
@@ -7,6 +7,34 @@ import base64
 from PIL import Image
 import uuid
 import logging
+import threading
+import time
+import sys
+import random
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+# Helpers shared with the command line scripts live in ../utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+
+from batching import BatchScheduler
+from jobs import JobQueue, QueueFullError
+from result_cache import ResultCache, make_cache_key
+from snapshot import file_sha256, read_manifest, snapshot_matches, load_snapshot
+from embedding_cache import PromptEmbeddingCache
+from encoding import ImageEncoder, FORMATS, parse_encode_options, cache_variant, media_type, extension
+from page import plan_page
+from adapters import AdapterRegistry
+from metrics import MetricsRegistry
+from coalescing import SingleFlight
+from llm_gateway import LLMGateway, create_blueprint
+from compression import compress_response
+from output_store import OutputStore
+from cancellation import CancelToken, DisconnectWatcher, GenerationCancelled, DEADLINE, DISCONNECTED
+from previews import LivePreview, PreviewDecoder, encode_preview
+from samplers import SchedulerRegistry, resolve_sampler, list_samplers
+from memory_profile import choose_profile, profile_dtype, place_pipeline, configure_for_resolution
 
 app = Flask(__name__)
 
@@ -18,8 +46,60 @@ logger = logging.getLogger(__name__)
 BASE_MODEL_ID = os.getenv("SD_BASE_MODEL_ID", "runwayml/stable-diffusion-v1-5")  # Base model
 LORA_MODEL_PATH = os.getenv("SD_LORA_PATH", "../models/weights")  # Path to LORA weights
 LORA_WEIGHT_NAME = os.getenv("SD_LORA_WEIGHT", "pytorch_lora_weights.safetensors")  # LORA weight filename
+LORA_SCALE = float(os.getenv("SD_LORA_SCALE", "0.8"))  # Strength of the LORA style
+MAX_LOADED_ADAPTERS = int(os.getenv("SD_MAX_LOADED_ADAPTERS", "4"))  # LORA adapters kept in the pipeline at once
+DEFAULT_ADAPTER = "comic_style"  # Adapter name of SD_LORA_PATH/SD_LORA_WEIGHT
+SNAPSHOT_DIR = os.getenv("SD_SNAPSHOT_DIR", "../utils/fused_snapshot")  # Fused LORA snapshot built by setup_sd.py --snapshot
 CACHE_DIR = os.getenv("SD_CACHE_DIR", "./cache")
 OUTPUT_DIR = os.getenv("SD_OUTPUT_DIR", "./outputs")
+BATCH_WINDOW_MS = int(os.getenv("SD_BATCH_WINDOW_MS", "50"))  # How long to wait for compatible txt2img requests
+MAX_BATCH_SIZE = int(os.getenv("SD_MAX_BATCH_SIZE", "4"))  # Max prompts per batched pipeline call
+JOB_WORKERS = int(os.getenv("SD_JOB_WORKERS", "4"))  # Jobs running at once (concurrent txt2img jobs can share a batch)
+JOB_QUEUE_DEPTH = int(os.getenv("SD_JOB_QUEUE_DEPTH", "16"))  # Jobs allowed to wait before new ones get a 429
+JOB_TTL = int(os.getenv("SD_JOB_TTL", "3600"))  # Seconds finished jobs are kept for polling
+RESULT_CACHE_MEMORY_MB = int(os.getenv("SD_RESULT_CACHE_MEMORY_MB", "256"))  # In-memory LRU of seeded results
+RESULT_CACHE_DISK_MB = int(os.getenv("SD_RESULT_CACHE_DISK_MB", "2048"))  # On-disk tier, kept in the output store
+EMBEDDING_CACHE_SIZE = int(os.getenv("SD_EMBEDDING_CACHE_SIZE", "256"))  # Prompt embeddings kept in memory
+SAVE_OUTPUTS = os.getenv("SD_SAVE_OUTPUTS", "1") == "1"  # Also keep a copy of unseeded results in the output store
+OUTPUT_MAX_MB = int(os.getenv("SD_OUTPUT_MAX_MB", "0"))  # Size cap of the output store, least recently used go first; 0 for none
+OUTPUT_RETENTION_DAYS = float(os.getenv("SD_OUTPUT_RETENTION_DAYS", "0"))  # Outputs unused this long are deleted; 0 keeps them
+OUTPUT_GC_INTERVAL = int(os.getenv("SD_OUTPUT_GC_INTERVAL", "600"))  # Seconds between retention passes over the output store
+TORCH_THREADS = int(os.getenv("SD_TORCH_THREADS", "0"))  # Intra-op threads for torch, 0 keeps the default
+CPU_AFFINITY = os.getenv("SD_CPU_AFFINITY", "")  # Cores to pin this process to, e.g. "0-7" or "0,2,4"
+WARMUP = os.getenv("SD_WARMUP", "1") == "1"  # Run one tiny generation after loading to initialise kernels/allocator
+LOADING_RETRY_AFTER = int(os.getenv("SD_LOADING_RETRY_AFTER", "10"))  # Retry-After seconds while the model loads
+ENCODE_WORKERS = int(os.getenv("SD_ENCODE_WORKERS", "2"))  # Threads encoding images and thumbnails
+MEMORY_PROFILE = os.getenv("SD_MEMORY_PROFILE", "auto")  # auto, full, balanced or low (see memory_profile.py)
+MAX_RESOLUTION = int(os.getenv("SD_MAX_RESOLUTION", "1024"))  # Largest panel side the memory profile must fit
+CPU_BF16 = os.getenv("SD_CPU_BF16", "1") == "1"  # Use bfloat16 on CPUs with native support (AVX512-BF16/AMX)
+PREVIEW_SAMPLER = os.getenv("SD_PREVIEW_SAMPLER", "DPM++ 2M Karras")  # Sampler for "preview": true drafts
+PREVIEW_STEPS = int(os.getenv("SD_PREVIEW_STEPS", "10"))  # Step cap for drafts
+PREVIEW_SCALE = float(os.getenv("SD_PREVIEW_SCALE", "0.5"))  # Drafts render at this fraction of the requested size
+MAX_PAGE_SCENES = int(os.getenv("SD_MAX_PAGE_SCENES", "8"))  # Scenes accepted by one page request
+LIVE_PREVIEW_EVERY = int(os.getenv("SD_LIVE_PREVIEW_EVERY", "5"))  # Steps between streamed previews, 0 turns them off
+REQUEST_TIMEOUT = float(os.getenv("SD_REQUEST_TIMEOUT", "0"))  # Deadline in seconds for generations, 0 for none unless the client sends X-Request-Timeout
+LIVE_PREVIEW_DECODER = os.getenv("SD_LIVE_PREVIEW_DECODER", "")  # AutoencoderTiny for previews, e.g. madebyollin/taesd; empty uses the latent approximation
+OLLAMA_URL = os.getenv("SD_OLLAMA_URL", "http://localhost:11434")  # Ollama server behind the /llm gateway
+LLM_DEFAULT_MODEL = os.getenv("SD_LLM_MODEL", "gemma:2b")  # Model for gateway requests that don't name one
+LLM_TIMEOUT = int(os.getenv("SD_LLM_TIMEOUT", "300"))  # Seconds to wait for Ollama
+LLM_POOL_SIZE = int(os.getenv("SD_LLM_POOL_SIZE", "8"))  # Keep-alive connections held open to Ollama
+LLM_CACHE_MEMORY_MB = int(os.getenv("SD_LLM_CACHE_MEMORY_MB", "32"))  # In-memory LRU of LLM completions
+LLM_CACHE_DISK_MB = int(os.getenv("SD_LLM_CACHE_DISK_MB", "256"))  # On-disk tier, kept in the output store
+JOB_RETRY_AFTER = 5  # Seconds clients should wait before resubmitting when the queue is full
+STREAM_KEEPALIVE = 2  # Seconds between keep-alive comments on idle event streams, which also detect disconnects
+OUTPUT_MAX_AGE = 365 * 24 * 3600  # Outputs are named by their content hash and never change, so clients may cache them for good
+OUTPUT_EXTENSIONS = {media: ext for _, media, ext in FORMATS.values()}  # File extension per image media type
+HR_DENOISING_STRENGTH = 0.7  # Hires fix second pass strength when the request doesn't set denoising_strength
+
+# hr_upscaler names accepted with enable_hr (as in Auto1111) -> torch interpolation mode and antialiasing
+LATENT_UPSCALERS = {
+    "Latent": ("bilinear", False),
+    "Latent (antialiased)": ("bilinear", True),
+    "Latent (bicubic)": ("bicubic", False),
+    "Latent (bicubic antialiased)": ("bicubic", True),
+    "Latent (nearest)": ("nearest", False),
+    "Latent (nearest-exact)": ("nearest-exact", False)
+}
 
 # Ensure directories exist
 os.makedirs(CACHE_DIR, exist_ok=True)
@@ -27,114 +107,1087 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # Global variables for model
 pipe = None
+img2img_pipe = None  # Shares the UNet/VAE/text encoder of `pipe`
+pipe_lock = threading.Lock()  # The pipeline is not thread-safe, only one call may run at a time
+batcher = None
+scheduler_registry = None  # Schedulers per sampler name, built from the loaded pipeline's config
+job_queue = JobQueue(
+    workers=JOB_WORKERS,
+    max_queued=JOB_QUEUE_DEPTH,
+    ttl=JOB_TTL,
+    on_cancel=lambda job, reason: record_cancellation(job.kind, reason)
+)
+disconnect_watcher = DisconnectWatcher()  # Cancels generations whose client hung up
+single_flight = SingleFlight()  # Running seeded txt2img generations, joined by identical requests
+save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output-writer")
+
+# Prometheus metrics served on /metrics
+metrics = MetricsRegistry(prefix="sd_")
+requests_total = metrics.counter("requests_total", "HTTP requests by endpoint and status", ("endpoint", "method", "status"))
+request_seconds = metrics.histogram("request_seconds", "HTTP request latency", ("endpoint",))
+stage_seconds = metrics.histogram("stage_seconds", "Time spent per generation stage", ("stage",))
+step_seconds = metrics.histogram("denoise_step_seconds", "Time per denoising step (one UNet pass over the batch)", ("batch_size",))
+batch_size_histogram = metrics.histogram("batch_size", "Images per pipeline call", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+images_total = metrics.counter("images_total", "Images returned, by source (generated, coalesced or cache)", ("source",))
+cancellations_total = metrics.counter("cancellations_total", "Generations stopped before finishing, by reason", ("reason",))
+metrics.gauge("queue_depth", "Items waiting for the pipeline: batch slots, queued and running jobs", ("queue",), callback=lambda: {
+    ("batch",): batcher.pending_count() if batcher else 0,
+    ("jobs_queued",): job_queue.stats()["queued"],
+    ("jobs_running",): job_queue.stats()["running"]
+})
+metrics.gauge("model_ready", "1 once the model is loaded and warmed up", callback=lambda: int(model_status["phase"] == "ready"))
+metrics.gauge("model_load_seconds", "Time the last model load took", callback=lambda: load_info.get("seconds"))
+metrics.gauge("process_resident_memory_bytes", "Resident set size of the server process",
+              callback=lambda: memory_footprint()["rss_mb"] * (1 << 20))
+metrics.gauge("cuda_memory_bytes", "CUDA memory allocated and reserved by torch", ("kind",), callback=lambda: {
+    ("allocated",): torch.cuda.memory_allocated(),
+    ("reserved",): torch.cuda.memory_reserved()
+} if torch.cuda.is_available() else {})
+metrics.gauge("output_store_bytes", "Size of the saved outputs", callback=lambda: output_store.stats()["bytes"])
+metrics.gauge("output_store_files", "Number of saved outputs", callback=lambda: output_store.stats()["files"])
+metrics.gauge("result_cache_bytes", "Size of the result cache tiers", ("tier",), callback=lambda: {
+    ("memory",): result_cache.stats()["memory_bytes"],
+    ("disk",): result_cache.stats()["disk_bytes"]
+})
+
+image_encoder = ImageEncoder(
+    workers=ENCODE_WORKERS,
+    on_encoded=lambda image_format, seconds: stage_seconds.observe(seconds, stage="encode")
+)
+embedding_cache = PromptEmbeddingCache(max_entries=EMBEDDING_CACHE_SIZE)
+adapters = AdapterRegistry(LORA_MODEL_PATH, LORA_WEIGHT_NAME, DEFAULT_ADAPTER, MAX_LOADED_ADAPTERS)
+default_adapters = ()  # (name, scale) pairs used when a request doesn't pick adapters, set via /options
+load_info = {}  # How the model was loaded and how long it took
+memory_profile = None  # dtype and memory optimisations chosen at load time
+preview_decoder = PreviewDecoder()  # Turns intermediate latents into streamed previews
+# Load phase: pending -> loading -> warming -> ready, or failed
+model_status = {"phase": "pending", "started_at": None, "ready_at": None, "error": None}
+
+# Saved images served on /outputs, sharded on disk with a SQLite index for queries and retention
+output_store = OutputStore(
+    OUTPUT_DIR,
+    OUTPUT_EXTENSIONS,
+    max_bytes=OUTPUT_MAX_MB << 20,
+    max_age=OUTPUT_RETENTION_DAYS * 24 * 3600
+)
+
+# Seeded txt2img results are deterministic, so identical requests are served from this cache
+result_cache = ResultCache(
+    output_store,
+    "results",
+    max_memory_bytes=RESULT_CACHE_MEMORY_MB << 20,
+    max_disk_bytes=RESULT_CACHE_DISK_MB << 20
+)
+
+# Ollama gateway under /llm; completions are cached like seeded images
+llm_gateway = LLMGateway(
+    OLLAMA_URL,
+    ResultCache(
+        output_store,
+        "llm",
+        max_memory_bytes=LLM_CACHE_MEMORY_MB << 20,
+        max_disk_bytes=LLM_CACHE_DISK_MB << 20
+    ),
+    LLM_DEFAULT_MODEL,
+    timeout=LLM_TIMEOUT,
+    pool_size=LLM_POOL_SIZE
+)
+app.register_blueprint(create_blueprint(llm_gateway), url_prefix="/llm")
+
+def parse_core_list(value):
+    """Parse a core list such as "0-3,8" into a set of core ids"""
+    cores = set()
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-")
+            cores.update(range(int(start), int(end) + 1))
+        elif part:
+            cores.add(int(part))
+    return cores
+
+def apply_cpu_settings():
+    """Pin the process to its core set and size torch's thread pool to match"""
+    if CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, parse_core_list(CPU_AFFINITY))
+        logger.info(f"Pinned to cores {CPU_AFFINITY}")
+    if TORCH_THREADS > 0:
+        torch.set_num_threads(TORCH_THREADS)
+        logger.info(f"Using {TORCH_THREADS} torch threads")
+
+def memory_footprint():
+    """Resident set size of this process and CUDA memory in use, in MB"""
+    footprint = {"rss_mb": None}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    footprint["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                    break
+    except OSError:
+        import resource
+        # ru_maxrss is the peak RSS, in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        footprint["rss_mb"] = round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    if torch.cuda.is_available():
+        footprint["cuda_allocated_mb"] = round(torch.cuda.memory_allocated() / (1 << 20), 1)
+        footprint["cuda_reserved_mb"] = round(torch.cuda.memory_reserved() / (1 << 20), 1)
+    return footprint
+
+def warm_up():
+    """Run one tiny generation so kernel selection and allocator setup happen before the first request"""
+    started = time.perf_counter()
+    with pipe_lock, torch.no_grad():
+        adapters.activate(pipe, default_adapters)
+        pipe(
+            prompt="warm up",
+            num_inference_steps=1,
+            width=64,
+            height=64,
+            guidance_scale=1.0
+        )
+    logger.info(f"Warm-up generation took {time.perf_counter() - started:.2f}s")
 
 def load_model():
     """Load the Stable Diffusion model with LORA weights"""
-    global pipe
+    global pipe, img2img_pipe, batcher, default_adapters, load_info, memory_profile, scheduler_registry, preview_decoder
+
+    model_status.update(phase="loading", started_at=time.time(), ready_at=None, error=None)
+    started = time.perf_counter()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    memory_profile = choose_profile(device, MAX_RESOLUTION, MAX_RESOLUTION, MEMORY_PROFILE, CPU_BF16)
+    logger.info(f"Memory profile: {memory_profile['name']} ({memory_profile['dtype']}, "
+                f"{memory_profile['available_mb']}MB available, ~{memory_profile['estimated_mb']}MB needed "
+                f"at {MAX_RESOLUTION}x{MAX_RESOLUTION})")
+    torch_dtype = profile_dtype(memory_profile)
+    lora_full_path = os.path.join(LORA_MODEL_PATH, LORA_WEIGHT_NAME)
+    current_lora_hash = file_sha256(lora_full_path)
+    # Other adapters can't be applied on top of weights with comic_style fused in
+    other_adapters = [name for name in adapters.names() if name != DEFAULT_ADAPTER]
 
-    logger.info(f"Loading base model: {BASE_MODEL_ID}")
     try:
-        # Load the base model
-        pipe = AutoPipelineForText2Image.from_pretrained(
-            BASE_MODEL_ID,
-            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-            cache_dir=CACHE_DIR
-        )
+        manifest = read_manifest(SNAPSHOT_DIR)
+        if current_lora_hash and not other_adapters and snapshot_matches(manifest, BASE_MODEL_ID, current_lora_hash, LORA_SCALE, memory_profile["dtype"]):
+            # Fast path: the LORA is already fused into the snapshot weights
+            logger.info(f"Loading fused snapshot: {SNAPSHOT_DIR}")
+            pipe = load_snapshot(SNAPSHOT_DIR, torch_dtype)
+            if getattr(pipe, "safety_checker", None) is None:
+                logger.warning("The fused snapshot has no safety checker, so outputs are not NSFW-filtered")
+            adapters.fused = (DEFAULT_ADAPTER, round(LORA_SCALE, 4))
+            load_path = "snapshot"
+        else:
+            if other_adapters and manifest is not None:
+                logger.info(f"Not using the fused snapshot: other LORA adapters are available ({', '.join(other_adapters)})")
+            elif manifest is not None:
+                logger.warning(f"Snapshot at {SNAPSHOT_DIR} does not match the configured model/LORA/dtype, ignoring it")
 
-        # Load LORA weights if they exist
-        lora_full_path = os.path.join(LORA_MODEL_PATH, LORA_WEIGHT_NAME)
-        if os.path.exists(lora_full_path):
-            logger.info(f"Loading LORA weights from {lora_full_path}")
-            pipe.load_lora_weights(
-                LORA_MODEL_PATH,
-                weight_name=LORA_WEIGHT_NAME,
-                adapter_name="comic_style"  # Named adapter for comic/manga style
+            logger.info(f"Loading base model: {BASE_MODEL_ID}")
+            # Load the base model
+            pipe = AutoPipelineForText2Image.from_pretrained(
+                BASE_MODEL_ID,
+                torch_dtype=torch_dtype,
+                cache_dir=CACHE_DIR
             )
-            logger.info("LORA weights loaded successfully")
-        else:
-            logger.warning(f"LORA weights not found at {lora_full_path}, loading base model only")
 
-        # Move to GPU if available, otherwise CPU
-        if torch.cuda.is_available():
-            pipe = pipe.to("cuda")
-            logger.info("Model loaded on GPU")
-        else:
-            pipe = pipe.to("cpu")
-            logger.info("Model loaded on CPU")
+            # Load the default LORA weights if they exist; other adapters load on first use
+            if current_lora_hash:
+                adapters.preload(pipe, [DEFAULT_ADAPTER])
+                logger.info("LORA weights loaded successfully")
+            else:
+                logger.warning(f"LORA weights not found at {lora_full_path}, loading base model only")
+            load_path = "standard"
+
+        default_adapters = ((DEFAULT_ADAPTER, round(LORA_SCALE, 4)),) if current_lora_hash else ()
+
+        # Move to GPU if available, otherwise CPU, and apply the memory optimisations
+        pipe = place_pipeline(pipe, memory_profile)
+        logger.info(f"Model loaded on {device.upper()}")
+
+        # img2img reuses the already loaded components instead of loading them again
+        img2img_pipe = AutoPipelineForImage2Image.from_pipe(pipe)
+        scheduler_registry = SchedulerRegistry(pipe.scheduler.config)
+        preview_decoder = PreviewDecoder.load(LIVE_PREVIEW_DECODER, pipe.device, pipe.dtype, CACHE_DIR)
+
+        # Start the txt2img batching scheduler in front of the pipeline
+        if batcher is None:
+            batcher = BatchScheduler(
+                run_txt2img_batch,
+                window=BATCH_WINDOW_MS / 1000.0,
+                max_batch_size=MAX_BATCH_SIZE
+            )
+            logger.info(f"Batching txt2img requests (window {BATCH_WINDOW_MS}ms, max batch {MAX_BATCH_SIZE})")
+
+        load_info = {
+            "path": load_path,
+            "lora_fused": load_path == "snapshot",
+            "seconds": round(time.perf_counter() - started, 2)
+        }
+        logger.info(f"Model loaded successfully in {load_info['seconds']}s ({load_path} path)")
+
+        if WARMUP:
+            model_status["phase"] = "warming"
+            warm_up()
 
-        logger.info("Model loaded successfully")
+        model_status.update(phase="ready", ready_at=time.time())
     except Exception as e:
+        model_status.update(phase="failed", error=str(e))
         logger.error(f"Error loading model: {str(e)}")
         raise e
 
-@app.route("/sdapi/v1/txt2img", methods=["POST"])
-def txt2img():
-    """Generate image from text prompt"""
-    global pipe
+def start_model_loading():
+    """Load the model in a background thread so the server can bind and answer health checks meanwhile"""
+    def run():
+        try:
+            load_model()
+        except Exception:
+            pass  # Already logged and recorded in model_status
 
-    if pipe is None:
-        return jsonify({"error": "Model not loaded"}), 500
+    threading.Thread(target=run, name="model-loader", daemon=True).start()
 
-    try:
-        data = request.get_json()
+def model_unavailable():
+    """Return an error response while the model is not ready to generate, otherwise None"""
+    if model_status["phase"] == "ready":
+        return None
+    if model_status["phase"] == "failed":
+        return jsonify({"error": f"Model failed to load: {model_status['error']}"}), 500
+
+    response = jsonify({"error": "Model is still loading", "phase": model_status["phase"]})
+    response.headers["Retry-After"] = str(LOADING_RETRY_AFTER)
+    return response, 503
+
+def readiness():
+    """Load phase, elapsed time and memory footprint for /health and /ready"""
+    started_at = model_status["started_at"]
+    end = model_status["ready_at"] or time.time()
+    return {
+        "phase": model_status["phase"],
+        "ready": model_status["phase"] == "ready",
+        "elapsed_seconds": round(end - started_at, 2) if started_at else None,
+        "error": model_status["error"],
+        "memory": memory_footprint()
+    }
+
+def enhance_prompt(prompt):
+    """Wrap a prompt with the Japanese manga style instructions"""
+    return f"Japanese manga style, {prompt}, highly detailed, black and white style, sharp lines, manga art style, professional quality, clean lines, detailed character design"
+
+def enhance_negative_prompt(negative_prompt):
+    """Append the manga-specific elements to avoid to a negative prompt"""
+    return f"{negative_prompt}, color image, western cartoon style, low detail, blurry, deformed, ugly, anime screencap, digital art that looks like a screenshot"
+
+def cancelled(item):
+    return item.get("cancel") is not None and item["cancel"].cancelled
+
+def step_callback(items, total_steps, offset=0):
+    """
+    Build a pipeline step callback for a batch: times each step, reports
+    progress and live previews to every item, and stops the call once every
+    item has been cancelled. ``offset`` is the number of steps earlier
+    passes of the same generation already reported.
+    """
+    last_step = [time.perf_counter()]
+
+    def callback(pipeline, step_index, timestep, callback_kwargs):
+        step_seconds.observe(time.perf_counter() - last_step[0], batch_size=len(items))
+        if all(cancelled(item) for item in items):
+            raise GenerationCancelled(items[0]["cancel"].reason)
+
+        step = offset + step_index + 1
+        for position, item in enumerate(items):
+            if item.get("on_step") is not None:
+                item["on_step"](step, total_steps)
+            live_preview = item.get("live_preview")
+            if live_preview is not None and live_preview.due(step, total_steps) and not cancelled(item):
+                image = preview_decoder.decode(callback_kwargs["latents"][position:position + 1])[0]
+                live_preview.emit(step, total_steps, item.get("index", 0), image)
+        # Previews are not part of the step time
+        last_step[0] = time.perf_counter()
+        return callback_kwargs
+    return callback
+
+def decode_latents(pipeline, latents):
+    """VAE-decode latents from an output_type="latent" call and post-process them as the pipeline would"""
+    with stage_seconds.time(stage="vae_decode"):
+        image = pipeline.vae.decode(latents / pipeline.vae.config.scaling_factor, return_dict=False)[0]
+
+    has_nsfw_concept = None
+    if getattr(pipeline, "safety_checker", None) is not None:
+        with stage_seconds.time(stage="safety_check"):
+            image, has_nsfw_concept = pipeline.run_safety_checker(image, pipeline._execution_device, latents.dtype)
+
+    with stage_seconds.time(stage="postprocess"):
+        # Flagged images come back blacked out by the safety checker and must not be denormalized
+        do_denormalize = [True] * image.shape[0] if has_nsfw_concept is None else [not flagged for flagged in has_nsfw_concept]
+        return pipeline.image_processor.postprocess(image, output_type="pil", do_denormalize=do_denormalize)
+
+def hires_settings(data, width, height, steps, sampler_name):
+    """
+    The hires fix a txt2img request asks for with ``enable_hr``, or None.
+
+    As in Auto1111, ``width``/``height`` are the first pass and the final
+    size is ``hr_resize_x``/``hr_resize_y`` (one of them keeps the aspect
+    ratio) or else ``hr_scale`` times the first pass. A final size beyond
+    SD_MAX_RESOLUTION is scaled down to fit, keeping its aspect ratio; if
+    it then doesn't enlarge the first pass there is no second pass.
+    Returns the batch key part ``(width, height, steps, denoising_strength,
+    upscaler, sampler_name)`` of the second pass.
+    """
+    if not data.get("enable_hr"):
+        return None
+
+    resize_x, resize_y = int(data.get("hr_resize_x") or 0), int(data.get("hr_resize_y") or 0)
+    if resize_x or resize_y:
+        hr_width = resize_x or resize_y * width / height
+        hr_height = resize_y or resize_x * height / width
+    else:
+        hr_scale = float(data.get("hr_scale", 2.0))
+        hr_width, hr_height = width * hr_scale, height * hr_scale
+    fit = min(1.0, MAX_RESOLUTION / max(hr_width, hr_height))
+    if fit < 1.0:
+        logger.info(f"Hires fix size {int(hr_width)}x{int(hr_height)} is larger than SD_MAX_RESOLUTION "
+                    f"({MAX_RESOLUTION}), scaling it down to fit")
+    hr_width, hr_height = int(hr_width * fit) // 8 * 8, int(hr_height * fit) // 8 * 8
+    # The second pass only enlarges; a target smaller than the first pass in either direction renders in one pass
+    if hr_width < width or hr_height < height or (hr_width, hr_height) == (width, height):
+        return None
+
+    upscaler = data.get("hr_upscaler") or "Latent"
+    if upscaler not in LATENT_UPSCALERS:
+        raise ValueError(f"Unsupported hr_upscaler: {upscaler} (supported: {', '.join(LATENT_UPSCALERS)})")
+    hr_steps = int(data.get("hr_second_pass_steps") or 0) or steps
+    denoising_strength = float(data.get("denoising_strength", HR_DENOISING_STRENGTH))
+    if int(hr_steps * denoising_strength) < 1:
+        raise ValueError("hr_second_pass_steps * denoising_strength must be at least 1")
+    hr_sampler_name = resolve_sampler(data.get("hr_sampler_name") or sampler_name)
+    return (hr_width, hr_height, hr_steps, denoising_strength, upscaler, hr_sampler_name)
 
-        # Extract parameters
-        prompt = data.get("prompt", "")
-        negative_prompt = data.get("negative_prompt", "")
-        steps = data.get("steps", 20)
-        width = data.get("width", 512)
-        height = data.get("height", 512)
-        cfg_scale = data.get("cfg_scale", 7.5)
-        seed = data.get("seed", -1)
-        sampler_name = data.get("sampler_name", "Euler a")
-
-        # Enhance the prompt with specific Japanese manga style instructions
-        enhanced_prompt = f"Japanese manga style, {prompt}, highly detailed, black and white style, sharp lines, manga art style, professional quality, clean lines, detailed character design"
-
-        # Enhanced negative prompt with manga-specific elements to avoid
-        enhanced_negative_prompt = f"{negative_prompt}, color image, western cartoon style, low detail, blurry, deformed, ugly, anime screencap, digital art that looks like a screenshot"
-
-        # Generate the image
-        generator = None
-        if seed != -1:
-            generator = torch.Generator(device=pipe.device).manual_seed(seed)
-
-        with torch.no_grad():
-            image = pipe(
-                prompt=enhanced_prompt,
-                negative_prompt=enhanced_negative_prompt,
+def hires_parameters(hires):
+    """The hires fix as echoed in a result's parameters"""
+    if hires is None:
+        return None
+    hr_width, hr_height, hr_steps, denoising_strength, upscaler, hr_sampler_name = hires
+    return {
+        "width": hr_width,
+        "height": hr_height,
+        "steps": hr_steps,
+        "denoising_strength": denoising_strength,
+        "upscaler": upscaler,
+        "sampler_name": hr_sampler_name
+    }
+
+def upscale_latents(pipeline, latents, width, height, upscaler):
+    """Resize first pass latents to the hires fix size (in pixels) without decoding them"""
+    mode, antialias = LATENT_UPSCALERS[upscaler]
+    size = (height // pipeline.vae_scale_factor, width // pipeline.vae_scale_factor)
+    # Latents are small; interpolating in float32 also covers modes half precision lacks on CPU
+    upscaled = torch.nn.functional.interpolate(latents.float(), size=size, mode=mode, antialias=antialias)
+    return upscaled.to(latents.dtype)
+
+def run_txt2img_batch(key, items):
+    """
+    Run one batched txt2img pipeline call for requests sharing the same shape.
+
+    With a hires fix the first pass runs at the requested (native) size,
+    its latents are upscaled and a short img2img pass over the shared
+    components refines them at the final size.
+    """
+    width, height, steps, cfg_scale, sampler_name, selection, hires = key
+
+    # Requests cancelled while they waited for the batch are left out
+    results = [GenerationCancelled(item["cancel"].reason) if cancelled(item) else None for item in items]
+    batch = [item for item in items if not cancelled(item)]
+    if not batch:
+        return results
+
+    # One generator per item so every prompt keeps its own seed
+    generators = []
+    for item in batch:
+        generator = torch.Generator(device=pipe.device)
+        if item["seed"] != -1:
+            generator.manual_seed(item["seed"])
+        else:
+            generator.seed()
+        generators.append(generator)
+
+    with pipe_lock, torch.no_grad():
+        configure_for_resolution(pipe, memory_profile, width, height)
+        pipe.scheduler = scheduler_registry.get(sampler_name)
+        with stage_seconds.time(stage="adapters"):
+            adapters.activate(pipe, selection)
+        with stage_seconds.time(stage="text_encode"):
+            # The style prefix and default negative prompt repeat, so their embeddings are cached per adapter selection
+            prompt_embeds = embedding_cache.encode(pipe, [item["prompt"] for item in batch], variant=selection)
+            negative_prompt_embeds = embedding_cache.encode(pipe, [item["negative_prompt"] for item in batch], variant=selection)
+
+        # Progress counts the steps of both hires fix passes
+        total_steps = steps + (int(hires[2] * hires[3]) if hires else 0)
+
+        # Stop at the latents so the denoising loop and the VAE decode are timed separately
+        started = time.perf_counter()
+        with stage_seconds.time(stage="denoise"):
+            latents = pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
                 num_inference_steps=steps,
                 guidance_scale=cfg_scale,
                 width=width,
                 height=height,
+                generator=generators,
+                callback_on_step_end=step_callback(batch, total_steps),
+                output_type="latent"
+            ).images
+
+        if hires:
+            hr_width, hr_height, hr_steps, denoising_strength, upscaler, hr_sampler_name = hires
+            first_pass = time.perf_counter() - started
+            with stage_seconds.time(stage="hires_upscale"):
+                latents = upscale_latents(pipe, latents, hr_width, hr_height, upscaler)
+            upscaled = time.perf_counter()
+            configure_for_resolution(pipe, memory_profile, hr_width, hr_height)
+            img2img_pipe.scheduler = scheduler_registry.get(hr_sampler_name)
+            # Latents passed as the image skip the VAE encode; strength truncates the schedule like img2img
+            with stage_seconds.time(stage="hires_denoise"):
+                latents = img2img_pipe(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    image=latents,
+                    num_inference_steps=hr_steps,
+                    guidance_scale=cfg_scale,
+                    strength=denoising_strength,
+                    generator=generators,
+                    callback_on_step_end=step_callback(batch, total_steps, offset=steps),
+                    output_type="latent"
+                ).images
+            logger.info(f"Hires fix {width}x{height} -> {hr_width}x{hr_height} for {len(batch)} image(s): "
+                        f"first pass {first_pass:.2f}s, upscale {upscaled - started - first_pass:.2f}s, "
+                        f"second pass {time.perf_counter() - upscaled:.2f}s")
+        images = iter(decode_latents(pipe, latents))
+
+    batch_size_histogram.observe(len(batch))
+    return [result if result is not None else next(images) for result in results]
+
+def output_parameters(result, index):
+    """What produced image ``index`` of a result, as recorded in the output index"""
+    parameters = dict(result["parameters"], seed=result["seeds"][index])
+    if "panels" in result:
+        parameters.update(prompt=result["prompts"][index], panel=result["panels"][index])
+    return parameters
+
+def write_outputs(result, indexes=None):
+    """
+    Save the images of a result (all, or those in ``indexes``) and their
+    thumbnails to the output store. Returns ``(image ids, thumbnail ids)``,
+    the latter as ``(size, id)`` pairs per image.
+    """
+    image_ids, thumbnail_ids = [], []
+    with stage_seconds.time(stage="save"):
+        for index, data in enumerate(result["images"]):
+            if indexes is not None and index not in indexes:
+                continue
+            image_id = output_store.put(data, result["media_type"], result["kind"], result["project"],
+                                        output_parameters(result, index))
+            image_ids.append(image_id)
+            thumbnail_ids.append([
+                (variant["size"], output_store.put(variant["data"], result["media_type"], "thumbnail", result["project"],
+                                                   {"source": image_id, "size": variant["size"]}))
+                for variant in result["thumbnails"][index]
+            ])
+    return image_ids, thumbnail_ids
+
+def save_outputs(result, data, image_format):
+    """Keep unseeded images in the output store, in the background so responses don't wait on disk"""
+    if image_format is None and data.get("response_format") == "url":
+        return  # json_body saves every image of a url response itself
+    # Seeded images can be regenerated, and the result cache already holds them
+    indexes = {index for index, seed in enumerate(result["seeds"]) if seed == -1}
+    if SAVE_OUTPUTS and indexes:
+        save_executor.submit(write_outputs, result, indexes)
+
+def adapter_selection(data):
+    """
+    The LORA adapters a request asks for, as ``(name, scale)`` pairs.
+
+    ``adapters`` picks several (``[{"name": ..., "scale": ...}]`` or names);
+    otherwise ``adapter`` (or ``override_settings.sd_model_checkpoint``) picks
+    one of /sdapi/v1/sd-models at ``lora_scale``. Without either the
+    defaults set through /sdapi/v1/options apply. ``model`` is left alone:
+    it names the base model, which serve.py routes requests by.
+    """
+    scale = data.get("lora_scale", LORA_SCALE)
+    if "adapters" in data:
+        requested = [
+            (adapter["name"], adapter.get("scale", scale)) if isinstance(adapter, dict) else (adapter, scale)
+            for adapter in data["adapters"]
+        ]
+    else:
+        adapter = data.get("adapter") or data.get("override_settings", {}).get("sd_model_checkpoint")
+        if adapter and adapter != BASE_MODEL_ID:
+            requested = [(adapter, scale)]
+        elif "lora_scale" in data:
+            requested = [(name, scale) for name, _ in default_adapters]
+        else:
+            return default_adapters
+    return adapters.selection(requested)
+
+def preview_settings(steps, width, height):
+    """Drafts: a fast sampler at few steps and reduced size, for layout before the full render"""
+    return (
+        resolve_sampler(PREVIEW_SAMPLER),
+        min(steps, PREVIEW_STEPS),
+        max(64, int(width * PREVIEW_SCALE) // 8 * 8),
+        max(64, int(height * PREVIEW_SCALE) // 8 * 8)
+    )
+
+def render_txt2img(entries, shape, encode_options, on_step=None, live_preview=None, cancel=None):
+    """
+    Generate and encode one image per ``(prompt, negative_prompt, seed)`` entry.
+
+    Prompts must already be enhanced; ``shape`` is the batch key
+    ``(width, height, steps, cfg_scale, sampler_name, adapters, hires)``,
+    ``hires`` being None or the second pass from hires_settings(). Seeded entries are
+    served from the result cache when possible, or join an identical
+    generation already in flight; the rest go through the batching scheduler. ``live_preview`` (a LivePreview) receives intermediate
+    images and ``cancel`` (a CancelToken) stops the generation. Returns
+    ``(encoded images, thumbnails, all cached)``.
+    """
+    width, height, steps, cfg_scale, sampler_name, selection, hires = shape
+    file_extension = extension(encode_options)
+    encoded = [None] * len(entries)
+    cache_keys = [None] * len(entries)
+    futures = {}
+    joined = 0
+
+    for index, (prompt, negative_prompt, item_seed) in enumerate(entries):
+        # Queued requests with the same shape are batched into one pipeline call
+        item = {"prompt": prompt, "negative_prompt": negative_prompt, "seed": item_seed}
+        if item_seed == -1:
+            futures[index] = batcher.submit(shape, dict(item, index=index, on_step=on_step, live_preview=live_preview, cancel=cancel))
+            continue
+
+        # Seeded generations are deterministic, so look for an identical earlier result
+        params = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "steps": steps,
+            "width": width,
+            "height": height,
+            "cfg_scale": cfg_scale,
+            "sampler": sampler_name,
+            "seed": item_seed,
+            "adapters": [(name, adapters.sha256(name), scale) for name, scale in selection],
+            "model": BASE_MODEL_ID,
+            # Fused and unfused LORA weights, or another dtype, give slightly different pixels
+            "weights": (load_info["path"], memory_profile["dtype"])
+        }
+        if hires:
+            params["hires"] = hires
+        cache_keys[index] = make_cache_key(dict(params, encoding=cache_variant(encode_options)))
+        encoded[index] = result_cache.get(cache_keys[index])
+        if encoded[index] is None:
+            # ...or for an identical one still running (a retry, a double click), and share its image
+            futures[index], shared = single_flight.submit(
+                make_cache_key(params),
+                lambda flight: batcher.submit(shape, dict(item, on_step=flight.on_step, live_preview=flight, cancel=flight)),
+                on_step, live_preview, index, cancel
+            )
+            joined += shared
+
+    if joined:
+        logger.info(f"Joined in-flight generations for {joined} image(s)")
+    images_total.inc(len(futures) - joined, source="generated")
+    images_total.inc(joined, source="coalesced")
+    images_total.inc(len(entries) - len(futures), source="cache")
+    cached = len(futures) == 0
+    if cached:
+        logger.info(f"Result cache hit for {len(entries)} image(s)")
+
+    # Encode off the request thread; images of a batch (and their thumbnails) encode in parallel
+    encodings = []
+    for index in range(len(entries)):
+        if index in futures:
+            image = futures[index].result()
+            # A shared generation outlives the requests that gave up on it; they don't need the image
+            if cancel is not None:
+                cancel.check()
+            encodings.append(image_encoder.submit(image, encode_options))
+        else:
+            encodings.append(image_encoder.submit(None, encode_options, encoded=encoded[index]))
+    encodings = [encoding.result() for encoding in encodings]
+
+    for index in futures:
+        encoded[index] = encodings[index]["image"]
+        if cache_keys[index] is not None:
+            # The result cache's tier in the output store is the saved copy of seeded results
+            with stage_seconds.time(stage="save"):
+                result_cache.put(cache_keys[index], encoded[index], extension=f".{file_extension}")
+
+    return encoded, [encoding["thumbnails"] for encoding in encodings], cached
+
+def generate_txt2img(data, on_step=None, image_format=None, live_preview=None, cancel=None):
+    """Run a txt2img request and return the encoded images with their parameters"""
+    # Extract parameters
+    prompt = data.get("prompt", "")
+    negative_prompt = data.get("negative_prompt", "")
+    steps = data.get("steps", 20)
+    width = data.get("width", 512)
+    height = data.get("height", 512)
+    cfg_scale = data.get("cfg_scale", 7.5)
+    seed = data.get("seed", -1)
+    sampler_name = resolve_sampler(data.get("sampler_name", "Euler a"))
+    selection = adapter_selection(data)
+    batch_size = data.get("batch_size", 1)
+    preview = bool(data.get("preview", False))
+    encode_options = parse_encode_options(data, image_format)
+
+    if preview:
+        sampler_name, steps, width, height = preview_settings(steps, width, height)
+    # Drafts skip the hires fix, they're about layout
+    hires = None if preview else hires_settings(data, width, height, steps, sampler_name)
+
+    enhanced_prompt = enhance_prompt(prompt)
+    enhanced_negative_prompt = enhance_negative_prompt(negative_prompt)
+
+    # Consecutive seeds for a seeded batch, like Auto1111
+    seeds = [seed + i if seed != -1 else -1 for i in range(batch_size)]
+    encoded, thumbnails, cached = render_txt2img(
+        [(enhanced_prompt, enhanced_negative_prompt, item_seed) for item_seed in seeds],
+        (width, height, steps, cfg_scale, sampler_name, selection, hires),
+        encode_options,
+        on_step,
+        live_preview,
+        cancel
+    )
+
+    result = {
+        "kind": "txt2img",
+        "project": data.get("project"),
+        "images": encoded,
+        "thumbnails": thumbnails,
+        "media_type": media_type(encode_options),
+        "seeds": seeds,
+        "parameters": {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "steps": steps,
+            "width": width,
+            "height": height,
+            "cfg_scale": cfg_scale,
+            "sampler_name": sampler_name,
+            "adapters": [{"name": name, "scale": scale} for name, scale in selection],
+            "seed": seed,
+            "batch_size": batch_size,
+            "preview": preview,
+            "hires": hires_parameters(hires)
+        },
+        "info": "Image served from result cache" if cached else "Image generated successfully with LORA weights"
+    }
+    save_outputs(result, data, image_format)
+    return result
+
+def generate_page(data, on_step=None, image_format=None, live_preview=None, cancel=None):
+    """Render every scene of a comic page, seeding panels by their main character"""
+    page = data.get("page", {})
+    scenes = page.get("scenes") or data.get("scenes", [])
+    negative_prompt = data.get("negative_prompt", "")
+    steps = data.get("steps", 20)
+    width = data.get("width", 512)
+    height = data.get("height", 512)
+    cfg_scale = data.get("cfg_scale", 7.5)
+    seed = data.get("seed", 0)  # Story seed; keep it fixed across pages for consistent characters
+    sampler_name = resolve_sampler(data.get("sampler_name", "Euler a"))
+    selection = adapter_selection(data)
+    preview = bool(data.get("preview", False))
+    encode_options = parse_encode_options(data, image_format)
+
+    if not scenes:
+        raise ValueError("No scenes provided")
+    if len(scenes) > MAX_PAGE_SCENES:
+        raise ValueError(f"At most {MAX_PAGE_SCENES} scenes per page")
+    if seed == -1:
+        seed = random.randint(0, 2 ** 31 - 1)
+    if preview:
+        sampler_name, steps, width, height = preview_settings(steps, width, height)
+    # Drafts skip the hires fix, they're about layout
+    hires = None if preview else hires_settings(data, width, height, steps, sampler_name)
+
+    # Panels sharing a main character get the same seed and so the same starting latents;
+    # all panels are submitted together, so they share batched pipeline calls (SD_MAX_BATCH_SIZE per call)
+    panels = plan_page(scenes, seed)
+    enhanced_negative_prompt = enhance_negative_prompt(negative_prompt)
+    prompts = [scene.get("imagePrompt") or scene.get("prompt", "") for scene in scenes]
+    entries = [
+        (enhance_prompt(prompt), enhanced_negative_prompt, panel["seed"])
+        for prompt, panel in zip(prompts, panels)
+    ]
+    encoded, thumbnails, cached = render_txt2img(
+        entries, (width, height, steps, cfg_scale, sampler_name, selection, hires), encode_options, on_step, live_preview, cancel
+    )
+
+    return {
+        "kind": "page",
+        "project": data.get("project"),
+        "images": encoded,
+        "thumbnails": thumbnails,
+        "media_type": media_type(encode_options),
+        "seeds": [panel["seed"] for panel in panels],
+        "panels": panels,
+        "prompts": prompts,
+        "parameters": {
+            "page_number": page.get("pageNumber"),
+            "negative_prompt": negative_prompt,
+            "steps": steps,
+            "width": width,
+            "height": height,
+            "cfg_scale": cfg_scale,
+            "sampler_name": sampler_name,
+            "adapters": [{"name": name, "scale": scale} for name, scale in selection],
+            "seed": seed,
+            "preview": preview,
+            "hires": hires_parameters(hires)
+        },
+        "info": "Page served from result cache" if cached else f"Generated {len(panels)} panels with LORA weights"
+    }
+
+def generate_img2img(data, on_step=None, image_format=None, live_preview=None, cancel=None):
+    """Run an img2img request and return the encoded image with its parameters"""
+    # Extract parameters
+    init_images = data.get("init_images", [])
+    prompt = data.get("prompt", "")
+    negative_prompt = data.get("negative_prompt", "")
+    steps = data.get("steps", 20)
+    denoising_strength = data.get("denoising_strength", 0.75)
+    width = data.get("width", 512)
+    height = data.get("height", 512)
+    cfg_scale = data.get("cfg_scale", 7.5)
+    seed = data.get("seed", -1)
+    sampler_name = resolve_sampler(data.get("sampler_name", "Euler a"))
+    selection = adapter_selection(data)
+
+    if not init_images:
+        raise ValueError("No init_images provided")
+    encode_options = parse_encode_options(data, image_format)
+
+    # Enhance the prompt with specific Japanese manga style instructions
+    enhanced_prompt = enhance_prompt(prompt)
+
+    # Enhanced negative prompt with manga-specific elements to avoid
+    enhanced_negative_prompt = enhance_negative_prompt(negative_prompt)
+
+    # Decode the first image
+    with stage_seconds.time(stage="parse"):
+        img_data = base64.b64decode(init_images[0])
+        init_image = Image.open(io.BytesIO(img_data)).convert("RGB")
+
+    # Resize image to match dimensions
+    init_image = init_image.resize((width, height))
+
+    generator = torch.Generator(device=pipe.device)
+    if seed != -1:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()
+
+    # Strength truncates the schedule: only the last steps * strength steps are run
+    denoising_steps = min(int(steps * denoising_strength), steps)
+    if denoising_steps < 1:
+        raise ValueError("steps * denoising_strength must be at least 1")
+
+    # Use img2img pipeline
+    with pipe_lock, torch.no_grad():
+        # The request may have been cancelled while it waited for the pipeline
+        if cancel is not None:
+            cancel.check()
+        configure_for_resolution(pipe, memory_profile, width, height)
+        img2img_pipe.scheduler = scheduler_registry.get(sampler_name)
+        with stage_seconds.time(stage="adapters"):
+            adapters.activate(pipe, selection)
+        with stage_seconds.time(stage="text_encode"):
+            prompt_embeds = embedding_cache.encode(pipe, [enhanced_prompt], variant=selection)
+            negative_prompt_embeds = embedding_cache.encode(pipe, [enhanced_negative_prompt], variant=selection)
+
+        # The VAE encode of the init image is part of this stage
+        with stage_seconds.time(stage="denoise"):
+            latents = img2img_pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                image=init_image,
+                num_inference_steps=steps,
+                guidance_scale=cfg_scale,
+                strength=denoising_strength,
                 generator=generator,
-                cross_attention_kwargs={"scale": 0.8}  # Apply LORA scaling if available
-            ).images[0]
+                callback_on_step_end=step_callback([{"on_step": on_step, "live_preview": live_preview, "cancel": cancel}], denoising_steps),
+                output_type="latent"
+            ).images
+        image = decode_latents(img2img_pipe, latents)[0]
+    images_total.inc(source="generated")
 
-        # Save the image
-        output_filename = f"{str(uuid.uuid4())}.png"
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-        image.save(output_path)
+    encoding = image_encoder.submit(image, encode_options).result()
 
-        # Convert to base64 for API response
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+    return {
+        "kind": "img2img",
+        "project": data.get("project"),
+        "images": [encoding["image"]],
+        "thumbnails": [encoding["thumbnails"]],
+        "media_type": media_type(encode_options),
+        "seeds": [seed],
+        "parameters": {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "steps": steps,
+            "denoising_strength": denoising_strength,
+            "width": width,
+            "height": height,
+            "cfg_scale": cfg_scale,
+            "sampler_name": sampler_name,
+            "adapters": [{"name": name, "scale": scale} for name, scale in selection],
+            "seed": seed
+        },
+        "info": "Image transformed successfully with LORA weights"
+    }
 
-        return jsonify({
-            "images": [img_str],
-            "parameters": {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "steps": steps,
-                "width": width,
-                "height": height,
-                "cfg_scale": cfg_scale,
-                "seed": seed
-            },
-            "info": "Image generated successfully with LORA weights"
-        })
+def parse_response_format(data):
+    """How a request wants its images in JSON bodies: "b64_json" (inline base64) or "url" (saved, /outputs URLs)"""
+    response_format = data.get("response_format", "b64_json")
+    if response_format not in ("b64_json", "url"):
+        raise ValueError(f"Unsupported response_format: {response_format}")
+    return response_format
+
+def json_body(result, response_format="b64_json"):
+    """
+    Build the Auto1111-style JSON body with base64 images, or for
+    ``response_format="url"`` with the ids and /outputs URLs of the saved images.
+    """
+    body = {
+        "parameters": result["parameters"],
+        "info": result["info"]
+    }
+    if response_format == "url":
+        image_ids, thumbnail_ids = write_outputs(result)
+        body["ids"] = image_ids
+        body["urls"] = [f"/outputs/{image_id}" for image_id in image_ids]
+        if any(result["thumbnails"]):
+            body["thumbnails"] = [
+                [{"size": size, "id": image_id, "url": f"/outputs/{image_id}"} for size, image_id in variants]
+                for variants in thumbnail_ids
+            ]
+    else:
+        body["images"] = [base64.b64encode(data).decode() for data in result["images"]]
+        if any(result["thumbnails"]):
+            body["thumbnails"] = [
+                [{"size": variant["size"], "image": base64.b64encode(variant["data"]).decode()} for variant in variants]
+                for variants in result["thumbnails"]
+            ]
+    if result["media_type"] != "image/png":
+        body["media_type"] = result["media_type"]
+    if "panels" in result:
+        body["panels"] = result["panels"]
+    return body
+
+def binary_format():
+    """Return the image format the client asked to receive as raw bytes, or None for JSON"""
+    requested = request.args.get("format")
+    if requested:
+        return requested
+
+    best = request.accept_mimetypes.best_match(["application/json"] + [f"image/{fmt}" for fmt in FORMATS])
+    if best and best.startswith("image/"):
+        return best.split("/", 1)[1]
+    return None
+
+def iter_chunks(data, chunk_size=64 * 1024):
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size].tobytes()
+
+def binary_response(result):
+    """Stream one image as raw bytes, or several images/variants as a multipart/mixed body"""
+    parts = []
+    for index, (data, seed) in enumerate(zip(result["images"], result["seeds"])):
+        parts.append((data, seed, index, "full"))
+        for variant in result["thumbnails"][index]:
+            parts.append((variant["data"], seed, index, f"thumbnail-{variant['size']}"))
+
+    if len(parts) == 1:
+        data = parts[0][0]
+        response = Response(iter_chunks(data), mimetype=result["media_type"])
+        response.headers["Content-Length"] = str(len(data))
+        response.headers["X-Seed"] = str(result["seeds"][0])
+        return response
+
+    boundary = uuid.uuid4().hex
+
+    def generate_parts():
+        for data, seed, index, variant in parts:
+            yield (
+                f"--{boundary}\r\n"
+                f"Content-Type: {result['media_type']}\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"X-Seed: {seed}\r\n"
+                f"X-Image-Index: {index}\r\n"
+                f"X-Variant: {variant}\r\n\r\n"
+            ).encode()
+            yield from iter_chunks(data)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return Response(generate_parts(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+def parse_json():
+    """The request's JSON body, timed as the parse stage"""
+    with stage_seconds.time(stage="parse"):
+        return request.get_json()
+
+def serialize(result, image_format, response_format="b64_json"):
+    """Build the JSON or binary response for a generation result, timed as the serialize stage"""
+    with stage_seconds.time(stage="serialize"):
+        if image_format is not None:
+            return binary_response(result)
+        return jsonify(json_body(result, response_format))
+
+def request_token():
+    """
+    CancelToken for the current request. It expires after X-Request-Timeout
+    seconds or SD_REQUEST_TIMEOUT, whichever is shorter.
+    """
+    header = request.headers.get("X-Request-Timeout")
+    try:
+        timeouts = [timeout for timeout in (float(header or 0), REQUEST_TIMEOUT) if timeout > 0]
+    except ValueError:
+        raise ValueError(f"Invalid X-Request-Timeout: {header}")
+    return CancelToken(min(timeouts) if timeouts else None)
+
+def record_cancellation(kind, reason):
+    cancellations_total.inc(reason=reason)
+    logger.info(f"Cancelled {kind} generation: {reason} ({cancellations_total.value(reason=reason)} {reason} cancellations so far)")
 
+def run_cancellable(kind, handler, data, image_format):
+    """
+    Run a generation for the current request, stopping it at the next step
+    if the client disconnects or the request's deadline passes.
+    """
+    token = request_token()
+    # Only the development server exposes the client socket; elsewhere just the deadline applies
+    client_socket = request.environ.get("werkzeug.socket")
+    if client_socket is not None:
+        disconnect_watcher.watch(client_socket, token)
+    try:
+        return handler(data, image_format=image_format, cancel=token)
+    except GenerationCancelled as e:
+        # Requests sharing a batch share its exception; report this request's own reason
+        reason = token.reason or e.reason
+        record_cancellation(kind, reason)
+        raise GenerationCancelled(reason)
+    finally:
+        disconnect_watcher.unwatch(token)
+
+def cancelled_response(e):
+    """504 for requests past their deadline; 499 (client closed request) when nobody is listening anyway"""
+    return jsonify({"error": f"Generation cancelled: {e.reason}", "reason": e.reason}), 504 if e.reason == DEADLINE else 499
+
+# Generation handlers available to the job queue, keyed by job type
+JOB_HANDLERS = {
+    "txt2img": generate_txt2img,
+    "img2img": generate_img2img,
+    "page": generate_page
+}
+
+def queue_full(e):
+    """429 response for a rejected job"""
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+    return response, 429
+
+def wants_event_stream():
+    """True if the client asked for Server-Sent Events instead of a single response"""
+    if request.args.get("stream") == "1":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", "text/event-stream"]) == "text/event-stream"
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def event_stream(kind, data):
+    """
+    Run a generation as a job and stream it as Server-Sent Events.
+
+    Events: ``job`` (its id), ``progress`` after every step, ``preview``
+    every ``preview_every`` steps (SD_LIVE_PREVIEW_EVERY by default, base64
+    JPEG), then one of ``result`` (the usual JSON body), ``cancelled`` or
+    ``error``. Closing the connection cancels the generation at its next step.
+    """
+    handler = JOB_HANDLERS[kind]
+    response_format = parse_response_format(data)
+    events = queue.Queue()
+    live_preview = LivePreview(
+        int(data.get("preview_every", LIVE_PREVIEW_EVERY)),
+        lambda step, total_steps, index, image: events.put(
+            ("preview", {"step": step, "total_steps": total_steps, "index": index, "image": image})
+        )
+    )
+
+    def run(job):
+        def on_step(step, total_steps):
+            job.update_progress(step, total_steps)
+            events.put(("progress", {"step": step, "total_steps": total_steps}))
+
+        try:
+            body = json_body(handler(job.payload, on_step=on_step, live_preview=live_preview, cancel=job.cancel_token), response_format)
+        except GenerationCancelled as e:
+            events.put(("cancelled", {"reason": job.cancel_token.reason or e.reason}))
+            raise
+        except Exception as e:
+            events.put(("error", {"error": str(e)}))
+            raise
+        events.put(("result", body))
+        return body
+
+    try:
+        job = job_queue.submit(kind, data, run, request_token())
+    except QueueFullError as e:
+        return queue_full(e)
+    logger.info(f"Streaming {kind} job {job.id}")
+
+    def generate():
+        finished = False
+        try:
+            yield sse_event("job", {"job_id": job.id, "url": f"/sdapi/v1/jobs/{job.id}"})
+            while not finished:
+                try:
+                    event, payload = events.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # Writing is the only way to notice a client that went away
+                    yield ": keep-alive\n\n"
+                    continue
+                if event == "preview":
+                    payload["image"] = encode_preview(payload["image"])
+                finished = event in ("result", "cancelled", "error")
+                yield sse_event(event, payload)
+        finally:
+            # Runs when the server fails to write to a disconnected client
+            if not finished and job.cancel_token.cancel(DISCONNECTED):
+                logger.info(f"Client disconnected from job {job.id}, cancelling it")
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/sdapi/v1/txt2img", methods=["POST"])
+def txt2img():
+    """Generate image from text prompt"""
+    unavailable = model_unavailable()
+    if unavailable is not None:
+        return unavailable
+
+    try:
+        data = parse_json()
+        if wants_event_stream():
+            return event_stream("txt2img", data)
+        image_format = binary_format()
+        response_format = parse_response_format(data)
+        return serialize(run_cancellable("txt2img", generate_txt2img, data, image_format), image_format, response_format)
+
+    except GenerationCancelled as e:
+        return cancelled_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error in txt2img: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -142,119 +1195,315 @@ def txt2img():
 @app.route("/sdapi/v1/img2img", methods=["POST"])
 def img2img():
     """Generate image from image and text prompt"""
-    global pipe
-
-    if pipe is None:
-        return jsonify({"error": "Model not loaded"}), 500
+    unavailable = model_unavailable()
+    if unavailable is not None:
+        return unavailable
 
     try:
-        data = request.get_json()
-
-        # Extract parameters
-        init_images = data.get("init_images", [])
-        prompt = data.get("prompt", "")
-        negative_prompt = data.get("negative_prompt", "")
-        steps = data.get("steps", 20)
-        denoising_strength = data.get("denoising_strength", 0.75)
-        width = data.get("width", 512)
-        height = data.get("height", 512)
-        cfg_scale = data.get("cfg_scale", 7.5)
+        data = parse_json()
+        if wants_event_stream():
+            return event_stream("img2img", data)
+        image_format = binary_format()
+        response_format = parse_response_format(data)
+        return serialize(run_cancellable("img2img", generate_img2img, data, image_format), image_format, response_format)
 
-        if not init_images:
-            return jsonify({"error": "No init_images provided"}), 400
+    except GenerationCancelled as e:
+        return cancelled_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in img2img: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        # Enhance the prompt with specific Japanese manga style instructions
-        enhanced_prompt = f"Japanese manga style, {prompt}, highly detailed, black and white style, sharp lines, manga art style, professional quality, clean lines, detailed character design"
+@app.route("/sdapi/v1/page", methods=["POST"])
+def page():
+    """Generate all panels of a comic page with character-consistent seeds"""
+    unavailable = model_unavailable()
+    if unavailable is not None:
+        return unavailable
 
-        # Enhanced negative prompt with manga-specific elements to avoid
-        enhanced_negative_prompt = f"{negative_prompt}, color image, western cartoon style, low detail, blurry, deformed, ugly, anime screencap, digital art that looks like a screenshot"
+    try:
+        data = parse_json()
+        if wants_event_stream():
+            return event_stream("page", data)
+        image_format = binary_format()
+        response_format = parse_response_format(data)
+        return serialize(run_cancellable("page", generate_page, data, image_format), image_format, response_format)
 
-        # Decode the first image
-        img_data = base64.b64decode(init_images[0])
-        init_image = Image.open(io.BytesIO(img_data)).convert("RGB")
+    except GenerationCancelled as e:
+        return cancelled_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in page: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        # Resize image to match dimensions
-        init_image = init_image.resize((width, height))
+@app.route("/sdapi/v1/jobs", methods=["POST"])
+def create_job():
+    """Queue a txt2img/img2img generation and return its job id immediately"""
+    unavailable = model_unavailable()
+    if unavailable is not None:
+        return unavailable
 
-        # Use img2img pipeline
-        with torch.no_grad():
-            image = pipe(
-                prompt=enhanced_prompt,
-                negative_prompt=enhanced_negative_prompt,
-                image=init_image,
-                num_inference_steps=int(steps / denoising_strength),  # Adjust steps based on denoising strength
-                guidance_scale=cfg_scale,
-                strength=denoising_strength,
-                generator=torch.Generator(device=pipe.device).manual_seed(42),  # Fixed seed for consistency
-                cross_attention_kwargs={"scale": 0.8}  # Apply LORA scaling if available
-            ).images[0]
+    try:
+        data = parse_json()
+        kind = data.get("type", "txt2img")
+        handler = JOB_HANDLERS.get(kind)
+        if handler is None:
+            return jsonify({"error": f"Unknown job type: {kind}"}), 400
 
-        # Convert to base64 for API response
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        response_format = parse_response_format(data)
+        job = job_queue.submit(
+            kind,
+            data,
+            lambda job: json_body(handler(job.payload, on_step=job.update_progress, cancel=job.cancel_token), response_format),
+            request_token()
+        )
+        logger.info(f"Queued {kind} job {job.id}")
 
-        return jsonify({
-            "images": [img_str],
-            "parameters": {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "steps": steps,
-                "denoising_strength": denoising_strength,
-                "width": width,
-                "height": height,
-                "cfg_scale": cfg_scale
-            },
-            "info": "Image transformed successfully with LORA weights"
+        response = jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "url": f"/sdapi/v1/jobs/{job.id}"
         })
+        return response, 202
 
+    except QueueFullError as e:
+        return queue_full(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error in img2img: {str(e)}")
+        logger.error(f"Error in create_job: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/sdapi/v1/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Report job status, current denoising step and, once done, the result"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/sdapi/v1/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    """Cancel a queued or running job; it stops at its next denoising step"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(job.to_dict(include_result=False)), 202
+
+@app.route("/outputs", methods=["GET"])
+def list_outputs():
+    """
+    Query saved outputs, newest first. Filters: project, kind (txt2img,
+    img2img, page or thumbnail), prompt (substring), since/until (unix
+    times), plus limit and offset for paging.
+    """
+    try:
+        args = request.args
+        records = output_store.query(
+            project=args.get("project"),
+            kind=args.get("kind"),
+            prompt=args.get("prompt"),
+            since=float(args["since"]) if "since" in args else None,
+            until=float(args["until"]) if "until" in args else None,
+            limit=min(int(args.get("limit", 50)), 500),
+            offset=int(args.get("offset", 0))
+        )
+        for record in records:
+            record["url"] = f"/outputs/{record['id']}"
+        return jsonify({"outputs": records, "count": len(records)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in list_outputs: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/outputs/<image_id>/meta", methods=["GET"])
+def get_output_meta(image_id):
+    """Index entry of a saved image: parameters, project, size and created/last-access times"""
+    record = output_store.record(image_id)
+    if record is None:
+        return jsonify({"error": f"Unknown output: {image_id}"}), 404
+    record["url"] = f"/outputs/{image_id}"
+    return jsonify(record)
+
+@app.route("/outputs/<image_id>", methods=["GET"])
+def get_output(image_id):
+    """
+    Serve a saved image by id. Ids are content hashes, so the id is a strong
+    ETag and the response can be cached for good; conditional and Range
+    requests are answered with 304 and 206.
+    """
+    path, media = output_store.get(image_id)
+    if path is None:
+        return jsonify({"error": f"Unknown output: {image_id}"}), 404
+    response = send_file(path, mimetype=media, conditional=True, etag=image_id, max_age=OUTPUT_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={OUTPUT_MAX_AGE}, immutable"
+    # The export step draws these onto a canvas, which needs a CORS-enabled image
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
+
+@app.route("/sdapi/v1/options", methods=["GET"])
+def get_options():
+    """Current default adapter selection"""
+    return jsonify({
+        "sd_model_checkpoint": default_adapters[0][0] if default_adapters else BASE_MODEL_ID,
+        "adapters": [{"name": name, "scale": scale} for name, scale in default_adapters],
+        "loaded_adapters": adapters.stats()["loaded"]
+    })
+
 @app.route("/sdapi/v1/options", methods=["POST"])
 def set_options():
-    """Set Stable Diffusion options (stub implementation)"""
+    """
+    Set the default adapters and preload adapters into the pipeline.
+
+    ``sd_model_checkpoint`` (an adapter name, or the base model id for no
+    adapter) or ``adapters`` set the default for requests that don't pick
+    their own; ``preload_adapters`` only loads them ahead of use.
+    """
+    global default_adapters
+
+    unavailable = model_unavailable()
+    if unavailable is not None:
+        return unavailable
+
     try:
         data = request.get_json()
         logger.info(f"Setting options: {data}")
-        return jsonify({"status": "options set"})
+
+        selection = None
+        if "adapters" in data:
+            selection = adapter_selection(data)
+        elif "sd_model_checkpoint" in data:
+            checkpoint = data["sd_model_checkpoint"]
+            scale = data.get("lora_scale", LORA_SCALE)
+            selection = adapters.selection([] if checkpoint == BASE_MODEL_ID else [(checkpoint, scale)])
+
+        preload = list(data.get("preload_adapters", []))
+        if selection is not None:
+            preload += [name for name, _ in selection]
+        with pipe_lock:
+            loaded = adapters.preload(pipe, preload)
+
+        if selection is not None:
+            default_adapters = selection
+        return jsonify({
+            "status": "options set",
+            "adapters": [{"name": name, "scale": scale} for name, scale in default_adapters],
+            "preloaded": loaded
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error in set_options: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/sdapi/v1/samplers", methods=["GET"])
+def get_samplers():
+    """List the samplers accepted in sampler_name"""
+    return jsonify(list_samplers())
+
 @app.route("/sdapi/v1/sd-models", methods=["GET"])
 def get_models():
-    """Get available models (stub implementation)"""
+    """List the LORA adapters in SD_LORA_PATH; select one with "adapter" or sd_model_checkpoint"""
     try:
-        return jsonify([{
-            "title": "Comic Style Model (with LORA)", 
-            "model_name": "comic-style-lora", 
-            "hash": "lora-enhanced"
-        }])
+        models = []
+        for entry in adapters.scan():
+            sha256 = adapters.sha256(entry["name"])
+            models.append({
+                "title": entry["name"],
+                "model_name": entry["name"],
+                "hash": sha256[:10],
+                "sha256": sha256,
+                "filename": os.path.join(entry["directory"], entry["weight_name"]),
+                "config": None,
+                "loaded": adapters.is_loaded(entry["name"]) or (adapters.fused is not None and adapters.fused[0] == entry["name"])
+            })
+        return jsonify(models)
     except Exception as e:
         logger.error(f"Error in get_models: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness endpoint: 200 once the model can serve generations, 503 while loading"""
+    status = readiness()
+    if status["ready"]:
+        return jsonify(status)
+    response = jsonify(status)
+    if status["phase"] != "failed":
+        response.headers["Retry-After"] = str(LOADING_RETRY_AFTER)
+    return response, 503
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Count requests and time them (streamed bodies are not included)"""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        request_seconds.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@app.after_request
+def compress_body(response):
+    """gzip/brotli JSON and text bodies for clients that accept it"""
+    return compress_response(
+        response,
+        request.accept_encodings,
+        on_compressed=lambda encoding, seconds: stage_seconds.observe(seconds, stage="compress")
+    )
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus metrics: request counts, queue depth, per-stage latency, load time and memory"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
-    # Check if LORA weights are loaded by checking if the adapter is active
-    lora_loaded = False
-    if hasattr(pipe, 'lora_manager') and pipe.lora_manager:
-        lora_loaded = True
-    elif hasattr(pipe, 'loaded_lora'):
-        lora_loaded = pipe.loaded_lora is not None
+    # LORA weights are loaded if an adapter is resident or fused into the snapshot
+    adapter_stats = adapters.stats()
+    lora_loaded = bool(adapter_stats["loaded"] or adapter_stats["fused"])
 
-    return jsonify({
-        "status": "ok", 
+    status = readiness()
+    body = {
+        "status": "error" if status["phase"] == "failed" else "ok",
         "model_loaded": pipe is not None,
-        "lora_loaded": lora_loaded
-    })
+        "ready": status["ready"],
+        "phase": status["phase"],
+        "elapsed_seconds": status["elapsed_seconds"],
+        "memory": status["memory"],
+        "lora_loaded": lora_loaded,
+        "adapters": adapter_stats,
+        "load": load_info,
+        "memory_profile": memory_profile,
+        "jobs": job_queue.stats(),
+        "result_cache": result_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "outputs": output_store.stats(),
+        "llm": llm_gateway.stats()
+    }
+    if status["error"]:
+        body["error"] = status["error"]
+    # Loading is healthy; only a failed load reports an error status
+    return jsonify(body), 500 if status["phase"] == "failed" else 200
 
 if __name__ == "__main__":
-    # Load the model when starting the service
-    load_model()
+    # Load the model in the background; the server binds right away and
+    # answers 503 on generation routes until the model is ready
+    apply_cpu_settings()
+    start_model_loading()
+    # Images and cache files saved flat in OUTPUT_DIR by earlier versions move into the store before the first GC pass
+    output_store.start_gc(OUTPUT_GC_INTERVAL, import_from=OUTPUT_DIR, import_caches={
+        "results": os.path.join(OUTPUT_DIR, "cache"),
+        "llm": os.path.join(OUTPUT_DIR, "llm_cache")
+    })
 
     # Get port from environment variable or default to 5000
     port = int(os.getenv("SD_API_PORT", 5000))
@@ -0,0 +1,111 @@
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """Collect compatible generation requests and run them as one pipeline call.
+
+    Requests are grouped by a batch key (e.g. width, height, steps, cfg_scale).
+    The oldest pending request opens a window of ``window`` seconds; every
+    request with the same key that arrives before the window closes (up to
+    ``max_batch_size``) is handed to ``run_batch`` together. ``run_batch``
+    receives ``(key, items)`` and must return one result per item, in order;
+    an exception instance in place of a result fails only that item.
+    """
+
+    def __init__(self, run_batch, window=0.05, max_batch_size=4):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max(1, max_batch_size)
+        self._pending = []  # list of (key, item, future, enqueued_at)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, item):
+        """Queue one item and return a Future resolving to its result"""
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Batch scheduler is stopped")
+            self._pending.append((key, item, future, time.monotonic()))
+            self._cond.notify_all()
+        return future
+
+    def pending_count(self):
+        """Number of items waiting for a batch slot"""
+        with self._cond:
+            return len(self._pending)
+
+    def stop(self):
+        """Stop the scheduler thread and fail anything still queued"""
+        with self._cond:
+            self._stopped = True
+            pending, self._pending = self._pending, []
+            self._cond.notify_all()
+        for _, _, future, _ in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("Batch scheduler is stopped"))
+        self._thread.join(timeout=5)
+
+    def _count_for(self, key):
+        return sum(1 for entry in self._pending if entry[0] == key)
+
+    def _next_batch(self):
+        """Block until a batch is ready and remove it from the pending list"""
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return None, []
+
+            key, _, _, enqueued_at = self._pending[0]
+            deadline = enqueued_at + self.window
+            while not self._stopped and self._count_for(key) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, rest = [], []
+            for entry in self._pending:
+                if entry[0] == key and len(batch) < self.max_batch_size:
+                    batch.append(entry)
+                else:
+                    rest.append(entry)
+            self._pending = rest
+            return key, batch
+
+    def _loop(self):
+        while True:
+            key, batch = self._next_batch()
+            if key is None and not batch:
+                if self._stopped:
+                    return
+                continue
+
+            # Drop items whose callers already gave up
+            batch = [entry for entry in batch if entry[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            items = [entry[1] for entry in batch]
+            futures = [entry[2] for entry in batch]
+            logger.info(f"Running batch of {len(items)} for key {key}")
+            try:
+                results = self.run_batch(key, items)
+                for future, result in zip(futures, results):
+                    # An exception in place of a result fails only that item
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            except Exception as e:
+                logger.error(f"Error running batch {key}: {str(e)}")
+                for future in futures:
+                    future.set_exception(e)
@@ -0,0 +1,541 @@
+import argparse
+import base64
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+PROMPTS = [
+    "a detective standing in the rain",
+    "two friends talking on a rooftop at night",
+    "a cat jumping over a fence",
+    "a crowded train station at dawn"
+]
+READY_TIMEOUT = 600  # Seconds to wait for the server to load the model
+REQUEST_TIMEOUT = 600
+
+
+def byte_characters():
+    """The 256 printable characters CLIP's byte-level BPE maps bytes to"""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    codes = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            codes.append(256 + extra)
+            extra += 1
+    return [chr(code) for code in codes]
+
+
+def build_tiny_pipeline(path, seed=0):
+    """
+    Save a tiny randomly initialised Stable Diffusion pipeline to ``path``.
+
+    The components have the SD 1.x architecture at a fraction of the width,
+    so app.py loads and runs it like the real model, on CPU and without any
+    download. The same ``seed`` always gives the same weights.
+    """
+    import torch
+    from diffusers import AutoencoderKL, EulerAncestralDiscreteScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    os.makedirs(path, exist_ok=True)
+
+    # Byte-level vocabulary without merges: every character is a token
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for char in byte_characters():
+        for token in (char, char + "</w>"):
+            vocab.setdefault(token, len(vocab))
+    vocab_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(vocab_dir, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(vocab_dir, "merges.txt"), "w") as f:
+            f.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(os.path.join(vocab_dir, "vocab.json"), os.path.join(vocab_dir, "merges.txt"), model_max_length=77)
+    finally:
+        shutil.rmtree(vocab_dir, ignore_errors=True)
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        layer_norm_eps=1e-05,
+        vocab_size=len(vocab),
+        max_position_embeddings=77
+    ))
+    scheduler = EulerAncestralDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        num_train_timesteps=1000,
+        steps_offset=1
+    )
+    pipe = StableDiffusionPipeline(
+        unet=unet,
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    pipe.save_pretrained(path)
+    return path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize(values):
+    """min/mean/p50/p95/max of a list of numbers, rounded for the report"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(fraction):
+        # Nearest rank, so small samples report an observed value
+        return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+    return {
+        "n": len(ordered),
+        "min": round(ordered[0], 4),
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": round(percentile(0.5), 4),
+        "p95": round(percentile(0.95), 4),
+        "max": round(ordered[-1], 4)
+    }
+
+
+def read_rss_mb(pid):
+    """Current resident set size of a process in MB (Linux only, None elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakMemory:
+    """Sample a process's RSS in the background and keep the peak while active"""
+
+    def __init__(self, pid, interval=0.01):
+        self.pid = pid
+        self.interval = interval
+        self.peak_mb = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak_mb = read_rss_mb(self.pid)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        if self.peak_mb is not None:
+            self.peak_mb = round(self.peak_mb, 1)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            rss = read_rss_mb(self.pid)
+            if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+                self.peak_mb = rss
+
+
+class Server:
+    """An app.py process on a free local port, configured for benchmarking"""
+
+    def __init__(self, model, work_dir, extra_env=None):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ)
+        self.env.update({
+            "SD_API_HOST": "127.0.0.1",
+            "SD_API_PORT": str(self.port),
+            "SD_BASE_MODEL_ID": model,
+            # No LORA or snapshot unless the caller passes them in extra_env
+            "SD_LORA_PATH": os.path.join(work_dir, "no-lora"),
+            "SD_SNAPSHOT_DIR": os.path.join(work_dir, "no-snapshot"),
+            "SD_CACHE_DIR": os.path.join(work_dir, "cache"),
+            # Fresh outputs per process, so no run is answered from an earlier run's result cache
+            "SD_OUTPUT_DIR": os.path.join(work_dir, f"outputs-{self.port}"),
+            "HF_HUB_OFFLINE": "1",
+            "TQDM_DISABLE": "1"
+        })
+        self.env.update(extra_env or {})
+        self.log_path = os.path.join(work_dir, f"server-{self.port}.log")
+        self.process = None
+        self.session = requests.Session()
+
+    def start(self):
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, APP_PATH],
+            env=self.env,
+            cwd=os.path.dirname(APP_PATH),
+            stdout=self._log,
+            stderr=subprocess.STDOUT
+        )
+        return self
+
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        """Poll /ready until the model is loaded and warmed up, returning the readiness body"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.process.returncode}, see {self.log_path}")
+            try:
+                response = self.session.get(f"{self.url}/ready", timeout=5)
+                if response.status_code == 200:
+                    return response.json()
+                if response.json().get("phase") == "failed":
+                    raise RuntimeError(f"Model failed to load: {response.json().get('error')}")
+            except requests.ConnectionError:
+                pass  # Not bound yet
+            time.sleep(0.05)
+        raise TimeoutError(f"Server not ready after {timeout}s, see {self.log_path}")
+
+    def post(self, path, body, session=None):
+        """POST JSON and return (seconds, response)"""
+        started = time.perf_counter()
+        response = (session or self.session).post(f"{self.url}{path}", json=body, timeout=REQUEST_TIMEOUT)
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}: {response.text[:200]}")
+        return elapsed, response
+
+    def health(self):
+        return self.session.get(f"{self.url}/health", timeout=10).json()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._log.close()
+        shutil.rmtree(self.env["SD_OUTPUT_DIR"], ignore_errors=True)
+
+
+class RequestFactory:
+    """Request bodies with distinct seeds, so the result cache never answers them"""
+
+    def __init__(self, base_seed=1000):
+        self._seed = base_seed
+        self._lock = threading.Lock()
+
+    def txt2img(self, width, height, steps, batch_size=1):
+        with self._lock:
+            seed = self._seed
+            self._seed += batch_size
+        return {
+            "prompt": PROMPTS[seed % len(PROMPTS)],
+            "negative_prompt": "blurry",
+            "width": width,
+            "height": height,
+            "steps": steps,
+            "batch_size": batch_size,
+            "seed": seed
+        }
+
+    def img2img(self, width, height, steps, init_image):
+        body = self.txt2img(width, height, steps)
+        body.update(init_images=[init_image], denoising_strength=0.6)
+        return body
+
+
+def init_image(width, height):
+    """A flat grey PNG as a base64 init image"""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (128, 128, 128)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def bench_cold_start(model, work_dir, extra_env):
+    """Time one server process from launch to ready and its first generation"""
+    server = Server(model, work_dir, extra_env)
+    started = time.perf_counter()
+    server.start()
+    try:
+        with PeakMemory(server.process.pid) as peak:
+            server.wait_ready()
+            ready_seconds = time.perf_counter() - started
+            first_seconds, _ = server.post("/sdapi/v1/txt2img", RequestFactory().txt2img(64, 64, 2))
+        health = server.health()
+        return {
+            "ready_seconds": round(ready_seconds, 4),
+            "model_load_seconds": health.get("load", {}).get("seconds"),
+            "first_request_seconds": round(first_seconds, 4),
+            "peak_rss_mb": peak.peak_mb
+        }
+    finally:
+        server.stop()
+
+
+def bench_latency(server, factory, endpoint, width, height, steps, batch_size, repeats):
+    """Sequential requests for one shape: latency, payload size and peak memory"""
+    if endpoint == "img2img":
+        image = init_image(width, height)
+        make_body = lambda: factory.img2img(width, height, steps, image)
+    else:
+        make_body = lambda: factory.txt2img(width, height, steps, batch_size)
+
+    server.post(f"/sdapi/v1/{endpoint}", make_body())  # Untimed, first use of this shape
+    latencies, payloads = [], []
+    with PeakMemory(server.process.pid) as peak:
+        for _ in range(repeats):
+            elapsed, response = server.post(f"/sdapi/v1/{endpoint}", make_body())
+            latencies.append(elapsed)
+            payloads.append(len(response.content))
+
+    return {
+        "name": f"{endpoint}_{width}x{height}_s{steps}_b{batch_size}",
+        "endpoint": endpoint,
+        "width": width,
+        "height": height,
+        "steps": steps,
+        "batch_size": batch_size,
+        "seconds": summarize(latencies),
+        "payload_bytes": round(sum(payloads) / len(payloads)),
+        "peak_rss_mb": peak.peak_mb
+    }
+
+
+def bench_throughput(server, factory, width, height, steps, concurrency, requests_per_client):
+    """Concurrent txt2img clients (exercising the batcher): requests and images per second"""
+    total = concurrency * requests_per_client
+
+    def client(_):
+        session = requests.Session()
+        latencies = []
+        for _ in range(requests_per_client):
+            elapsed, _ = server.post("/sdapi/v1/txt2img", factory.txt2img(width, height, steps), session)
+            latencies.append(elapsed)
+        return latencies
+
+    with PeakMemory(server.process.pid) as peak:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = [latency for result in pool.map(client, range(concurrency)) for latency in result]
+        wall = time.perf_counter() - started
+
+    return {
+        "name": f"txt2img_{width}x{height}_s{steps}_c{concurrency}",
+        "width": width,
+        "height": height,
+        "steps": steps,
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_seconds": round(wall, 4),
+        "requests_per_second": round(total / wall, 4),
+        "seconds": summarize(latencies),
+        "peak_rss_mb": peak.peak_mb
+    }
+
+
+def environment_info(args):
+    info = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model": args.model or "tiny",
+        "server_env": dict(args.env)
+    }
+    try:
+        info["git_commit"] = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(APP_PATH),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info["git_commit"] = None
+    for package in ("torch", "diffusers", "transformers"):
+        try:
+            info[package] = __import__(package).__version__
+        except ImportError:
+            info[package] = None
+    return info
+
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="sd-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    model = args.model
+    if not model:
+        model = os.path.join(work_dir, "tiny-sd")
+        if not os.path.exists(os.path.join(model, "model_index.json")):
+            print(f"Building tiny pipeline in {model}")
+            build_tiny_pipeline(model)
+    extra_env = dict(args.env)
+
+    results = {"environment": environment_info(args), "config": {
+        "resolutions": args.resolutions,
+        "steps": args.steps,
+        "batch_sizes": args.batch_sizes,
+        "concurrency": args.concurrency,
+        "repeats": args.repeats,
+        "endpoints": args.endpoints
+    }}
+
+    try:
+        print(f"Cold start x{args.cold_starts}")
+        runs = [bench_cold_start(model, work_dir, extra_env) for _ in range(args.cold_starts)]
+        results["cold_start"] = {
+            "runs": runs,
+            "ready_seconds": summarize([r["ready_seconds"] for r in runs]),
+            "first_request_seconds": summarize([r["first_request_seconds"] for r in runs])
+        }
+
+        server = Server(model, work_dir, extra_env).start()
+        factory = RequestFactory()
+        try:
+            server.wait_ready()
+            results["latency"] = []
+            for endpoint in args.endpoints:
+                for size in args.resolutions:
+                    for steps in args.steps:
+                        # img2img takes a single init image, so only txt2img varies the batch size
+                        for batch_size in (args.batch_sizes if endpoint == "txt2img" else [1]):
+                            result = bench_latency(server, factory, endpoint, size, size, steps, batch_size, args.repeats)
+                            print(f"{result['name']}: p50 {result['seconds']['p50']}s, "
+                                  f"{result['payload_bytes']} bytes, peak {result['peak_rss_mb']}MB")
+                            results["latency"].append(result)
+
+            results["throughput"] = []
+            for concurrency in args.concurrency:
+                result = bench_throughput(server, factory, args.resolutions[0], args.resolutions[0], args.steps[0],
+                                          concurrency, args.repeats)
+                print(f"{result['name']}: {result['requests_per_second']} req/s, p95 {result['seconds']['p95']}s")
+                results["throughput"].append(result)
+            results["server_health"] = server.health()
+        finally:
+            server.stop()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def scenario_metrics(results):
+    """Flatten results into {metric name: value} for comparing runs"""
+    flat = {}
+    cold = results.get("cold_start") or {}
+    for key in ("ready_seconds", "first_request_seconds"):
+        if cold.get(key):
+            flat[f"cold_start.{key}.p50"] = cold[key]["p50"]
+    for result in results.get("latency", []):
+        flat[f"{result['name']}.p50"] = result["seconds"]["p50"]
+        flat[f"{result['name']}.p95"] = result["seconds"]["p95"]
+        flat[f"{result['name']}.payload_bytes"] = result["payload_bytes"]
+        flat[f"{result['name']}.peak_rss_mb"] = result["peak_rss_mb"]
+    for result in results.get("throughput", []):
+        flat[f"{result['name']}.requests_per_second"] = result["requests_per_second"]
+        flat[f"{result['name']}.p95"] = result["seconds"]["p95"]
+        flat[f"{result['name']}.peak_rss_mb"] = result["peak_rss_mb"]
+    return flat
+
+
+def compare(baseline, current):
+    """Print every metric present in both runs with its relative change"""
+    before, after = scenario_metrics(baseline), scenario_metrics(current)
+    print(f"\nCompared with {baseline.get('environment', {}).get('git_commit')} "
+          f"({baseline.get('environment', {}).get('timestamp')}):")
+    print(f"{'metric':<48} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name], after[name]
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name:<48} {old:>12} {new:>12} {change:>9}")
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_env(value):
+    key, sep, val = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Expected KEY=VALUE, got {value}")
+    return key, val
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the generation server against a tiny CPU-only pipeline")
+    parser.add_argument("--output", type=str, default="benchmark.json", help="Where to write the JSON results (default: benchmark.json)")
+    parser.add_argument("--compare", type=str, help="Earlier results file to compare this run against")
+    parser.add_argument("--model", type=str, help="Model id or path to benchmark instead of the tiny stand-in pipeline")
+    parser.add_argument("--resolutions", type=parse_ints, default=[64, 128], help="Square sizes, comma separated (default: 64,128)")
+    parser.add_argument("--steps", type=parse_ints, default=[4, 8], help="Step counts, comma separated (default: 4,8)")
+    parser.add_argument("--batch_sizes", type=parse_ints, default=[1, 2], help="txt2img batch sizes, comma separated (default: 1,2)")
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4], help="Concurrent clients for the throughput runs (default: 1,4)")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed requests per scenario and per throughput client (default: 5)")
+    parser.add_argument("--cold_starts", type=int, default=1, help="Server launches timed from start to ready (default: 1)")
+    parser.add_argument("--endpoints", type=lambda v: v.split(","), default=["txt2img", "img2img"], help="Endpoints to time (default: txt2img,img2img)")
+    parser.add_argument("--env", type=parse_env, action="append", default=[], help="Extra server setting, e.g. --env SD_MEMORY_PROFILE=low (repeatable)")
+    parser.add_argument("--work_dir", type=str, help="Keep the tiny pipeline, outputs and server logs here instead of a temporary directory")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
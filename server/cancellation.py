@@ -0,0 +1,100 @@
+import select
+import socket
+import threading
+import time
+
+# Why a generation was cancelled
+DISCONNECTED = "disconnected"  # The client closed the connection
+DEADLINE = "deadline"  # The request's deadline passed
+REQUESTED = "requested"  # Cancelled through the API
+
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is abandoned before it finished"""
+
+    def __init__(self, reason=REQUESTED):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Shared flag a request's owner sets to stop its generation at the next denoising step.
+
+    With ``timeout`` (seconds) the token also cancels itself once that much
+    time has passed, so work for requests the client gave up on stops.
+    """
+
+    def __init__(self, timeout=None):
+        self.reason = None
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self._event = threading.Event()
+
+    def cancel(self, reason=REQUESTED):
+        """Cancel once; returns False if the token was already cancelled"""
+        if self._event.is_set():
+            return False
+        self.reason = reason
+        self._event.set()
+        return True
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(DEADLINE)
+        return self._event.is_set()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None without one"""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        """Raise GenerationCancelled if the token has been cancelled"""
+        if self.cancelled:
+            raise GenerationCancelled(self.reason)
+
+
+def connection_closed(sock):
+    """True if the peer has closed ``sock``; only peeks, so unread request data is left alone"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        return False  # Closed file descriptor or an SSL socket, which can't peek: can't tell
+    except OSError:
+        return True  # Reset by the peer
+
+
+class DisconnectWatcher:
+    """Cancel the tokens of in-flight requests whose client has gone away, checked every ``interval`` seconds"""
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self._watched = {}  # token -> (client socket, on_disconnect)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, sock, token, on_disconnect=None):
+        """Cancel ``token`` once the peer of ``sock`` hangs up, then call ``on_disconnect()`` if given"""
+        with self._lock:
+            self._watched[token] = (sock, on_disconnect)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="disconnect-watcher", daemon=True)
+                self._thread.start()
+
+    def unwatch(self, token):
+        with self._lock:
+            self._watched.pop(token, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._watched.items())
+            for token, (sock, on_disconnect) in watched:
+                if not token.cancelled and connection_closed(sock):
+                    token.cancel(DISCONNECTED)
+                    if on_disconnect is not None:
+                        on_disconnect()
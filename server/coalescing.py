@@ -0,0 +1,100 @@
+import threading
+
+
+class Flight:
+    """
+    One in-flight generation shared by every identical request attached to it.
+
+    A Flight stands in for a single request in the batch item: it forwards
+    step progress and live previews to every attached request, and counts
+    as cancelled only once all of them are.
+    """
+
+    def __init__(self):
+        self.future = None
+        self._listeners = []  # (on_step, live_preview, index, cancel) per attached request
+        self._lock = threading.Lock()
+
+    def attach(self, on_step=None, live_preview=None, index=0, cancel=None):
+        """Add a request; returns False if the flight is already cancelled and can't be joined"""
+        with self._lock:
+            if self._all_cancelled():
+                return False
+            self._listeners.append((on_step, live_preview, index, cancel))
+            return True
+
+    def _all_cancelled(self):
+        return bool(self._listeners) and all(cancel is not None and cancel.cancelled for _, _, _, cancel in self._listeners)
+
+    @property
+    def cancelled(self):
+        with self._lock:
+            return self._all_cancelled()
+
+    @property
+    def reason(self):
+        with self._lock:
+            reasons = [cancel.reason for _, _, _, cancel in self._listeners if cancel is not None and cancel.reason]
+        return reasons[-1] if reasons else None
+
+    def listeners(self):
+        with self._lock:
+            return list(self._listeners)
+
+    def on_step(self, step, total_steps):
+        for on_step, _, _, _ in self.listeners():
+            if on_step is not None:
+                on_step(step, total_steps)
+
+    def due(self, step, total_steps):
+        return any(live_preview is not None and live_preview.due(step, total_steps)
+                   for _, live_preview, _, _ in self.listeners())
+
+    def emit(self, step, total_steps, index, image):
+        # Every request gets the preview under its own image index
+        for _, live_preview, own_index, cancel in self.listeners():
+            if live_preview is not None and live_preview.due(step, total_steps) and not (cancel is not None and cancel.cancelled):
+                live_preview.emit(step, total_steps, own_index, image)
+
+
+class SingleFlight:
+    """
+    Identical in-flight generations by key, so a duplicate request (a retry,
+    a double click) joins the running one instead of queueing its own.
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.joined = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, start, on_step=None, live_preview=None, index=0, cancel=None):
+        """
+        Attach a request to the flight for ``key``, or start one with
+        ``start(flight)``, which must return a Future. Returns
+        ``(future, joined)``.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.future.done() and flight.attach(on_step, live_preview, index, cancel):
+                self.joined += 1
+                return flight.future, True
+
+            flight = Flight()
+            flight.attach(on_step, live_preview, index, cancel)
+            flight.future = start(flight)
+            self._flights[key] = flight
+            self.started += 1
+
+        flight.future.add_done_callback(lambda _: self._finish(key, flight))
+        return flight.future, False
+
+    def _finish(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
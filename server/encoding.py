@@ -0,0 +1,125 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# Supported output formats: format name -> (PIL format, MIME type, file extension)
+FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg")
+}
+
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+DEFAULT_QUALITY = 90
+MAX_THUMBNAILS = 4
+
+
+def parse_encode_options(data, image_format=None):
+    """
+    Read the output encoding settings from a request body.
+
+    ``image_format`` overrides the body's ``output_format`` (used when the
+    format was negotiated via the Accept header or query string).
+    """
+    image_format = (image_format or data.get("output_format", "png")).lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in FORMATS:
+        raise ValueError(f"Unsupported format: {image_format}")
+
+    compress_level = int(data.get("png_compress_level", DEFAULT_PNG_COMPRESS_LEVEL))
+    if not 0 <= compress_level <= 9:
+        raise ValueError("png_compress_level must be between 0 and 9")
+
+    quality = int(data.get("quality", DEFAULT_QUALITY))
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+
+    thumbnails = data.get("thumbnails", [])
+    if len(thumbnails) > MAX_THUMBNAILS:
+        raise ValueError(f"At most {MAX_THUMBNAILS} thumbnail sizes may be requested")
+    thumbnails = sorted({int(size) for size in thumbnails}, reverse=True)
+    if any(size < 16 for size in thumbnails):
+        raise ValueError("Thumbnail sizes must be at least 16 pixels")
+
+    return {
+        "format": image_format,
+        "png_compress_level": compress_level,
+        "quality": quality,
+        "lossless": bool(data.get("lossless", False)),
+        "thumbnails": thumbnails
+    }
+
+
+def media_type(options):
+    return FORMATS[options["format"]][1]
+
+
+def extension(options):
+    return FORMATS[options["format"]][2]
+
+
+def cache_variant(options):
+    """The options that change the encoded bytes of the full-size image"""
+    return {key: options[key] for key in ("format", "png_compress_level", "quality", "lossless")}
+
+
+def encode_image(image, options):
+    """Encode a PIL image with the given options and return the bytes"""
+    pil_format = FORMATS[options["format"]][0]
+    buffered = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffered, format="PNG", compress_level=options["png_compress_level"])
+    elif pil_format == "WEBP":
+        if options["lossless"]:
+            image.save(buffered, format="WEBP", lossless=True)
+        else:
+            image.save(buffered, format="WEBP", quality=options["quality"])
+    else:
+        image.convert("RGB").save(buffered, format="JPEG", quality=options["quality"])
+    return buffered.getvalue()
+
+
+def make_thumbnail(image, size):
+    """Downscale a copy of the image so its longest side is at most ``size``"""
+    thumbnail = image.copy()
+    thumbnail.thumbnail((size, size), Image.LANCZOS)
+    return thumbnail
+
+
+class ImageEncoder:
+    """
+    Thread pool that encodes full-size images and their thumbnail variants.
+
+    ``on_encoded``, if given, is called with the format and seconds spent
+    after every encode.
+    """
+
+    def __init__(self, workers=2, on_encoded=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-encoder")
+        self._on_encoded = on_encoded
+
+    def _encode(self, image, options, encoded):
+        started = time.perf_counter()
+        if image is None:
+            # Cache hits arrive already encoded; only decode them if variants are needed
+            image = Image.open(io.BytesIO(encoded)) if options["thumbnails"] else None
+        if encoded is None:
+            encoded = encode_image(image, options)
+        thumbnails = [
+            {"size": size, "data": encode_image(make_thumbnail(image, size), options)}
+            for size in options["thumbnails"]
+        ]
+        if self._on_encoded is not None:
+            self._on_encoded(options["format"], time.perf_counter() - started)
+        return {"image": encoded, "thumbnails": thumbnails}
+
+    def submit(self, image, options, encoded=None):
+        """
+        Encode ``image`` (or reuse already ``encoded`` bytes) off the caller's thread.
+
+        Returns a Future of ``{"image": bytes, "thumbnails": [{"size", "data"}]}``.
+        """
+        return self._executor.submit(self._encode, image, options, encoded)
@@ -0,0 +1,137 @@
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cancellation import CancelToken, GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job"""
+
+
+class Job:
+    """A single long-running generation tracked by the job queue"""
+
+    def __init__(self, kind, payload, cancel_token=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.status = "queued"
+        self.step = 0
+        self.total_steps = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_token = cancel_token or CancelToken()
+
+    def update_progress(self, step, total_steps):
+        """Record the current denoising step (called from the pipeline step callback)"""
+        self.step = step
+        self.total_steps = total_steps
+
+    def to_dict(self, include_result=True):
+        data = {
+            "id": self.id,
+            "type": self.kind,
+            "status": self.status,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        if include_result and self.result is not None:
+            data["result"] = self.result
+        return data
+
+
+class JobQueue:
+    """Bounded worker pool running generation jobs in the background.
+
+    At most ``workers`` jobs run at once and at most ``max_queued`` more may
+    wait; ``submit`` raises ``QueueFullError`` beyond that. Finished jobs are
+    kept for ``ttl`` seconds so clients can poll for the result.
+    ``on_cancel(job, reason)`` is called for every cancelled job.
+    """
+
+    def __init__(self, workers=2, max_queued=16, ttl=3600, on_cancel=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.on_cancel = on_cancel
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job-worker")
+
+    def submit(self, kind, payload, handler, cancel_token=None):
+        """Queue ``handler(job)`` and return the new Job; its return value becomes the job result"""
+        with self._lock:
+            self._prune()
+            if self._count("queued") >= self.max_queued:
+                raise QueueFullError(f"Job queue is full ({self.max_queued} jobs waiting)")
+            job = Job(kind, payload, cancel_token)
+            self._jobs[job.id] = job
+
+        self._executor.submit(self._run, job, handler)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._count("queued"),
+                "running": self._count("running"),
+                "workers": self.workers,
+                "max_queued": self.max_queued
+            }
+
+    def _count(self, status):
+        return sum(1 for job in self._jobs.values() if job.status == status)
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL"""
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns the job, or None if it is unknown"""
+        job = self.get(job_id)
+        if job is not None and job.finished_at is None:
+            job.cancel_token.cancel()
+        return job
+
+    def _run(self, job, handler):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            # Jobs cancelled or past their deadline while queued never start
+            job.cancel_token.check()
+            job.result = handler(job)
+            job.status = "done"
+        except GenerationCancelled as e:
+            reason = job.cancel_token.reason or e.reason
+            logger.info(f"Job {job.id} cancelled: {reason}")
+            job.error = f"Cancelled: {reason}"
+            job.status = "cancelled"
+            if self.on_cancel is not None:
+                self.on_cancel(job, reason)
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
@@ -0,0 +1,280 @@
+import json
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+
+from result_cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Request fields that change what Ollama generates, and so belong in the cache key
+GENERATION_FIELDS = ("model", "prompt", "system", "template", "format", "options", "images", "raw", "suffix")
+
+# Ollama endpoints forwarded as they are, with their methods; model management (pull, delete, create, ...)
+# stays off the gateway, which may be reachable through the public tunnel
+PASSTHROUGH_ENDPOINTS = {"chat": ("POST",), "tags": ("GET",)}
+
+SCENE_PROMPT_TEMPLATE = """You write prompts for a Stable Diffusion model that draws {style} comic panels.
+For every scene below write one image prompt: a comma-separated list of what the panel shows (characters and how they look, their action and expression, the setting, camera angle, lighting and mood).
+Keep each prompt under 60 words and leave out dialogue, narration and character names the model can't know.
+Answer with JSON only, one entry per scene in the same order:
+{{"prompts": [{{"id": "<scene id>", "imagePrompt": "<prompt>"}}]}}
+
+Scenes:
+{scenes}"""
+
+
+def describe_scene(number, scene):
+    """One numbered scene block for the scene prompt template"""
+    lines = [f"{number}. id: {scene.get('id', number)}", f"   description: {scene.get('prompt', '')}"]
+    if scene.get("characters"):
+        lines.append(f"   characters: {', '.join(scene['characters'])}")
+    if scene.get("narrator"):
+        lines.append(f"   narrator: {scene['narrator']}")
+    return "\n".join(lines)
+
+
+def parse_scene_prompts(text, scenes):
+    """
+    Map the model's JSON answer back onto ``scenes`` by id, falling back to
+    position. Returns ``(prompts, missing)``: an imagePrompt per scene and
+    the ids of scenes the answer didn't cover, which keep their own prompt.
+    """
+    try:
+        answer = json.loads(text)
+    except ValueError:
+        answer = {}
+    entries = answer.get("prompts", []) if isinstance(answer, dict) else answer
+    entries = [entry for entry in entries if isinstance(entry, dict)] if isinstance(entries, list) else []
+    by_id = {str(entry.get("id")): entry.get("imagePrompt") for entry in entries}
+
+    prompts, missing = [], []
+    for position, scene in enumerate(scenes):
+        scene_id = str(scene.get("id", position + 1))
+        image_prompt = by_id.get(scene_id)
+        if not image_prompt and position < len(entries):
+            image_prompt = entries[position].get("imagePrompt")
+        if not isinstance(image_prompt, str) or not image_prompt.strip():
+            missing.append(scene_id)
+            image_prompt = scene.get("prompt", "")
+        prompts.append({"id": scene.get("id", position + 1), "imagePrompt": image_prompt.strip()})
+    return prompts, missing
+
+
+class LLMGateway:
+    """
+    Proxy to an Ollama server with a cache of completed generations.
+
+    Requests share one pooled keep-alive session, so each call skips the TCP
+    (and TLS) handshake. Completions are cached by everything that affects
+    the output (model, prompt, options, ...) in a ResultCache, an in-memory
+    LRU over JSON files in the output store that survive restarts.
+    """
+
+    def __init__(self, base_url, cache, default_model, timeout=300, pool_size=8):
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.default_model = default_model
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def cache_key(self, body):
+        return make_cache_key({field: body.get(field) for field in GENERATION_FIELDS})
+
+    def cached(self, body):
+        """The cached final response for a generate request, or None"""
+        if body.get("cache") is False:
+            return None
+        data = self.cache.get(self.cache_key(body))
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return json.loads(data) if data is not None else None
+
+    def store(self, body, result):
+        if body.get("cache") is not False and result.get("done"):
+            self.cache.put(self.cache_key(body), json.dumps(result).encode("utf-8"), ".json")
+
+    def upstream_body(self, body, stream):
+        upstream = {key: value for key, value in body.items() if key != "cache"}
+        upstream["model"] = body.get("model") or self.default_model
+        upstream["stream"] = stream
+        return upstream
+
+    def generate(self, body):
+        """Run a generate request to completion, returning ``(result, cached)``"""
+        body = dict(body, model=body.get("model") or self.default_model)
+        result = self.cached(body)
+        if result is not None:
+            return result, True
+
+        upstream = self.session.post(f"{self.base_url}/api/generate", json=self.upstream_body(body, False), timeout=self.timeout)
+        upstream.raise_for_status()
+        result = upstream.json()
+        self.store(body, result)
+        return result, False
+
+    def stream_generate(self, body):
+        """
+        NDJSON lines for a generate request, yielded as Ollama produces the
+        tokens. A cache hit is a single final line; a miss is cached once the
+        final line arrives, with the full text in ``response``. Ollama is
+        contacted before this returns, so connection errors raise here.
+        """
+        body = dict(body, model=body.get("model") or self.default_model)
+        result = self.cached(body)
+        if result is not None:
+            return iter([json.dumps(result) + "\n"])
+
+        upstream = self.session.post(f"{self.base_url}/api/generate", json=self.upstream_body(body, True),
+                                     timeout=self.timeout, stream=True)
+        if not upstream.ok:
+            upstream.close()
+            upstream.raise_for_status()
+        return self._relay(body, upstream)
+
+    def _relay(self, body, upstream):
+        try:
+            text = []
+            # chunk_size=None hands over each chunk as it arrives instead of waiting for 512 bytes
+            for line in upstream.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                text.append(chunk.get("response", ""))
+                yield line.decode("utf-8") + "\n"
+                if chunk.get("done"):
+                    self.store(body, dict(chunk, response="".join(text)))
+        finally:
+            upstream.close()
+
+    def scene_prompts(self, scenes, style="manga", model=None, options=None):
+        """Image prompts for all ``scenes`` of a page from a single LLM call"""
+        prompt = SCENE_PROMPT_TEMPLATE.format(
+            style=style,
+            scenes="\n".join(describe_scene(number, scene) for number, scene in enumerate(scenes, start=1))
+        )
+        body = {
+            "model": model,
+            "prompt": prompt,
+            "format": "json",
+            "options": dict({"temperature": 0.4, "num_predict": 160 * len(scenes) + 64}, **(options or {}))
+        }
+        result, cached = self.generate(body)
+        prompts, missing = parse_scene_prompts(result.get("response", ""), scenes)
+        if missing:
+            logger.warning(f"LLM answer had no image prompt for scenes {missing}, kept their descriptions")
+        return {"scenes": prompts, "missing": missing, "model": result.get("model"), "cached": cached}
+
+    def passthrough(self, method, path):
+        """Forward the current request to Ollama unchanged and stream the answer back"""
+        upstream = self.session.request(
+            method,
+            f"{self.base_url}/api/{path}",
+            data=request.get_data(),
+            headers={"Content-Type": request.headers.get("Content-Type", "application/json")},
+            timeout=self.timeout,
+            stream=True
+        )
+        response = Response(
+            upstream.iter_content(chunk_size=None),
+            status=upstream.status_code,
+            content_type=upstream.headers.get("Content-Type")
+        )
+        response.call_on_close(upstream.close)
+        return response
+
+    def stats(self):
+        with self._lock:
+            stats = {"url": self.base_url, "hits": self.hits, "misses": self.misses}
+        stats["cache"] = self.cache.stats()
+        return stats
+
+
+def create_blueprint(gateway):
+    """
+    Routes for ``gateway``. Under ``/api`` they mirror Ollama's API, so a
+    client pointed at ``<server>/llm`` instead of Ollama works unchanged.
+    """
+    blueprint = Blueprint("llm", __name__)
+
+    @blueprint.route("/api/generate", methods=["POST"])
+    def generate():
+        """Ollama's generate endpoint, served from the cache when possible"""
+        try:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or not data.get("prompt"):
+                return jsonify({"error": "prompt is required"}), 400
+
+            # Ollama streams unless told otherwise
+            if data.get("stream", True):
+                return Response(stream_with_context(gateway.stream_generate(data)), mimetype="application/x-ndjson")
+
+            result, cached = gateway.generate(data)
+            response = jsonify(result)
+            response.headers["X-Cache"] = "hit" if cached else "miss"
+            return response
+        except requests.RequestException as e:
+            logger.error(f"Ollama request failed: {str(e)}")
+            return jsonify({"error": f"Ollama request failed: {str(e)}"}), 502
+        except Exception as e:
+            logger.error(f"Error in llm generate: {str(e)}")
+            return jsonify({"error": str(e)}), 500
+
+    @blueprint.route("/scene-prompts", methods=["POST"])
+    def scene_prompts():
+        """
+        Turn every scene of a page into a diffusion imagePrompt with one LLM call.
+
+        Body: {"scenes": [{"id", "prompt", "characters", "narrator"}, ...]}, or
+        {"page": {"scenes": [...]}}, plus optional "style", "model" and "options".
+        """
+        try:
+            data = request.get_json(silent=True) or {}
+            scenes = data.get("scenes") or (data.get("page") or {}).get("scenes")
+            if not isinstance(scenes, list) or not scenes or not all(isinstance(scene, dict) for scene in scenes):
+                return jsonify({"error": "scenes must be a non-empty list of scene objects"}), 400
+
+            result = gateway.scene_prompts(scenes, data.get("style") or "manga", data.get("model"), data.get("options"))
+            return jsonify(result)
+        except requests.RequestException as e:
+            logger.error(f"Ollama request failed: {str(e)}")
+            return jsonify({"error": f"Ollama request failed: {str(e)}"}), 502
+        except Exception as e:
+            logger.error(f"Error in scene_prompts: {str(e)}")
+            return jsonify({"error": str(e)}), 500
+
+    @blueprint.route("/api/<path:path>", methods=["GET", "POST", "DELETE"])
+    def passthrough(path):
+        """The other Ollama endpoints the client uses (chat, tags), forwarded over the pooled session"""
+        if request.method not in PASSTHROUGH_ENDPOINTS.get(path, ()):
+            return jsonify({"error": f"{request.method} /api/{path} is not available through the gateway"}), 403
+        try:
+            return gateway.passthrough(request.method, path)
+        except requests.RequestException as e:
+            logger.error(f"Ollama request failed: {str(e)}")
+            return jsonify({"error": f"Ollama request failed: {str(e)}"}), 502
+
+    @blueprint.route("/health", methods=["GET"])
+    def health():
+        """Cache statistics and whether Ollama answers"""
+        stats = gateway.stats()
+        try:
+            gateway.session.get(f"{gateway.base_url}/api/version", timeout=2).raise_for_status()
+            stats["ollama"] = "ok"
+        except requests.RequestException as e:
+            stats["ollama"] = f"unreachable: {str(e)}"
+        return jsonify(stats), 200 if stats["ollama"] == "ok" else 503
+
+    return blueprint
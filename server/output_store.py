@@ -0,0 +1,462 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import logging
+
+try:
+    import fcntl  # Not on Windows, where GC passes aren't coordinated across processes
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+INDEX_NAME = "index.sqlite3"
+SHARDS_NAME = "images"
+CACHES_NAME = "caches"  # Where cache files were kept before they moved into the shards
+GC_LOCK_NAME = "gc.lock"
+ACCESS_RESOLUTION = 3600  # Seconds; last_access is only rewritten once it is this stale
+TMP_MAX_AGE = 3600  # Seconds before an unfinished temporary file is considered abandoned
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    kind TEXT,
+    project TEXT,
+    prompt TEXT,
+    seed INTEGER,
+    parameters TEXT,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outputs_last_access ON outputs (last_access);
+CREATE INDEX IF NOT EXISTS outputs_created_at ON outputs (created_at);
+CREATE INDEX IF NOT EXISTS outputs_project ON outputs (project);
+CREATE INDEX IF NOT EXISTS outputs_path ON outputs (path);
+CREATE TABLE IF NOT EXISTS cache_entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS cache_entries_last_access ON cache_entries (last_access);
+CREATE INDEX IF NOT EXISTS cache_entries_namespace_last_access ON cache_entries (namespace, last_access);
+CREATE INDEX IF NOT EXISTS cache_entries_path ON cache_entries (path);
+-- Bytes per cache namespace, kept by triggers so budget checks don't sum the table
+CREATE TABLE IF NOT EXISTS cache_usage (
+    namespace TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS cache_entries_insert AFTER INSERT ON cache_entries BEGIN
+    INSERT INTO cache_usage (namespace, bytes) VALUES (new.namespace, new.size)
+    ON CONFLICT(namespace) DO UPDATE SET bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entries_update AFTER UPDATE OF size ON cache_entries BEGIN
+    UPDATE cache_usage SET bytes = bytes + new.size - old.size WHERE namespace = new.namespace;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entries_delete AFTER DELETE ON cache_entries BEGIN
+    UPDATE cache_usage SET bytes = bytes - old.size WHERE namespace = old.namespace;
+END;
+"""
+
+
+def content_id(data):
+    """Id of an output: a hash of its bytes, so identical images share one file"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+class OutputStore:
+    """
+    Generated images on disk, sharded by id and indexed in SQLite.
+
+    Files live under ``<directory>/images/<id[:2]>/<id[2:4]>/<id>.<ext>`` so
+    no directory grows past a few hundred entries, and are written to a
+    temporary name and renamed into place. The index maps each id to its
+    media type, size, generation parameters, project and created/last-access
+    times, which is what queries and retention work from: ``gc()`` removes
+    outputs older than ``max_age`` seconds and then the least recently used
+    ones until the store fits ``max_bytes`` (0 disables either limit).
+
+    The store also holds caches, one namespace each (``cache_get`` and
+    ``cache_put``). Their files are content-addressed in the same shards, so
+    a cached image that is also kept as an output is one file with two index
+    entries, and a file is only deleted with the last entry that uses it.
+    Each namespace has its own size budget, enforced least recently used
+    first on write, and entries unused for ``max_age`` are removed by
+    ``gc()`` like outputs.
+
+    Several processes may share one store. A file is written and deleted in
+    the same SQLite transaction as its index entry, so a write never loses
+    its file to a concurrent GC pass, and ``start_gc`` passes take a file
+    lock so only one process imports or collects at a time.
+    """
+
+    def __init__(self, directory, extensions, max_bytes=0, max_age=0):
+        self.directory = directory
+        self.extensions = extensions  # media type -> file extension
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._gc_thread = None
+        os.makedirs(os.path.join(directory, SHARDS_NAME), exist_ok=True)
+        # Write transactions take the database lock up front; other processes wait for it
+        self._db = sqlite3.connect(os.path.join(directory, INDEX_NAME), timeout=30,
+                                   isolation_level="IMMEDIATE", check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+
+    def _relative_path(self, output_id, media_type):
+        return os.path.join(SHARDS_NAME, output_id[:2], output_id[2:4], f"{output_id}.{self.extensions[media_type]}")
+
+    def _write(self, path, data):
+        """Write ``path`` unless it exists, under a temporary name first so readers never see a partial file"""
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, data, media_type, kind=None, project=None, parameters=None):
+        """Store encoded image bytes with what produced them; returns their id"""
+        output_id = content_id(data)
+        relative_path = self._relative_path(output_id, media_type)
+        parameters = parameters or {}
+        now = time.time()
+        with self._lock, self._db:
+            # An identical image produced again keeps its first record but counts as used
+            self._db.execute(
+                "INSERT INTO outputs (id, path, media_type, size, kind, project, prompt, seed, parameters, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET last_access = excluded.last_access",
+                (output_id, relative_path, media_type, len(data), kind, project, parameters.get("prompt"),
+                 parameters.get("seed"), json.dumps(parameters), now, now)
+            )
+            self._write(os.path.join(self.directory, relative_path), data)
+        return output_id
+
+    def get(self, output_id):
+        """Path and media type of an output, or (None, None); marks it as used"""
+        if not ID_PATTERN.fullmatch(output_id):
+            return None, None
+        with self._lock:
+            row = self._db.execute("SELECT path, media_type, last_access FROM outputs WHERE id = ?", (output_id,)).fetchone()
+        if row is None:
+            return None, None
+
+        path = os.path.join(self.directory, row["path"])
+        if not os.path.exists(path):
+            logger.warning(f"Output {output_id} is indexed but its file is missing, dropping it from the index")
+            self._forget([output_id])
+            return None, None
+        now = time.time()
+        if now - row["last_access"] > ACCESS_RESOLUTION:
+            with self._lock, self._db:
+                self._db.execute("UPDATE outputs SET last_access = ? WHERE id = ?", (now, output_id))
+        return path, row["media_type"]
+
+    def record(self, output_id):
+        """Index entry of an output, or None"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM outputs WHERE id = ?", (output_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def query(self, project=None, kind=None, prompt=None, since=None, until=None, limit=50, offset=0):
+        """Index entries matching every given filter, newest first; ``prompt`` matches a substring"""
+        clauses, values = [], []
+        for column, value in (("project", project), ("kind", kind)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                values.append(value)
+        if prompt:
+            clauses.append("prompt LIKE ? ESCAPE '\\'")
+            values.append("%" + prompt.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if since is not None:
+            clauses.append("created_at >= ?")
+            values.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            values.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM outputs {where} ORDER BY created_at DESC LIMIT ? OFFSET ?", values + [limit, offset]
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def _to_dict(self, row):
+        record = dict(row)
+        record["parameters"] = json.loads(record["parameters"]) if record["parameters"] else {}
+        del record["path"]
+        return record
+
+    def _forget(self, output_ids):
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM outputs WHERE id = ?", [(output_id,) for output_id in output_ids])
+
+    def _delete(self, table, rows):
+        """
+        Remove index entries and their files; returns how many were removed
+        and the bytes freed. Rows used again since they were selected (a
+        newer last_access) are kept, and so are files another output or
+        cache entry still uses.
+        """
+        removed, freed = 0, 0
+        with self._lock, self._db:
+            for row in rows:
+                deleted = self._db.execute(f"DELETE FROM {table} WHERE rowid = ? AND last_access = ?",
+                                           (row["rowid"], row["last_access"])).rowcount
+                if not deleted:
+                    continue
+                removed += 1
+                if self._remove_unused(row["path"]):
+                    freed += row["size"]
+        return removed, freed
+
+    def _remove_unused(self, relative_path):
+        """Delete a file once no output or cache entry uses it; call inside the transaction that dropped the last one"""
+        in_use = self._db.execute(
+            "SELECT EXISTS (SELECT 1 FROM outputs WHERE path = ?) OR EXISTS (SELECT 1 FROM cache_entries WHERE path = ?)",
+            (relative_path, relative_path)
+        ).fetchone()[0]
+        if in_use:
+            return False
+        try:
+            os.remove(os.path.join(self.directory, relative_path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete {relative_path}: {str(e)}")
+        return True
+
+    def cache_get(self, namespace, key):
+        """Bytes cached under ``key`` in ``namespace``, or None; marks the entry as used"""
+        with self._lock:
+            row = self._db.execute("SELECT rowid, path FROM cache_entries WHERE namespace = ? AND key = ?",
+                                   (namespace, key)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, row["path"]), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM cache_entries WHERE rowid = ?", (row["rowid"],))
+            return None
+        with self._lock, self._db:
+            self._db.execute("UPDATE cache_entries SET last_access = ? WHERE rowid = ?", (time.time(), row["rowid"]))
+        return data
+
+    def cache_put(self, namespace, key, data, extension, max_bytes=0, last_access=None):
+        """Cache ``data`` under ``key`` in ``namespace``, then evict its least recently used entries past ``max_bytes``"""
+        cached_id = content_id(data)
+        relative_path = os.path.join(SHARDS_NAME, cached_id[:2], cached_id[2:4], cached_id + extension)
+        with self._lock, self._db:
+            previous = self._db.execute("SELECT path FROM cache_entries WHERE namespace = ? AND key = ?",
+                                        (namespace, key)).fetchone()
+            self._db.execute(
+                "INSERT INTO cache_entries (namespace, key, path, size, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET path = excluded.path, size = excluded.size, last_access = excluded.last_access",
+                (namespace, key, relative_path, len(data), last_access or time.time())
+            )
+            self._write(os.path.join(self.directory, relative_path), data)
+            if previous is not None and previous["path"] != relative_path:
+                self._remove_unused(previous["path"])
+        if max_bytes > 0:
+            self._fit_cache(namespace, max_bytes)
+
+    def _cache_bytes(self, namespace):
+        row = self._db.execute("SELECT bytes FROM cache_usage WHERE namespace = ?", (namespace,)).fetchone()
+        return row["bytes"] if row is not None else 0
+
+    def _fit_cache(self, namespace, max_bytes):
+        with self._lock:
+            total = self._cache_bytes(namespace)
+            if total <= max_bytes:
+                return
+            cursor = self._db.execute("SELECT rowid, path, size, last_access FROM cache_entries "
+                                      "WHERE namespace = ? ORDER BY last_access", (namespace,))
+            rows = []
+            for row in cursor:
+                if total <= max_bytes:
+                    break
+                rows.append(row)
+                total -= row["size"]
+        self._delete("cache_entries", rows)
+
+    def cache_stats(self, namespace):
+        with self._lock:
+            items = self._db.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (namespace,)).fetchone()[0]
+            return {"items": items, "bytes": self._cache_bytes(namespace)}
+
+    def gc(self):
+        """Apply the retention limits and clear abandoned temporary files; returns what was removed"""
+        removed, freed = 0, 0
+        if self.max_age > 0:
+            cutoff = time.time() - self.max_age
+            for table in ("outputs", "cache_entries"):
+                with self._lock:
+                    rows = self._db.execute(f"SELECT rowid, path, size, last_access FROM {table} WHERE last_access < ?",
+                                            (cutoff,)).fetchall()
+                deleted, deleted_bytes = self._delete(table, rows)
+                removed += deleted
+                freed += deleted_bytes
+
+        if self.max_bytes > 0:
+            total = self.stats()["bytes"]
+            if total > self.max_bytes:
+                with self._lock:
+                    cursor = self._db.execute("SELECT rowid, path, size, last_access FROM outputs ORDER BY last_access")
+                    rows = []
+                    for row in cursor:
+                        if total <= self.max_bytes:
+                            break
+                        rows.append(row)
+                        total -= row["size"]
+                deleted, deleted_bytes = self._delete("outputs", rows)
+                removed += deleted
+                freed += deleted_bytes
+
+        removed_tmp = self._sweep_tmp()
+        if removed or removed_tmp:
+            logger.info(f"Output GC removed {removed} outputs and cache entries ({freed / (1 << 20):.1f}MB) and {removed_tmp} temporary files")
+        return {"removed": removed, "freed_bytes": freed, "removed_tmp": removed_tmp}
+
+    def _sweep_tmp(self):
+        removed = 0
+        cutoff = time.time() - TMP_MAX_AGE
+        for name in (SHARDS_NAME, CACHES_NAME):
+            for root, _, files in os.walk(os.path.join(self.directory, name)):
+                for file_name in files:
+                    path = os.path.join(root, file_name)
+                    try:
+                        if file_name.endswith(".tmp") and os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+    def import_flat(self, directory):
+        """
+        Move images saved flat in ``directory`` (the old layout) into the
+        store. They are indexed without parameters, dated by their mtime.
+        """
+        media_types = {f".{extension}": media_type for media_type, extension in self.extensions.items()}
+        imported = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                media_type = media_types.get(os.path.splitext(entry.name)[1])
+                if media_type is None or not entry.is_file():
+                    continue
+                with open(entry.path, "rb") as f:
+                    data = f.read()
+                mtime = entry.stat().st_mtime
+                output_id = self.put(data, media_type)
+                with self._lock, self._db:
+                    self._db.execute("UPDATE outputs SET created_at = MIN(created_at, ?), last_access = ? WHERE id = ?",
+                                     (mtime, mtime, output_id))
+                os.remove(entry.path)
+                imported += 1
+        if imported:
+            logger.info(f"Moved {imported} flat outputs from {directory} into the output store")
+        return imported
+
+    def import_flat_cache(self, namespace, directory):
+        """
+        Move a cache directory of the old layout (one ``<key><ext>`` file per
+        entry) into ``namespace``, dated by mtime, then remove the directory.
+        """
+        if not os.path.isdir(directory):
+            return 0
+        imported = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if not entry.name.endswith(".tmp"):
+                    key, extension = os.path.splitext(entry.name)
+                    with open(entry.path, "rb") as f:
+                        data = f.read()
+                    self.cache_put(namespace, key, data, extension, last_access=entry.stat().st_mtime)
+                    imported += 1
+                os.remove(entry.path)
+        os.rmdir(directory)
+        logger.info(f"Moved {imported} cache entries from {directory} into the output store's {namespace} cache")
+        return imported
+
+    def _try_gc_lock(self):
+        """Open the GC lock file and lock it without waiting; None if another process holds it"""
+        lock_file = open(os.path.join(self.directory, GC_LOCK_NAME), "a+")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def start_gc(self, interval, import_from=None, import_caches=None):
+        """
+        Run gc() every ``interval`` seconds in a background thread, after
+        moving flat files from ``import_from`` and old cache directories
+        (``import_caches``, namespace -> directory) into the store if given.
+
+        Each pass holds a lock file in the store's directory. A process that
+        finds it held skips that pass, and a pass another process ran less
+        than half an interval ago isn't repeated, so worker processes sharing
+        a store neither race nor multiply the work.
+        """
+        if self._gc_thread is not None:
+            return
+
+        def run_pass(first):
+            lock_file = self._try_gc_lock()
+            if lock_file is None:
+                return
+            try:
+                if first:
+                    try:
+                        if import_from is not None:
+                            self.import_flat(import_from)
+                        for namespace, directory in (import_caches or {}).items():
+                            self.import_flat_cache(namespace, directory)
+                    except Exception as e:
+                        logger.error(f"Importing flat outputs failed: {str(e)}")
+                if interval <= 0:
+                    return
+                if not first and time.time() - os.fstat(lock_file.fileno()).st_mtime < interval / 2:
+                    return  # Another process ran one recently
+                try:
+                    self.gc()
+                except Exception as e:
+                    logger.error(f"Output GC failed: {str(e)}")
+                os.utime(lock_file.fileno())  # When the last pass ran, for the other processes
+            finally:
+                lock_file.close()  # Releases the lock
+
+        def loop():
+            run_pass(first=True)
+            while interval > 0:
+                time.sleep(interval)
+                run_pass(first=False)
+
+        self._gc_thread = threading.Thread(target=loop, name="output-gc", daemon=True)
+        self._gc_thread.start()
+
+    def stats(self):
+        with self._lock:
+            row = self._db.execute("SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM outputs").fetchone()
+        return {"files": row["files"], "bytes": row["bytes"], "max_bytes": self.max_bytes, "max_age": self.max_age}
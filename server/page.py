@@ -0,0 +1,65 @@
+import hashlib
+from collections import Counter
+
+MAX_SEED = 2 ** 31 - 1
+
+
+def derive_seed(*parts):
+    """Deterministic seed from strings, stable across processes (unlike hash())"""
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % MAX_SEED
+
+
+def normalize_character(name):
+    return " ".join(name.lower().split())
+
+
+def scene_characters(scene):
+    """
+    Characters appearing in a scene: an explicit ``characters`` list if the
+    scene has one, otherwise the speakers of its dialogue lines, in order.
+    """
+    names = scene.get("characters") or [line.get("character", "") for line in scene.get("dialogue", [])]
+    characters = []
+    for name in names:
+        if name and normalize_character(name) not in [normalize_character(c) for c in characters]:
+            characters.append(name)
+    return characters
+
+
+def plan_page(scenes, story_seed=0):
+    """
+    Assign a seed to every scene of a page.
+
+    Each character gets a seed derived from its name and ``story_seed``, so
+    the same character starts from the same noise on every page. A scene is
+    seeded by its main character: the one of its characters that appears in
+    the most scenes of the page (ties go to the first speaker). Scenes with
+    the same main character therefore share their starting latents; scenes
+    without characters get a seed of their own.
+
+    Returns one dict per scene with ``scene_id``, ``characters``,
+    ``character`` (the main one, or None), ``seed`` and ``shared_with``
+    (ids of the other scenes starting from the same latents).
+    """
+    scene_ids = [scene.get("id") or f"scene{index + 1}" for index, scene in enumerate(scenes)]
+    characters = [scene_characters(scene) for scene in scenes]
+    appearances = Counter(normalize_character(name) for names in characters for name in names)
+
+    panels = []
+    for scene_id, names in zip(scene_ids, characters):
+        if names:
+            # max() keeps the first of equally frequent characters
+            main = max(names, key=lambda name: appearances[normalize_character(name)])
+            seed = derive_seed("character", normalize_character(main), story_seed)
+        else:
+            main = None
+            seed = derive_seed("scene", scene_id, story_seed)
+        panels.append({"scene_id": scene_id, "characters": names, "character": main, "seed": seed})
+
+    for panel in panels:
+        panel["shared_with"] = [
+            other["scene_id"] for other in panels
+            if other is not panel and other["seed"] == panel["seed"]
+        ]
+    return panels
@@ -0,0 +1,79 @@
+import io
+import base64
+import logging
+
+import numpy as np
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Linear map from the 4 SD 1.x/2.x latent channels to RGB in [-1, 1]; a
+# cheap stand-in for the VAE decoder that costs one small matmul per preview
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473]
+]
+
+
+class LivePreview:
+    """A request's wish for previews every ``every`` steps, handed to ``emit(step, total_steps, index, image)``"""
+
+    def __init__(self, every, emit):
+        self.every = every
+        self.emit = emit
+
+    def due(self, step, total_steps):
+        # The last step is skipped, the finished image follows right after
+        return self.every > 0 and step % self.every == 0 and step < total_steps
+
+
+class PreviewDecoder:
+    """
+    Turn intermediate latents into small RGB previews.
+
+    Uses the tiny autoencoder (TAESD, diffusers' AutoencoderTiny) when one is
+    given, for full-size previews; otherwise a linear approximation gives
+    previews at latent resolution (1/8 of the image size).
+    """
+
+    def __init__(self, tiny_vae=None):
+        self.tiny_vae = tiny_vae
+        self._factors = {}  # (device, dtype) -> factors tensor
+
+    @classmethod
+    def load(cls, model_id, device, dtype, cache_dir=None):
+        """Decoder backed by the AutoencoderTiny at ``model_id``, or the approximation if it can't be loaded"""
+        if not model_id:
+            return cls()
+        try:
+            from diffusers import AutoencoderTiny
+            tiny_vae = AutoencoderTiny.from_pretrained(model_id, torch_dtype=dtype, cache_dir=cache_dir).to(device)
+            logger.info(f"Live previews decoded with {model_id}")
+            return cls(tiny_vae)
+        except Exception as e:
+            logger.warning(f"Could not load preview decoder {model_id}, using the latent approximation: {str(e)}")
+            return cls()
+
+    def decode(self, latents):
+        """Decode a (batch, 4, h, w) latent tensor into PIL images"""
+        with torch.no_grad():
+            if self.tiny_vae is not None:
+                images = self.tiny_vae.decode(latents.to(self.tiny_vae.dtype)).sample
+            else:
+                key = (latents.device, latents.dtype)
+                if key not in self._factors:
+                    self._factors[key] = torch.tensor(LATENT_RGB_FACTORS, device=latents.device, dtype=latents.dtype)
+                images = torch.einsum("bchw,cr->brhw", latents, self._factors[key])
+            images = ((images + 1) / 2).clamp(0, 1).mul(255).round()
+            arrays = images.to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+        return [Image.fromarray(np.ascontiguousarray(array)) for array in arrays]
+
+
+def encode_preview(image, quality=70):
+    """Base64 JPEG of a preview image"""
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+def make_cache_key(params):
+    """Hash a dict of generation inputs into a stable content-addressed key"""
+    encoded = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of encoded results keyed by a hash of their generation inputs.
+
+    The memory tier is an LRU bounded by ``max_memory_bytes``. The disk tier
+    is the ``namespace`` cache of an OutputStore, which indexes its files,
+    evicts the least recently used ones past ``max_disk_bytes`` and applies
+    the store's age retention. Processes sharing the store share this tier.
+    """
+
+    def __init__(self, store, namespace, max_memory_bytes=256 << 20, max_disk_bytes=1 << 30):
+        self.store = store
+        self.namespace = namespace
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached bytes for ``key`` or None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        data = self.store.cache_get(self.namespace, key)
+        if data is not None:
+            with self._lock:
+                self._remember(key, data)
+        return data
+
+    def put(self, key, data, extension=".png"):
+        """Store encoded bytes in both tiers; ``extension`` names the file on disk"""
+        with self._lock:
+            self._remember(key, data)
+        self.store.cache_put(self.namespace, key, data, extension, max_bytes=self.max_disk_bytes)
+
+    def _remember(self, key, data):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        if len(data) > self.max_memory_bytes:
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def stats(self):
+        disk = self.store.cache_stats(self.namespace)
+        with self._lock:
+            return {
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_items": disk["items"],
+                "disk_bytes": disk["bytes"]
+            }
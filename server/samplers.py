@@ -0,0 +1,81 @@
+import threading
+
+import diffusers
+
+# Auto1111 sampler name -> (diffusers scheduler class, config overrides)
+# LMS is left out: diffusers' LMSDiscreteScheduler needs scipy, which is not a dependency
+SAMPLERS = {
+    "Euler a": ("EulerAncestralDiscreteScheduler", {}),
+    "Euler": ("EulerDiscreteScheduler", {}),
+    "Heun": ("HeunDiscreteScheduler", {}),
+    "DPM2": ("KDPM2DiscreteScheduler", {}),
+    "DPM2 a": ("KDPM2AncestralDiscreteScheduler", {}),
+    "DPM++ 2M": ("DPMSolverMultistepScheduler", {}),
+    "DPM++ 2M Karras": ("DPMSolverMultistepScheduler", {"use_karras_sigmas": True}),
+    "DPM++ 2M SDE": ("DPMSolverMultistepScheduler", {"algorithm_type": "sde-dpmsolver++"}),
+    "DPM++ 2M SDE Karras": ("DPMSolverMultistepScheduler", {"algorithm_type": "sde-dpmsolver++", "use_karras_sigmas": True}),
+    "DPM++ 2S a": ("DPMSolverSinglestepScheduler", {}),
+    "UniPC": ("UniPCMultistepScheduler", {}),
+    "DDIM": ("DDIMScheduler", {}),
+    "PLMS": ("PNDMScheduler", {"skip_prk_steps": True})
+}
+
+# Other spellings clients send for the same samplers
+ALIASES = {
+    "k_euler_a": "Euler a",
+    "k_euler": "Euler",
+    "k_heun": "Heun",
+    "k_dpm_2": "DPM2",
+    "k_dpm_2_a": "DPM2 a",
+    "k_dpmpp_2m": "DPM++ 2M",
+    "k_dpmpp_2m_ka": "DPM++ 2M Karras",
+    "unipc": "UniPC",
+    "ddim": "DDIM",
+    "plms": "PLMS"
+}
+
+
+def resolve_sampler(name):
+    """Return the canonical sampler name for ``name``, raising ValueError for unknown samplers"""
+    if name in SAMPLERS:
+        return name
+    for candidate in SAMPLERS:
+        if candidate.lower() == name.lower():
+            return candidate
+    if name.lower() in ALIASES:
+        return ALIASES[name.lower()]
+    raise ValueError(f"Unknown sampler: {name}")
+
+
+def list_samplers():
+    """Samplers in the Auto1111 /sdapi/v1/samplers format"""
+    aliases = {}
+    for alias, name in ALIASES.items():
+        aliases.setdefault(name, []).append(alias)
+    return [
+        {"name": name, "aliases": aliases.get(name, []), "options": dict(overrides)}
+        for name, (_, overrides) in SAMPLERS.items()
+    ]
+
+
+class SchedulerRegistry:
+    """
+    Scheduler instances per sampler, all built from the loaded pipeline's
+    scheduler config so they share its training betas and timestep settings.
+    Building one only reads the config; no weights are loaded.
+    """
+
+    def __init__(self, base_config):
+        self._base_config = base_config
+        self._schedulers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Return the scheduler for a sampler name (instances are stateful; use under the pipeline lock)"""
+        name = resolve_sampler(name)
+        with self._lock:
+            if name not in self._schedulers:
+                class_name, overrides = SAMPLERS[name]
+                scheduler_class = getattr(diffusers, class_name)
+                self._schedulers[name] = scheduler_class.from_config(self._base_config, **overrides)
+            return self._schedulers[name]
@@ -0,0 +1,344 @@
+from flask import Flask, request, jsonify, Response
+import requests
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import HTTPError
+from http.client import HTTPException
+import subprocess
+import socket
+import threading
+import itertools
+import logging
+import sys
+import os
+
+from cancellation import CancelToken, DisconnectWatcher, GenerationCancelled, DISCONNECTED
+
+app = Flask(__name__)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+NUM_WORKERS = int(os.getenv("SD_NUM_WORKERS", "2"))  # Model worker processes, each with its own pipeline
+WORKER_BASE_PORT = int(os.getenv("SD_WORKER_BASE_PORT", "5100"))  # Worker i listens on base port + i
+WORKER_MODELS = [m for m in os.getenv("SD_WORKER_MODELS", "").split(",") if m]  # Optional model id per worker
+PIN_WORKERS = os.getenv("SD_PIN_WORKERS", "1") == "1"  # Give each worker its own slice of the CPU cores
+HEALTH_INTERVAL = float(os.getenv("SD_WORKER_HEALTH_INTERVAL", "2"))  # Seconds between worker health checks
+PROXY_TIMEOUT = int(os.getenv("SD_PROXY_TIMEOUT", "600"))  # Seconds to wait for a worker response
+WORKER_RETRY_AFTER = 5  # Seconds clients should wait when no worker is ready
+MAX_TRACKED_JOBS = 10000  # Job ids remembered for routing polls to their worker
+
+# Headers that describe a single hop and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "content-length", "host"
+}
+
+# What a failed or interrupted worker connection raises
+UPSTREAM_ERRORS = (OSError, HTTPException, HTTPError)
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def split_cores(cores, parts):
+    """Split a list of CPU core ids into ``parts`` contiguous, near-equal slices"""
+    cores = sorted(cores)
+    size, extra = divmod(len(cores), parts)
+    slices, start = [], 0
+    for index in range(parts):
+        end = start + size + (1 if index < extra else 0)
+        slices.append(cores[start:end] or cores)
+        start = end
+    return slices
+
+
+class Worker:
+    """One app.py process owning a loaded pipeline"""
+
+    def __init__(self, index, port, model_id=None, cores=None):
+        self.index = index
+        self.port = port
+        self.model_id = model_id
+        self.cores = cores
+        self.process = None
+        self.ready = False
+        self.in_flight = 0
+        self.pending_jobs = 0
+        self.served = 0
+        self.restarts = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        env = dict(os.environ)
+        env["SD_API_HOST"] = "127.0.0.1"
+        env["SD_API_PORT"] = str(self.port)
+        if self.model_id:
+            env["SD_BASE_MODEL_ID"] = self.model_id
+        if self.cores:
+            env["SD_CPU_AFFINITY"] = ",".join(str(core) for core in self.cores)
+            env.setdefault("SD_TORCH_THREADS", str(len(self.cores)))
+
+        logger.info(f"Starting worker {self.index} on port {self.port}"
+                    + (f" pinned to cores {env['SD_CPU_AFFINITY']}" if self.cores else ""))
+        self.ready = False
+        self.process = subprocess.Popen([sys.executable, APP_PATH], env=env, cwd=os.path.dirname(APP_PATH))
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def check_health(self):
+        """Mark the worker ready once its model is loaded and warmed up, and record its background job load"""
+        try:
+            response = requests.get(f"{self.url}/health", timeout=2)
+            health = response.json() if response.ok else {}
+        except (requests.RequestException, ValueError):
+            health = {}
+        self.ready = health.get("ready", False)
+        jobs = health.get("jobs", {})
+        self.pending_jobs = jobs.get("queued", 0) + jobs.get("running", 0)
+
+    @property
+    def queue_length(self):
+        return self.in_flight + self.pending_jobs
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "port": self.port,
+            "pid": self.process.pid if self.process else None,
+            "model": self.model_id,
+            "cores": self.cores,
+            "alive": self.alive(),
+            "ready": self.ready,
+            "queue_length": self.queue_length,
+            "in_flight": self.in_flight,
+            "pending_jobs": self.pending_jobs,
+            "served": self.served,
+            "restarts": self.restarts
+        }
+
+
+class Supervisor:
+    """Start the workers, restart the ones that die and pick one per request"""
+
+    def __init__(self, num_workers, base_port, models=None, pin=True):
+        core_slices = [None] * num_workers
+        if pin and hasattr(os, "sched_getaffinity"):
+            core_slices = split_cores(os.sched_getaffinity(0), num_workers)
+
+        models = models or []
+        self.workers = [
+            Worker(index, base_port + index, models[index % len(models)] if models else None, core_slices[index])
+            for index in range(num_workers)
+        ]
+        self.job_owners = {}  # job id -> worker, so polling reaches the worker running the job
+        self._rotation = itertools.count()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        for worker in self.workers:
+            worker.stop()
+
+    def _monitor(self):
+        while not self._stopped.wait(HEALTH_INTERVAL):
+            for worker in self.workers:
+                if not worker.alive():
+                    logger.warning(f"Worker {worker.index} exited, restarting")
+                    worker.restarts += 1
+                    worker.start()
+                    continue
+                worker.check_health()
+
+    def pick(self, model_id=None):
+        """Return the ready worker with the shortest queue, preferring ones serving ``model_id``"""
+        candidates = [worker for worker in self.workers if worker.ready]
+        if model_id:
+            matching = [worker for worker in candidates if worker.model_id == model_id]
+            candidates = matching or candidates
+        if not candidates:
+            return None
+
+        with self._lock:
+            # Rotate the start point so ties don't always land on the first worker
+            offset = next(self._rotation) % len(candidates)
+            ordered = candidates[offset:] + candidates[:offset]
+            worker = min(ordered, key=lambda w: w.queue_length)
+            worker.in_flight += 1
+            return worker
+
+    def track_job(self, job_id, worker):
+        with self._lock:
+            self.job_owners[job_id] = worker
+            while len(self.job_owners) > MAX_TRACKED_JOBS:
+                del self.job_owners[next(iter(self.job_owners))]
+
+    def release(self, worker):
+        with self._lock:
+            worker.in_flight -= 1
+            worker.served += 1
+
+
+supervisor = Supervisor(NUM_WORKERS, WORKER_BASE_PORT, WORKER_MODELS, PIN_WORKERS)
+disconnect_watcher = DisconnectWatcher()  # Hangs up on workers whose client hung up
+
+
+def shutdown(connection):
+    """Shut a worker connection down, waking a read blocked on it; the worker then sees its client leave"""
+    if connection.sock is not None:
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def proxy(worker, path):
+    """
+    Forward the current request to a worker and stream its response back.
+
+    Returns ``(response, upstream, token)``. The worker connection is closed
+    once the response is done, and as soon as the client disconnects, even
+    while the worker is still generating: the worker's own disconnect
+    check then cancels the generation. ``token`` is cancelled in that case.
+    """
+    headers = {key: value for key, value in request.headers if key.lower() not in HOP_BY_HOP_HEADERS}
+    # Compressed bodies are passed through undecoded, so the worker must only compress what the client accepts
+    headers["Accept-Encoding"] = request.headers.get("Accept-Encoding", "identity")
+    url = f"/{path}?{request.query_string.decode()}" if request.query_string else f"/{path}"
+
+    # One connection per request, owned here, so a disconnect can shut it down mid-request
+    connection = HTTPConnection("127.0.0.1", worker.port, timeout=PROXY_TIMEOUT)
+    token = CancelToken()
+    # Only the development server exposes the client socket
+    client_socket = request.environ.get("werkzeug.socket")
+    if client_socket is not None:
+        disconnect_watcher.watch(client_socket, token, on_disconnect=lambda: shutdown(connection))
+    try:
+        connection.request(request.method, url, body=request.get_data(), headers=headers, preload_content=False)
+        if token.cancelled:
+            # The client left before the connection existed
+            shutdown(connection)
+        upstream = connection.getresponse()
+    except UPSTREAM_ERRORS:
+        disconnect_watcher.unwatch(token)
+        connection.close()
+        if token.cancelled:
+            raise GenerationCancelled(DISCONNECTED)
+        raise
+
+    def relay():
+        try:
+            # Bodies the worker compressed for this client are passed on still compressed
+            yield from upstream.stream(chunk_size, decode_content=False)
+        except UPSTREAM_ERRORS:
+            if not token.cancelled:
+                raise
+        finally:
+            disconnect_watcher.unwatch(token)
+            connection.close()
+
+    response_headers = [(key, value) for key, value in upstream.headers.items()
+                        if key.lower() not in HOP_BY_HOP_HEADERS]
+    # Event streams are forwarded as each event arrives rather than in 64KB chunks
+    chunk_size = None if upstream.headers.get("Content-Type", "").startswith("text/event-stream") else 64 * 1024
+    response = Response(relay(), status=upstream.status, headers=response_headers)
+    return response, upstream, token
+
+
+@app.route("/workers", methods=["GET"])
+def workers():
+    """Per-worker state including queue length"""
+    return jsonify([worker.to_dict() for worker in supervisor.workers])
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Health check endpoint"""
+    ready = sum(1 for worker in supervisor.workers if worker.ready)
+    return jsonify({
+        "status": "ok" if ready else "starting",
+        "model_loaded": ready > 0,
+        "workers_ready": ready,
+        "workers": len(supervisor.workers),
+        "queue_length": sum(worker.queue_length for worker in supervisor.workers)
+    })
+
+
+@app.route("/sdapi/v1/jobs/<job_id>", methods=["GET", "DELETE"])
+def job(job_id):
+    """Poll or cancel a job on the worker that accepted it"""
+    worker = supervisor.job_owners.get(job_id)
+    if worker is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    try:
+        response, _, _ = proxy(worker, f"sdapi/v1/jobs/{job_id}")
+    except GenerationCancelled as e:
+        return jsonify({"error": f"Request cancelled: {e.reason}", "reason": e.reason}), 499
+    except UPSTREAM_ERRORS as e:
+        logger.error(f"Error proxying to worker {worker.index}: {str(e)}")
+        return jsonify({"error": str(e)}), 502
+    return response
+
+
+@app.route("/", defaults={"path": ""}, methods=["GET", "POST"])
+@app.route("/<path:path>", methods=["GET", "POST"])
+def dispatch(path):
+    """Route any other request to the least-queued worker"""
+    data = request.get_json(silent=True) or {}
+    worker = supervisor.pick(data.get("model"))
+    if worker is None:
+        response = jsonify({"error": "No model worker is ready"})
+        response.headers["Retry-After"] = str(WORKER_RETRY_AFTER)
+        return response, 503
+
+    try:
+        response, upstream, _ = proxy(worker, path)
+    except GenerationCancelled as e:
+        supervisor.release(worker)
+        logger.info(f"Client of a request on worker {worker.index} disconnected, closed the worker connection")
+        return jsonify({"error": f"Generation cancelled: {e.reason}", "reason": e.reason}), 499
+    except UPSTREAM_ERRORS as e:
+        supervisor.release(worker)
+        logger.error(f"Error proxying to worker {worker.index}: {str(e)}")
+        return jsonify({"error": str(e)}), 502
+
+    if path == "sdapi/v1/jobs" and upstream.status == 202:
+        # Remember which worker owns the job; the body is small, so read it here
+        body = response.get_json()
+        supervisor.track_job(body["job_id"], worker)
+        supervisor.release(worker)
+        return jsonify(body), 202
+
+    response.call_on_close(lambda: supervisor.release(worker))
+    return response
+
+
+if __name__ == "__main__":
+    supervisor.start()
+
+    port = int(os.getenv("SD_API_PORT", 5000))
+    host = os.getenv("SD_API_HOST", "0.0.0.0")
+
+    logger.info(f"Starting dispatcher for {NUM_WORKERS} workers on {host}:{port}")
+    try:
+        app.run(host=host, port=port, debug=False, threaded=True)
+    finally:
+        supervisor.stop()
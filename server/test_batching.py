@@ -0,0 +1,94 @@
+"""Tests for batching.py. Run with: python -m pytest server"""
+import pytest
+
+from batching import BatchScheduler
+
+
+class Recorder:
+    """A ``run_batch`` that records its batches and doubles every item"""
+
+    def __init__(self, fail_items=(), fail_batch=False):
+        self.batches = []
+        self.fail_items = fail_items
+        self.fail_batch = fail_batch
+
+    def __call__(self, key, items):
+        self.batches.append((key, list(items)))
+        if self.fail_batch:
+            raise RuntimeError("pipeline crashed")
+        return [ValueError(f"bad item {item}") if item in self.fail_items else item * 2 for item in items]
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(run_batch, **kwargs):
+        scheduler = BatchScheduler(run_batch, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def test_items_with_the_same_key_run_together(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, window=0.5, max_batch_size=4)
+    futures = [scheduler.submit((512, 512), item) for item in (1, 2, 3)]
+    assert [future.result(5) for future in futures] == [2, 4, 6]
+    assert run_batch.batches == [((512, 512), [1, 2, 3])]
+
+
+def test_a_full_batch_runs_without_waiting_for_the_window(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, window=30, max_batch_size=2)
+    futures = [scheduler.submit("key", item) for item in (1, 2)]
+    assert [future.result(5) for future in futures] == [2, 4]
+
+
+def test_batches_split_by_key_and_size(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, window=0.3, max_batch_size=2)
+    futures = [scheduler.submit(key, item) for key, item in (("a", 0), ("a", 1), ("b", 2), ("a", 3), ("a", 4), ("b", 5))]
+    assert [future.result(5) for future in futures] == [0, 2, 4, 6, 8, 10]
+    assert all(len(items) <= 2 for _, items in run_batch.batches)
+    assert sorted(item for key, items in run_batch.batches if key == "a" for item in items) == [0, 1, 3, 4]
+    assert sorted(item for key, items in run_batch.batches if key == "b" for item in items) == [2, 5]
+
+
+def test_an_exception_in_place_of_a_result_fails_only_that_item(make_scheduler):
+    scheduler = make_scheduler(Recorder(fail_items=(2,)), window=0.5, max_batch_size=3)
+    futures = [scheduler.submit("key", item) for item in (1, 2, 3)]
+    assert futures[0].result(5) == 2
+    with pytest.raises(ValueError, match="bad item 2"):
+        futures[1].result(5)
+    assert futures[2].result(5) == 6
+
+
+def test_a_failed_batch_fails_every_item(make_scheduler):
+    scheduler = make_scheduler(Recorder(fail_batch=True), window=0.5, max_batch_size=2)
+    futures = [scheduler.submit("key", item) for item in (1, 2)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="pipeline crashed"):
+            future.result(5)
+
+
+def test_cancelled_items_are_left_out_of_the_batch(make_scheduler):
+    run_batch = Recorder()
+    scheduler = make_scheduler(run_batch, window=0.3, max_batch_size=4)
+    kept, dropped = scheduler.submit("key", 1), scheduler.submit("key", 2)
+    assert dropped.cancel()
+    assert kept.result(5) == 2
+    assert run_batch.batches == [("key", [1])]
+
+
+def test_stop_fails_queued_items_and_refuses_new_ones():
+    scheduler = BatchScheduler(Recorder(), window=30, max_batch_size=4)
+    queued = scheduler.submit("key", 1)  # Waits for the window to fill
+    scheduler.stop()
+    with pytest.raises(RuntimeError, match="stopped"):
+        queued.result(5)
+    with pytest.raises(RuntimeError, match="stopped"):
+        scheduler.submit("key", 2)
@@ -0,0 +1,109 @@
+"""Tests for coalescing.py. Run with: python -m pytest server"""
+from concurrent.futures import Future
+
+from cancellation import CancelToken
+from coalescing import SingleFlight
+
+
+class Starter:
+    """A ``start`` callable that records flights and leaves their futures for the test to resolve"""
+
+    def __init__(self):
+        self.flights = []
+
+    def __call__(self, flight):
+        self.flights.append(flight)
+        return Future()
+
+
+class RecordingPreview:
+    def __init__(self):
+        self.emitted = []
+
+    def due(self, step, total_steps):
+        return True
+
+    def emit(self, step, total_steps, index, image):
+        self.emitted.append((step, index, image))
+
+
+def test_a_duplicate_joins_the_running_flight():
+    single_flight, start = SingleFlight(), Starter()
+    first, joined_first = single_flight.submit("key", start)
+    second, joined_second = single_flight.submit("key", start)
+    assert (joined_first, joined_second) == (False, True)
+    assert second is first
+    assert len(start.flights) == 1
+    assert single_flight.stats() == {"in_flight": 1, "started": 1, "joined": 1}
+
+
+def test_different_keys_start_their_own_flights():
+    single_flight, start = SingleFlight(), Starter()
+    first, _ = single_flight.submit("a", start)
+    second, _ = single_flight.submit("b", start)
+    assert first is not second
+    assert single_flight.stats()["started"] == 2
+
+
+def test_a_finished_flight_is_forgotten():
+    single_flight, start = SingleFlight(), Starter()
+    future, _ = single_flight.submit("key", start)
+    future.set_result("image")
+    assert single_flight.stats()["in_flight"] == 0
+    again, joined = single_flight.submit("key", start)
+    assert not joined and again is not future
+
+
+def test_a_flight_is_cancelled_only_when_every_waiter_cancels():
+    single_flight, start = SingleFlight(), Starter()
+    tokens = [CancelToken(), CancelToken()]
+    for token in tokens:
+        single_flight.submit("key", start, cancel=token)
+    flight = start.flights[0]
+
+    tokens[0].cancel("disconnected")
+    assert not flight.cancelled
+    tokens[1].cancel()
+    assert flight.cancelled
+    assert flight.reason == "requested"
+
+
+def test_a_waiter_without_a_token_keeps_the_flight_alive():
+    single_flight, start = SingleFlight(), Starter()
+    token = CancelToken()
+    single_flight.submit("key", start, cancel=token)
+    single_flight.submit("key", start)
+    token.cancel()
+    assert not start.flights[0].cancelled
+
+
+def test_a_cancelled_flight_cannot_be_joined():
+    single_flight, start = SingleFlight(), Starter()
+    token = CancelToken()
+    first, _ = single_flight.submit("key", start, cancel=token)
+    token.cancel()
+    second, joined = single_flight.submit("key", start)
+    assert not joined and second is not first
+    assert len(start.flights) == 2
+    # The cancelled flight finishing doesn't forget its replacement
+    first.set_result(None)
+    assert single_flight.stats()["in_flight"] == 1
+
+
+def test_progress_and_previews_reach_every_waiter():
+    single_flight, start = SingleFlight(), Starter()
+    steps, previews, cancelled_preview = [], [RecordingPreview(), RecordingPreview()], RecordingPreview()
+    single_flight.submit("key", start, on_step=lambda step, total: steps.append(("first", step)), live_preview=previews[0], index=0)
+    single_flight.submit("key", start, on_step=lambda step, total: steps.append(("second", step)), live_preview=previews[1], index=2)
+    token = CancelToken()
+    single_flight.submit("key", start, live_preview=cancelled_preview, index=1, cancel=token)
+    token.cancel()
+
+    flight = start.flights[0]
+    flight.on_step(3, 10)
+    assert flight.due(3, 10)
+    flight.emit(3, 10, 0, "preview")
+    assert steps == [("first", 3), ("second", 3)]
+    assert previews[0].emitted == [(3, 0, "preview")]
+    assert previews[1].emitted == [(3, 2, "preview")]  # Under the waiter's own image index
+    assert cancelled_preview.emitted == []
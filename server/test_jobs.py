@@ -0,0 +1,110 @@
+"""Tests for jobs.py. Run with: python -m pytest server"""
+import threading
+import time
+
+import pytest
+
+from cancellation import CancelToken, GenerationCancelled
+from jobs import JobQueue, QueueFullError
+
+
+def wait_finished(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job.finished_at is None:
+        assert time.monotonic() < deadline, f"job still {job.status}"
+        time.sleep(0.01)
+    return job
+
+
+def test_a_job_runs_its_handler_and_keeps_the_result():
+    queue = JobQueue(workers=1)
+
+    def handler(job):
+        job.update_progress(4, 4)
+        return {"images": ["..."]}
+
+    job = wait_finished(queue.submit("txt2img", {"prompt": "cat"}, handler))
+    assert job.status == "done"
+    assert queue.get(job.id) is job
+    data = job.to_dict()
+    assert (data["type"], data["step"], data["total_steps"], data["result"]) == ("txt2img", 4, 4, {"images": ["..."]})
+    assert "result" not in job.to_dict(include_result=False)
+
+
+def test_a_failing_handler_fails_the_job():
+    job = wait_finished(JobQueue(workers=1).submit("txt2img", {}, lambda job: 1 / 0))
+    assert job.status == "failed"
+    assert "division by zero" in job.to_dict()["error"]
+
+
+def test_the_queue_refuses_jobs_past_max_queued():
+    queue = JobQueue(workers=1, max_queued=1)
+    release = threading.Event()
+    running = queue.submit("txt2img", {}, lambda job: release.wait(5))
+    while running.status != "running":
+        time.sleep(0.01)
+    queue.submit("txt2img", {}, lambda job: None)
+    with pytest.raises(QueueFullError):
+        queue.submit("txt2img", {}, lambda job: None)
+    assert queue.stats() == {"queued": 1, "running": 1, "workers": 1, "max_queued": 1}
+    release.set()
+
+
+def test_cancelling_a_queued_job_keeps_it_from_starting():
+    cancelled = []
+    queue = JobQueue(workers=1, on_cancel=lambda job, reason: cancelled.append((job.id, reason)))
+    release = threading.Event()
+    queue.submit("txt2img", {}, lambda job: release.wait(5))
+    started = []
+    job = queue.submit("txt2img", {}, lambda job: started.append(job))
+    assert queue.cancel(job.id) is job
+    release.set()
+    wait_finished(job)
+    assert (job.status, job.error, started) == ("cancelled", "Cancelled: requested", [])
+    assert cancelled == [(job.id, "requested")]
+
+
+def test_cancelling_a_running_job_stops_it_at_the_next_check():
+    queue = JobQueue(workers=1)
+    started = threading.Event()
+
+    def handler(job):
+        started.set()
+        while True:
+            job.cancel_token.check()
+            time.sleep(0.01)
+
+    job = queue.submit("txt2img", {}, handler)
+    started.wait(5)
+    queue.cancel(job.id)
+    assert wait_finished(job).status == "cancelled"
+
+
+def test_a_job_whose_deadline_passes_while_queued_never_starts():
+    queue = JobQueue(workers=1)
+    release = threading.Event()
+    queue.submit("txt2img", {}, lambda job: release.wait(5))
+    started = []
+    job = queue.submit("txt2img", {}, lambda job: started.append(job), CancelToken(timeout=0.01))
+    time.sleep(0.05)
+    release.set()
+    assert wait_finished(job).status == "cancelled"
+    assert started == []
+    assert job.error == "Cancelled: deadline"
+
+
+def test_the_handler_can_raise_generation_cancelled_itself():
+    def handler(job):
+        raise GenerationCancelled("disconnected")
+
+    job = wait_finished(JobQueue(workers=1).submit("txt2img", {}, handler))
+    assert (job.status, job.error) == ("cancelled", "Cancelled: disconnected")
+
+
+def test_finished_jobs_are_forgotten_after_the_ttl():
+    queue = JobQueue(workers=1, ttl=60)
+    job = wait_finished(queue.submit("txt2img", {}, lambda job: None))
+    job.finished_at -= 120
+    queue.submit("txt2img", {}, lambda job: None)  # Submitting prunes
+    assert queue.get(job.id) is None
+    assert queue.cancel(job.id) is None
@@ -0,0 +1,187 @@
+"""Tests for output_store.py. Run with: python -m pytest server"""
+import os
+import time
+
+import pytest
+
+from output_store import OutputStore, content_id
+
+EXTENSIONS = {"image/png": "png", "image/webp": "webp"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return OutputStore(str(tmp_path / "outputs"), EXTENSIONS)
+
+
+def files_in(store):
+    return sorted(name for _, _, names in os.walk(store.directory) for name in names
+                  if os.path.splitext(name)[1] in (".png", ".webp"))
+
+
+def set_last_access(store, table, value, where="1 = 1", values=()):
+    with store._lock, store._db:
+        store._db.execute(f"UPDATE {table} SET last_access = ? WHERE {where}", (value,) + tuple(values))
+
+
+def test_put_and_get_round_trip(store):
+    output_id = store.put(b"image", "image/webp", "txt2img", "comic", {"prompt": "a cat", "seed": 7})
+    assert output_id == content_id(b"image")
+    path, media_type = store.get(output_id)
+    assert media_type == "image/webp"
+    assert path == os.path.join(store.directory, "images", output_id[:2], output_id[2:4], f"{output_id}.webp")
+    with open(path, "rb") as f:
+        assert f.read() == b"image"
+
+    record = store.record(output_id)
+    assert (record["kind"], record["project"], record["prompt"], record["seed"]) == ("txt2img", "comic", "a cat", 7)
+    assert record["parameters"] == {"prompt": "a cat", "seed": 7}
+    assert "path" not in record
+
+
+def test_identical_images_share_one_file(store):
+    first = store.put(b"same", "image/png", "txt2img")
+    assert store.put(b"same", "image/png", "page") == first
+    assert store.record(first)["kind"] == "txt2img"  # The first record is kept
+    assert store.stats()["files"] == 1
+    assert len(files_in(store)) == 1
+
+
+def test_get_rejects_bad_ids_and_forgets_missing_files(store):
+    assert store.get("../index.sqlite3") == (None, None)
+    assert store.get("0" * 32) == (None, None)
+    output_id = store.put(b"image", "image/png")
+    os.remove(store.get(output_id)[0])
+    assert store.get(output_id) == (None, None)
+    assert store.record(output_id) is None
+
+
+def test_query_filters_and_time_range(store):
+    ids = [store.put(f"image {i}".encode(), "image/png", "txt2img", "comic" if i % 2 else "other",
+                     {"prompt": f"panel_{i} 100%"}) for i in range(4)]
+    with store._lock, store._db:
+        for i, output_id in enumerate(ids):
+            store._db.execute("UPDATE outputs SET created_at = ? WHERE id = ?", (1000 + i, output_id))
+
+    assert [record["id"] for record in store.query()] == ids[::-1]  # Newest first
+    assert [record["id"] for record in store.query(since=1001, until=1003)] == [ids[2], ids[1]]
+    assert [record["id"] for record in store.query(project="comic")] == [ids[3], ids[1]]
+    assert [record["id"] for record in store.query(limit=2, offset=1)] == [ids[2], ids[1]]
+    # LIKE wildcards in the prompt filter match literally
+    assert [record["id"] for record in store.query(prompt="panel_2")] == [ids[2]]
+    assert len(store.query(prompt="100%")) == 4
+    assert store.query(prompt="l%1") == []
+
+
+def test_gc_removes_outputs_past_max_age(store):
+    old = store.put(b"old", "image/png")
+    new = store.put(b"new", "image/png")
+    set_last_access(store, "outputs", time.time() - 100, "id = ?", (old,))
+    store.max_age = 50
+    assert store.gc()["removed"] == 1
+    assert store.get(old) == (None, None)
+    assert store.get(new)[0] is not None
+    assert len(files_in(store)) == 1
+
+
+def test_gc_removes_least_recently_used_past_max_bytes(store):
+    ids = [store.put(bytes([i]) * 100, "image/png") for i in range(3)]
+    for age, output_id in zip((30, 10, 20), ids):
+        set_last_access(store, "outputs", time.time() - age, "id = ?", (output_id,))
+    store.max_bytes = 150
+    result = store.gc()
+    assert (result["removed"], result["freed_bytes"]) == (2, 200)
+    assert [record["id"] for record in store.query()] == [ids[1]]
+
+
+def test_gc_keeps_an_output_used_after_it_was_selected(store):
+    output_id = store.put(b"image", "image/png")
+    set_last_access(store, "outputs", 1)
+    rows = store._db.execute("SELECT rowid, path, size, last_access FROM outputs").fetchall()
+    set_last_access(store, "outputs", time.time())  # Used by another request in between
+    assert store._delete("outputs", rows) == (0, 0)
+    assert store.get(output_id)[0] is not None
+
+
+def test_gc_sweeps_abandoned_temporary_files(store):
+    tmp = os.path.join(store.directory, "images", "ab", "abandoned.png.1.2.tmp")
+    os.makedirs(os.path.dirname(tmp))
+    open(tmp, "wb").close()
+    os.utime(tmp, (1, 1))
+    assert store.gc()["removed_tmp"] == 1
+    assert not os.path.exists(tmp)
+
+
+def test_import_flat_moves_old_files_dated_by_mtime(store, tmp_path):
+    flat = tmp_path / "flat"
+    flat.mkdir()
+    (flat / "old.png").write_bytes(b"old image")
+    (flat / "notes.txt").write_text("not an image")
+    os.utime(flat / "old.png", (1000, 1000))
+
+    assert store.import_flat(str(flat)) == 1
+    assert sorted(os.listdir(flat)) == ["notes.txt"]
+    record = store.record(content_id(b"old image"))
+    assert (record["created_at"], record["last_access"], record["media_type"]) == (1000, 1000, "image/png")
+    assert store.import_flat(str(flat)) == 0
+
+
+def test_cache_put_and_get(store):
+    assert store.cache_get("results", "key") is None
+    store.cache_put("results", "key", b"cached", ".png")
+    assert store.cache_get("results", "key") == b"cached"
+    assert store.cache_get("llm", "key") is None
+    assert store.cache_stats("results") == {"items": 1, "bytes": 6}
+
+
+def test_cache_budget_evicts_least_recently_used(store):
+    for i in range(3):
+        store.cache_put("results", f"key{i}", bytes([i]) * 100, ".png", last_access=1000 + i)
+    store.cache_get("results", "key0")  # Now the most recently used
+    store.cache_put("results", "key3", b"\x03" * 100, ".png", max_bytes=250)
+    assert [store.cache_get("results", f"key{i}") is not None for i in range(4)] == [True, False, False, True]
+    assert store.cache_stats("results") == {"items": 2, "bytes": 200}
+    assert len(files_in(store)) == 2
+
+
+def test_cache_and_outputs_share_a_file_until_both_are_gone(store):
+    store.cache_put("results", "key", b"image", ".png")
+    output_id = store.put(b"image", "image/png", "txt2img")
+    assert len(files_in(store)) == 1
+
+    store.max_age = 50
+    set_last_access(store, "cache_entries", 1)
+    store.gc()
+    assert store.cache_get("results", "key") is None
+    assert store.get(output_id)[0] is not None
+
+    set_last_access(store, "outputs", 1)
+    store.gc()
+    assert files_in(store) == []
+
+
+def test_cache_put_over_a_key_drops_the_old_file(store):
+    store.cache_put("llm", "key", b"first", ".json")
+    store.cache_put("llm", "key", b"second", ".json")
+    assert store.cache_get("llm", "key") == b"second"
+    assert store.cache_stats("llm") == {"items": 1, "bytes": 6}
+    assert len([name for _, _, names in os.walk(store.directory) for name in names if name.endswith(".json")]) == 1
+
+
+def test_import_flat_cache_moves_entries_and_removes_the_directory(store, tmp_path):
+    old = tmp_path / "result_cache"
+    old.mkdir()
+    (old / "abc.png").write_bytes(b"cached")
+    (old / "def.png.tmp").write_bytes(b"partial")
+    assert store.import_flat_cache("results", str(old)) == 1
+    assert not old.exists()
+    assert store.cache_get("results", "abc") == b"cached"
+    assert store.import_flat_cache("results", str(old)) == 0
+
+
+def test_stores_in_one_directory_see_each_others_writes(store):
+    other = OutputStore(store.directory, EXTENSIONS)
+    output_id = other.put(b"from another process", "image/png")
+    assert store.get(output_id)[0] is not None
+    other.cache_put("results", "key", b"cached", ".png")
+    assert store.cache_get("results", "key") == b"cached"
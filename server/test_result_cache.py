@@ -0,0 +1,50 @@
+"""Tests for result_cache.py. Run with: python -m pytest server"""
+import pytest
+
+from output_store import OutputStore
+from result_cache import ResultCache, make_cache_key
+
+
+@pytest.fixture
+def store(tmp_path):
+    return OutputStore(str(tmp_path / "outputs"), {"image/png": "png"})
+
+
+def test_make_cache_key_ignores_dict_order():
+    assert make_cache_key({"prompt": "cat", "seed": 1}) == make_cache_key({"seed": 1, "prompt": "cat"})
+    assert make_cache_key({"prompt": "cat", "seed": 1}) != make_cache_key({"prompt": "cat", "seed": 2})
+
+
+def test_get_falls_back_to_the_disk_tier(store):
+    ResultCache(store, "results").put("key", b"image")
+    fresh = ResultCache(store, "results")  # Another process, nothing in memory yet
+    assert fresh.stats()["memory_items"] == 0
+    assert fresh.get("key") == b"image"
+    assert fresh.stats() == {"memory_items": 1, "memory_bytes": 5, "disk_items": 1, "disk_bytes": 5}
+    assert fresh.get("missing") is None
+
+
+def test_memory_tier_evicts_least_recently_used(store):
+    cache = ResultCache(store, "results", max_memory_bytes=200)
+    for key in ("a", "b"):
+        cache.put(key, key.encode() * 100)
+    cache.get("a")
+    cache.put("c", b"c" * 100)
+    assert list(cache._memory) == ["a", "c"]
+    assert cache.stats()["memory_bytes"] == 200
+    assert cache.get("b") == b"b" * 100  # Still on disk
+
+
+def test_entries_larger_than_the_memory_budget_only_go_to_disk(store):
+    cache = ResultCache(store, "results", max_memory_bytes=10)
+    cache.put("key", b"x" * 100)
+    assert cache.stats()["memory_items"] == 0
+    assert cache.get("key") == b"x" * 100
+
+
+def test_disk_tier_keeps_to_its_budget(store):
+    cache = ResultCache(store, "results", max_memory_bytes=0, max_disk_bytes=250)
+    for key in ("a", "b", "c"):
+        cache.put(key, key.encode() * 100)
+    assert cache.stats()["disk_items"] == 2
+    assert cache.get("a") is None
@@ -0,0 +1,453 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# --- Configuration ---
+OLLAMA_URL = "http://127.0.0.1:11434"
+OLLAMA_MODELS = ["gemma:2b"]  # The client's default script model
+SD_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+SD_CACHE_DIR = os.path.join(SERVER_DIR, "cache")  # The server's default SD_CACHE_DIR, so it loads without downloading
+SD_PORT = 5000
+LOG_DIR = "bootstrap_logs"
+POLL_INTERVAL = 0.25  # Seconds between health checks
+PROGRESS_INTERVAL = 5  # Seconds between progress reports
+VERIFIED_NAME = ".bootstrap_verified.json"  # Blobs already checksummed, by size and mtime
+
+print_lock = threading.Lock()
+
+
+def log(message):
+    """Print from any thread without lines running into each other"""
+    with print_lock:
+        print(message, flush=True)
+
+
+class Timeline:
+    """When each bring-up step started and how long it took, for the timing breakdown"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []  # (name, start offset, seconds, outcome)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name):
+        """Time a step; the body can set ``outcome["value"]``, e.g. to "skipped"."""
+        start = time.perf_counter()
+        outcome = {"value": "ok"}
+        log(f"[{start - self.started:6.1f}s] {name}...")
+        try:
+            yield outcome
+        except Exception as e:
+            outcome["value"] = f"failed: {e}"
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.steps.append((name, start - self.started, seconds, outcome["value"]))
+            log(f"[{time.perf_counter() - self.started:6.1f}s] {name}: {outcome['value']} ({seconds:.1f}s)")
+
+    def report(self, width=30):
+        """Table of steps in start order, with a bar showing when each one ran"""
+        total = time.perf_counter() - self.started
+        lines = ["", "--- Bring-up timing ---"]
+        for name, offset, seconds, outcome in sorted(self.steps, key=lambda step: step[1]):
+            begin = int(offset / total * width) if total else 0
+            length = max(1, int(seconds / total * width)) if total else 1
+            bar = " " * begin + "#" * min(length, width - begin)
+            lines.append(f"{name:<32} {offset:7.1f}s {seconds:7.1f}s  |{bar:<{width}}|  {outcome}")
+        serial = sum(seconds for _, _, seconds, _ in self.steps)
+        lines.append(f"Total: {total:.1f}s (steps add up to {serial:.1f}s when run one after another)")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 2),
+            "steps": [{"name": name, "start": round(offset, 2), "seconds": round(seconds, 2), "outcome": outcome}
+                      for name, offset, seconds, outcome in self.steps]
+        }
+
+
+class Progress:
+    """Latest progress of every running download, printed every few seconds"""
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self._tasks = {}  # name -> (status, completed bytes, total bytes)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def update(self, name, status, completed=None, total=None):
+        with self._lock:
+            self._tasks[name] = (status, completed, total)
+
+    def finish(self, name):
+        with self._lock:
+            self._tasks.pop(name, None)
+
+    def lines(self):
+        with self._lock:
+            tasks = sorted(self._tasks.items())
+        lines = []
+        for name, (status, completed, total) in tasks:
+            if completed is not None and total:
+                lines.append(f"  {name}: {status} {completed / (1 << 20):.0f}/{total / (1 << 20):.0f}MB ({completed / total:.0%})")
+            elif completed is not None:
+                lines.append(f"  {name}: {status} {completed / (1 << 20):.0f}MB")
+            else:
+                lines.append(f"  {name}: {status}")
+        return lines
+
+    def start(self):
+        threading.Thread(target=self._loop, name="progress", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            lines = self.lines()
+            if lines:
+                log("\n".join(["Progress:"] + lines))
+
+
+def http_ok(url, timeout=2):
+    """True if ``url`` answers 200"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.status == 200
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def sd_model_ready(ready_url):
+    """True once the SD server's /ready answers 200; raises if the model failed to load"""
+    try:
+        with urllib.request.urlopen(ready_url, timeout=2) as response:
+            return response.status == 200
+    except urllib.error.HTTPError as e:
+        try:
+            status = json.load(e)
+        except ValueError:
+            return False
+        if status.get("phase") == "failed":
+            error = (status.get("error") or "unknown error").splitlines()[0]
+            raise RuntimeError(f"SD model failed to load: {error}")
+        return False
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def wait_until(check, timeout, process=None, interval=POLL_INTERVAL):
+    """Poll ``check()`` until it is true; returns False on timeout and raises if ``process`` exits first"""
+    deadline = time.monotonic() + timeout
+    while not check():
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"process exited with code {process.returncode}")
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+class Service:
+    """A background server that counts as up once ``health_url`` answers 200"""
+
+    def __init__(self, name, command, health_url, cwd=None, env=None, log_dir=LOG_DIR):
+        self.name = name
+        self.command = command
+        self.health_url = health_url
+        self.cwd = cwd
+        self.env = env
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self.process = None
+
+    def start(self):
+        """Launch the service unless one already answers; returns True if it was started"""
+        if http_ok(self.health_url):
+            return False
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with open(self.log_path, "ab") as log:
+            # A new session keeps the service running after this script (or the notebook cell) exits
+            self.process = subprocess.Popen(self.command, cwd=self.cwd, env=self.env, stdout=log,
+                                            stderr=subprocess.STDOUT, start_new_session=True)
+        return True
+
+    def wait(self, timeout, check=None):
+        """Poll ``check()`` (by default: the health URL answers 200) until it is true"""
+        check = check or (lambda: http_ok(self.health_url))
+        try:
+            up = wait_until(check, timeout, self.process)
+        except RuntimeError as e:
+            raise RuntimeError(f"{self.name}: {e}, see {self.log_path}")
+        if not up:
+            raise TimeoutError(f"{self.name} was not up within {timeout}s, see {self.log_path}")
+
+
+def ollama_model_name(model):
+    """Ollama's name for a model, which has ":latest" when no tag is given"""
+    return model if ":" in model else f"{model}:latest"
+
+
+def installed_ollama_models(ollama_url):
+    """Digest of every model Ollama already has, by name"""
+    with urllib.request.urlopen(f"{ollama_url}/api/tags", timeout=10) as response:
+        return {model["name"]: model.get("digest") for model in json.load(response).get("models", [])}
+
+
+def pull_ollama_model(ollama_url, model, progress):
+    """Pull ``model`` through Ollama's API, reporting its download progress"""
+    body = json.dumps({"model": model, "name": model, "stream": True}).encode("utf-8")
+    request = urllib.request.Request(f"{ollama_url}/api/pull", data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            for line in response:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if "error" in event:
+                    raise RuntimeError(f"pulling {model}: {event['error']}")
+                progress.update(f"ollama:{model}", event.get("status", ""), event.get("completed"), event.get("total"))
+    finally:
+        progress.finish(f"ollama:{model}")
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hf_repo_dir(cache_dir, model_id):
+    """Where the Hugging Face cache keeps ``model_id``"""
+    return os.path.join(cache_dir, "models--" + model_id.replace("/", "--"))
+
+
+def verify_hf_blobs(repo_dir):
+    """
+    Check the cached weight files against their sha256, which the Hugging Face
+    cache uses as their file name. Files that don't match are deleted so the
+    download fetches them again. Files checked on an earlier run with the same
+    size and mtime are not hashed again. Returns ``(checked, corrupt)``.
+    """
+    blobs_dir = os.path.join(repo_dir, "blobs")
+    state_path = os.path.join(repo_dir, VERIFIED_NAME)
+    try:
+        with open(state_path) as f:
+            verified = json.load(f)
+    except (OSError, ValueError):
+        verified = {}
+
+    checked, corrupt = 0, []
+    names = os.listdir(blobs_dir) if os.path.isdir(blobs_dir) else []
+    for name in names:
+        # Only large (LFS) files are named by their sha256; small ones by a git hash
+        if not re.fullmatch(r"[0-9a-f]{64}", name):
+            continue
+        path = os.path.join(blobs_dir, name)
+        stat = os.stat(path)
+        if verified.get(name) == [stat.st_size, stat.st_mtime]:
+            continue
+        checked += 1
+        if file_sha256(path) == name:
+            verified[name] = [stat.st_size, stat.st_mtime]
+        else:
+            corrupt.append(name)
+            verified.pop(name, None)
+            os.remove(path)
+
+    if names:
+        with open(state_path, "w") as f:
+            json.dump(verified, f)
+    return checked, corrupt
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def sd_model_cached(model_id, cache_dir):
+    """True if every file the pipeline loads is already in the cache"""
+    from diffusers import DiffusionPipeline
+    try:
+        DiffusionPipeline.download(model_id, cache_dir=cache_dir, local_files_only=True)
+        return True
+    except Exception:
+        return False
+
+
+def download_sd_model(model_id, cache_dir, progress, verify=True):
+    """
+    Fetch the files ``from_pretrained`` needs into the server's cache. Returns
+    "present" if nothing had to be downloaded, otherwise "downloaded".
+    """
+    repo_dir = hf_repo_dir(cache_dir, model_id)
+    if verify:
+        checked, corrupt = verify_hf_blobs(repo_dir)
+        if corrupt:
+            log(f"  {len(corrupt)} cached file(s) of {model_id} failed their checksum and will be downloaded again")
+    if sd_model_cached(model_id, cache_dir):
+        return "present"
+
+    from diffusers import DiffusionPipeline
+    name = f"sd:{model_id}"
+    done = threading.Event()
+
+    def report():
+        # huggingface_hub only reports progress through tqdm, so watch the cache grow instead
+        while not done.wait(1):
+            progress.update(name, "downloading", directory_bytes(repo_dir))
+
+    threading.Thread(target=report, daemon=True).start()
+    try:
+        DiffusionPipeline.download(model_id, cache_dir=cache_dir)
+    finally:
+        done.set()
+        progress.finish(name)
+    return "downloaded"
+
+
+def bootstrap(args):
+    """
+    Bring everything up as concurrently as the dependencies allow. Returns
+    ``(timeline, failures, tunnel)``; with ``--tunnel``, ``tunnel`` is the
+    localtunnel ``(process, url)`` once it has reported its URL, otherwise None.
+    """
+    timeline = Timeline()
+    progress = Progress()
+    progress.start()
+    env = dict(os.environ)
+    env.setdefault("SD_OLLAMA_URL", args.ollama_url)
+
+    ollama = Service("ollama", ["ollama", "serve"], f"{args.ollama_url}/api/version", env=env, log_dir=args.log_dir)
+    sd_env = dict(env, SD_API_PORT=str(args.sd_port), SD_BASE_MODEL_ID=args.sd_model, SD_CACHE_DIR=os.path.abspath(args.sd_cache_dir))
+    sd_server = Service("sd_server", [sys.executable, "app.py"], f"http://127.0.0.1:{args.sd_port}/health",
+                        cwd=SERVER_DIR, env=sd_env, log_dir=args.log_dir)
+
+    def bring_up_ollama():
+        with timeline.step("ollama: start") as outcome:
+            if not ollama.start():
+                outcome["value"] = "already running"
+        with timeline.step("ollama: healthy"):
+            ollama.wait(args.timeout)
+
+        installed = installed_ollama_models(args.ollama_url)
+        with ThreadPoolExecutor(max_workers=max(1, len(args.ollama_models))) as pool:
+            list(pool.map(lambda model: pull(model, installed), args.ollama_models))
+
+    def pull(model, installed):
+        with timeline.step(f"ollama: pull {model}") as outcome:
+            if ollama_model_name(model) in installed and not args.refresh:
+                outcome["value"] = f"skipped, present ({(installed[ollama_model_name(model)] or '')[:12]})"
+                return
+            pull_ollama_model(args.ollama_url, model, progress)
+
+    def bring_up_sd():
+        if not os.path.isdir(args.sd_model):  # A local pipeline directory needs no download
+            with timeline.step(f"sd: download {args.sd_model}") as outcome:
+                if download_sd_model(args.sd_model, args.sd_cache_dir, progress, verify=not args.no_verify) == "present":
+                    outcome["value"] = "skipped, present"
+        with timeline.step("sd: start server") as outcome:
+            if not sd_server.start():
+                outcome["value"] = "already running"
+        with timeline.step("sd: healthy"):
+            sd_server.wait(args.timeout)
+        if args.wait_ready:
+            with timeline.step("sd: model ready"):
+                sd_server.wait(args.timeout, lambda: sd_model_ready(f"http://127.0.0.1:{args.sd_port}/ready"))
+
+    tasks = []
+    if not args.no_ollama:
+        tasks.append(bring_up_ollama)
+    if not args.no_sd:
+        tasks.append(bring_up_sd)
+
+    failures = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as pool:
+            for future in [pool.submit(task) for task in tasks]:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append(str(e))
+    finally:
+        progress.stop()
+
+    tunnel = None
+    if args.tunnel and not args.no_sd and not failures:
+        from localtunnel_setup import open_tunnel
+        try:
+            with timeline.step("tunnel: start") as outcome:
+                tunnel = open_tunnel(args.sd_port, args.timeout)
+                outcome["value"] = tunnel[1]
+        except Exception as e:
+            failures.append(f"tunnel: {e}")
+
+    return timeline, failures, tunnel
+
+
+def keep_tunnel_open(tunnel):
+    """Block while the tunnel runs, since it closes with this process; Ctrl-C closes it. Returns lt's exit code."""
+    try:
+        return tunnel.wait()
+    except KeyboardInterrupt:
+        log("Closing the tunnel")
+        tunnel.terminate()
+        tunnel.wait()
+        return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start Ollama and the SD server, pulling and downloading models concurrently")
+    parser.add_argument("--ollama_url", default=OLLAMA_URL, help="Where Ollama listens")
+    parser.add_argument("--ollama_models", nargs="*", default=OLLAMA_MODELS, help="Ollama models to pull")
+    parser.add_argument("--sd_model", default=SD_MODEL_ID, help="Diffusion model the SD server loads (hub id or local directory)")
+    parser.add_argument("--sd_cache_dir", default=SD_CACHE_DIR, help="Hugging Face cache the SD server loads from")
+    parser.add_argument("--sd_port", type=int, default=SD_PORT, help="Port of the SD server")
+    parser.add_argument("--timeout", type=int, default=300, help="Seconds to wait for each service to answer")
+    parser.add_argument("--wait_ready", action="store_true", help="Also wait until the SD model is loaded and warmed up")
+    parser.add_argument("--refresh", action="store_true", help="Pull Ollama models even if they are present")
+    parser.add_argument("--no_verify", action="store_true", help="Don't checksum cached model files")
+    parser.add_argument("--no_ollama", action="store_true", help="Skip Ollama")
+    parser.add_argument("--no_sd", action="store_true", help="Skip the SD server")
+    parser.add_argument("--tunnel", action="store_true", help="Expose the SD server with localtunnel once it is up, and keep running while the tunnel is open")
+    parser.add_argument("--log_dir", default=LOG_DIR, help="Where service logs are written")
+    parser.add_argument("--report", help="Also write the timing breakdown to this JSON file")
+    args = parser.parse_args()
+
+    timeline, failures, tunnel = bootstrap(args)
+    print(timeline.report())
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(timeline.to_dict(), f, indent=2)
+    if failures:
+        print("Bring-up failed:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    if tunnel is not None:
+        process, url = tunnel
+        print(f"Service should be available at: {url}")
+        print("Keeping the tunnel open, press Ctrl-C (or stop the cell) to close it")
+        code = keep_tunnel_open(process)
+        if code:
+            print(f"The tunnel exited with code {code}")
+            sys.exit(1)
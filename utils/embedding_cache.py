@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of CLIP text embeddings keyed by the final prompt string.
+
+    Every prompt is wrapped in the same manga style prefix and nearly every
+    negative prompt is the same default, so re-running the text encoder for
+    them on each call is wasted work. Pass the returned tensors to the
+    pipeline as ``prompt_embeds`` / ``negative_prompt_embeds``.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, pipe, prompts, lora_scale=None, variant=None):
+        """
+        Return a (len(prompts), seq_len, dim) tensor of embeddings for the prompts.
+
+        ``variant`` is folded into the key and must change whenever the text
+        encoder weights do (e.g. when a different LoRA adapter is active).
+        """
+        keys = [(prompt, lora_scale, variant) for prompt in prompts]
+        # A prompt repeated within the batch is looked up (and encoded) once, so it counts once
+        unique_keys = list(dict.fromkeys(keys))
+
+        with self._lock:
+            found = {}
+            for key in unique_keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+            missing = [key for key in unique_keys if key not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            # Encode all misses in one text encoder pass, without classifier-free
+            # guidance so the negative side is cached as its own entry
+            with torch.no_grad():
+                embeds, _ = pipe.encode_prompt(
+                    [key[0] for key in missing],
+                    pipe.device,
+                    1,
+                    False,
+                    lora_scale=lora_scale
+                )
+            with self._lock:
+                for index, key in enumerate(missing):
+                    found[key] = embeds[index:index + 1].clone()
+                    self._entries[key] = found[key]
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return torch.cat([found[key] for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
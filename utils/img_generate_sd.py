@@ -1,100 +1,135 @@
 import torch
 import os
+import time
+import json
 import argparse
 from diffusers import AutoPipelineForText2Image
+from embedding_cache import PromptEmbeddingCache
+from snapshot import SNAPSHOT_DIR, file_sha256, read_manifest, snapshot_matches, load_snapshot
+from memory_profile import choose_profile, profile_dtype, place_pipeline, configure_for_resolution
 
 # --- Configuration ---
 # Update these paths to match your folder structure
+BASE_MODEL_ID = "runwayml/stable-diffusion-v1-5"  # Model the local copy was downloaded from (see setup_sd.py)
 BASE_MODEL_PATH = "../utils/local_base_model"  # Path to the downloaded base model
 LORA_PATH = "../models/weights"  # Path to LORA weights directory
 LORA_WEIGHT_FILENAME = "pytorch_lora_weights.safetensors"
+LORA_SCALE = 0.8
+MEMORY_PROFILE = "auto"  # auto, full, balanced or low (see memory_profile.py)
+MAX_RESOLUTION = 1024  # Largest panel side the memory profile must fit
 
 # --- Global Storage ---
 # This variable holds the model in memory so we don't reload it every time
 _pipeline = None
+_memory_profile = None
+# Text embeddings of the style prefix / negative suffix, reused across calls
+_embedding_cache = PromptEmbeddingCache()
 
-def load_model():
+def load_model(max_width=MAX_RESOLUTION, max_height=MAX_RESOLUTION):
     """
     Loads the model into the global '_pipeline' variable.
     Call this once when your Flask app starts.
     """
-    global _pipeline
+    global _pipeline, _memory_profile
 
     if _pipeline is not None:
         print("Model is already loaded. Skipping.")
         return
 
     print("--- Loading Model into Memory (One Time Setup) ---")
+    started = time.perf_counter()
+    lora_full_path = os.path.join(LORA_PATH, LORA_WEIGHT_FILENAME)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    profile = choose_profile(device, max_width, max_height, MEMORY_PROFILE)
+    print(f"Memory profile: {profile['name']} ({profile['dtype']}, {profile['available_mb']}MB available)")
+    dtype = profile_dtype(profile)
     try:
-        # 1. Load Base Model
-        pipe = AutoPipelineForText2Image.from_pretrained(
-            BASE_MODEL_PATH,
-            torch_dtype=torch.float16,
-            safety_checker=None,
-            local_files_only=True
-        )
+        lora_hash = file_sha256(lora_full_path)
+        if lora_hash and snapshot_matches(read_manifest(SNAPSHOT_DIR), BASE_MODEL_ID, lora_hash, LORA_SCALE, profile["dtype"]):
+            # Fast path: the LoRA is already fused into the snapshot built by setup_sd.py --snapshot
+            print(f"Loading fused snapshot from {SNAPSHOT_DIR}...")
+            pipe = load_snapshot(SNAPSHOT_DIR, dtype, safety_checker=None)  # Like the standard path below
+        else:
+            # 1. Load Base Model
+            pipe = AutoPipelineForText2Image.from_pretrained(
+                BASE_MODEL_PATH,
+                torch_dtype=dtype,
+                safety_checker=None,
+                local_files_only=True
+            )
+
+            # 2. Load LoRA
+            print(f"Loading LoRA weights from {LORA_PATH}...")
+            if lora_hash:
+                pipe.load_lora_weights(
+                    LORA_PATH,
+                    weight_name=LORA_WEIGHT_FILENAME,
+                    adapter_name="comic_style"
+                )
+                print(f"LoRA weights loaded successfully from {lora_full_path}")
+            else:
+                print(f"Warning: LoRA weights not found at {lora_full_path}")
+                print("Proceeding with base model only...")
 
-        # 2. Move to GPU
-        if torch.cuda.is_available():
-            pipe = pipe.to("cuda")
+        # 3. Move to GPU (or CPU) with the profile's memory optimisations
+        pipe = place_pipeline(pipe, profile)
+        if device == "cuda":
             print("Model moved to CUDA (GPU).")
         else:
-            pipe = pipe.to("cpu")
             print("Warning: Running on CPU.")
 
-        # 3. Load LoRA
-        print(f"Loading LoRA weights from {LORA_PATH}...")
-        lora_full_path = os.path.join(LORA_PATH, LORA_WEIGHT_FILENAME)
-        if os.path.exists(lora_full_path):
-            pipe.load_lora_weights(
-                LORA_PATH,
-                weight_name=LORA_WEIGHT_FILENAME,
-                adapter_name="comic_style"
-            )
-            print(f"LoRA weights loaded successfully from {lora_full_path}")
-        else:
-            print(f"Warning: LoRA weights not found at {lora_full_path}")
-            print("Proceeding with base model only...")
-
-        # Assign to global variable
+        # Assign to global variables
         _pipeline = pipe
-        print("Model successfully loaded and ready for requests!")
+        _memory_profile = profile
+        print(f"Model successfully loaded and ready for requests in {time.perf_counter() - started:.2f}s!")
 
     except Exception as e:
         print(f"CRITICAL ERROR loading model: {e}")
         raise e
 
-def generate_image(prompt, negative_prompt, output_filename, num_inference_steps=35, guidance_scale=7.5, width=512, height=768):
+def enhance_prompt(prompt):
+    # Enhance the prompt with specific Japanese manga style instructions
+    return f"Japanese manga style, {prompt}, highly detailed, black and white style, sharp lines, manga art style, professional quality, clean lines, detailed character design"
+
+def enhance_negative_prompt(negative_prompt):
+    # Enhanced negative prompt with manga-specific elements to avoid
+    return f"{negative_prompt}, color image, western cartoon style, low detail, blurry, deformed, ugly, anime screencap, digital art that looks like a screenshot"
+
+def generate_images(prompts, negative_prompt, num_inference_steps=35, guidance_scale=7.5, width=512, height=768):
     """
-    Generates an image using the pre-loaded model with specific Japanese manga style guidance.
+    Generates one image per prompt in a single batched pipeline call and returns the PIL images.
     """
     global _pipeline
 
     # Auto-load if it wasn't loaded manually (safety check)
     if _pipeline is None:
-        load_model()
+        load_model(width, height)
 
-    print(f"Processing Request: {prompt[:30]}...")
+    prompt_embeds = _embedding_cache.encode(_pipeline, [enhance_prompt(prompt) for prompt in prompts], lora_scale=LORA_SCALE)
+    negative_prompt_embeds = _embedding_cache.encode(_pipeline, [enhance_negative_prompt(negative_prompt)] * len(prompts), lora_scale=LORA_SCALE)
+    configure_for_resolution(_pipeline, _memory_profile, width, height)
 
-    # Enhance the prompt with specific Japanese manga style instructions
-    enhanced_prompt = f"Japanese manga style, {prompt}, highly detailed, black and white style, sharp lines, manga art style, professional quality, clean lines, detailed character design"
+    return _pipeline(
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        width=width,
+        height=height,
+        cross_attention_kwargs={"scale": LORA_SCALE}
+    ).images
 
-    # Enhanced negative prompt with manga-specific elements to avoid
-    enhanced_negative_prompt = f"{negative_prompt}, color image, western cartoon style, low detail, blurry, deformed, ugly, anime screencap, digital art that looks like a screenshot"
+def generate_image(prompt, negative_prompt, output_filename, num_inference_steps=35, guidance_scale=7.5, width=512, height=768):
+    """
+    Generates an image using the pre-loaded model with specific Japanese manga style guidance.
+    """
+    print(f"Processing Request: {prompt[:30]}...")
 
     try:
-        image = _pipeline(
-            prompt=enhanced_prompt,
-            negative_prompt=enhanced_negative_prompt,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            width=width,
-            height=height,
-            cross_attention_kwargs={"scale": 0.8}
-        ).images[0]
+        image = generate_images([prompt], negative_prompt, num_inference_steps, guidance_scale, width, height)[0]
 
         # Ensure directory exists
-        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        os.makedirs(os.path.dirname(output_filename) or ".", exist_ok=True)
 
         image.save(output_filename)
         print(f"Saved: {output_filename}")
@@ -104,33 +139,195 @@ def generate_image(prompt, negative_prompt, output_filename, num_inference_steps
         print(f"Error generating image: {e}")
         return False
 
+def load_script(script_path):
+    """
+    Reads a comic script and returns its pages.
+    Accepts a JSON list of pages, a JSON object with a "pages" list (a saved
+    ComicProject), or JSONL with one page per line. Pages follow ComicPage in
+    client/types.ts: {"pageNumber": 1, "scenes": [{"id": ..., "imagePrompt": ...}]}.
+    """
+    with open(script_path) as f:
+        if script_path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        script = json.load(f)
+    return script["pages"] if isinstance(script, dict) else script
+
+def save_atomically(image, output_filename):
+    """Write to a temporary file and rename it, so an interrupted run never leaves a partial panel behind"""
+    tmp_filename = f"{output_filename}.tmp.png"
+    image.save(tmp_filename)
+    os.replace(tmp_filename, output_filename)
+
+def read_render_manifest(manifest_path):
+    """
+    Panels (by output path) and runs of the manifest an earlier run wrote,
+    or empty ones if there is none.
+    """
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}, []
+    panels = {panel["output"]: panel for panel in manifest.get("panels", []) if "output" in panel}
+    runs = manifest.get("runs")
+    if runs is None and "total_seconds" in manifest:
+        # Written before runs were listed: its totals are the one earlier run
+        runs = [{"load_seconds": manifest.get("load_seconds"), "total_seconds": manifest["total_seconds"]}]
+    return panels, runs or []
+
+def render_script(script_path, output_dir, negative_prompt, num_inference_steps=35, guidance_scale=7.5,
+                  width=512, height=768, batch_size=4):
+    """
+    Renders every panel of a comic script with the model loaded once.
+    Panels are grouped by size and rendered in batches of `batch_size`.
+    Panels whose output file already exists are skipped, so an interrupted
+    run can be resumed. A manifest.json with per-panel timings is written to
+    `output_dir` after every batch; on a resumed run, skipped panels keep the
+    entries of the earlier manifest and every run's totals are listed in "runs".
+    """
+    started = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    earlier_panels, earlier_runs = read_render_manifest(manifest_path)
+
+    # Collect panels, grouped by size
+    panels = []
+    for page_index, page in enumerate(load_script(script_path)):
+        page_number = page.get("pageNumber", page_index + 1)
+        page_label = str(page_number).zfill(3)  # Scripts from an LLM may give "1" rather than 1
+        for scene_index, scene in enumerate(page.get("scenes", [])):
+            scene_id = scene.get("id") or f"scene{scene_index + 1}"
+            panels.append({
+                "page": page_number,
+                "scene": scene_id,
+                "prompt": scene.get("imagePrompt") or scene.get("prompt", ""),
+                "width": scene.get("width", width),
+                "height": scene.get("height", height),
+                "output": os.path.join(output_dir, f"page{page_label}_{scene_id}.png")
+            })
+
+    todo = []
+    for panel in panels:
+        if os.path.exists(panel["output"]):
+            earlier = earlier_panels.get(panel["output"], {})
+            if earlier.get("status") == "generated":
+                # Keep the timing of the run that rendered it
+                panel.update({key: earlier[key] for key in ("status", "seconds") if key in earlier})
+            else:
+                panel["status"] = "skipped"
+        else:
+            todo.append(panel)
+    print(f"{len(panels)} panels in script, {len(panels) - len(todo)} already rendered, {len(todo)} to render")
+
+    groups = {}
+    for panel in todo:
+        groups.setdefault((panel["width"], panel["height"]), []).append(panel)
+
+    load_started = time.perf_counter()
+    if todo:
+        # Size the memory profile for the largest panel in the script
+        load_model(max(panel["width"] for panel in todo), max(panel["height"] for panel in todo))
+    load_seconds = time.perf_counter() - load_started
+
+    def write_manifest():
+        run = {
+            "load_seconds": round(load_seconds, 2),
+            "total_seconds": round(time.perf_counter() - started, 2),
+            "attempted": len(todo)
+        }
+        with open(manifest_path, "w") as f:
+            json.dump({
+                "script": script_path,
+                "steps": num_inference_steps,
+                "cfg_scale": guidance_scale,
+                "batch_size": batch_size,
+                "load_seconds": run["load_seconds"],
+                "total_seconds": run["total_seconds"],
+                "runs": earlier_runs + [run],
+                "panels": panels
+            }, f, indent=2)
+
+    for (group_width, group_height), group in groups.items():
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start + batch_size]
+            print(f"Rendering {len(batch)} panel(s) at {group_width}x{group_height}...")
+            batch_started = time.perf_counter()
+            try:
+                images = generate_images(
+                    [panel["prompt"] for panel in batch],
+                    negative_prompt,
+                    num_inference_steps,
+                    guidance_scale,
+                    group_width,
+                    group_height
+                )
+                seconds = (time.perf_counter() - batch_started) / len(batch)
+                for panel, image in zip(batch, images):
+                    save_atomically(image, panel["output"])
+                    panel["status"] = "generated"
+                    panel["seconds"] = round(seconds, 2)
+                    print(f"Saved: {panel['output']}")
+            except Exception as e:
+                print(f"Error rendering batch: {e}")
+                for panel in batch:
+                    panel["status"] = "failed"
+                    panel["error"] = str(e)
+            write_manifest()
+
+    write_manifest()
+    failed = sum(1 for panel in panels if panel["status"] == "failed")
+    print(f"Done in {time.perf_counter() - started:.2f}s (model load {load_seconds:.2f}s), manifest: {manifest_path}")
+    return failed == 0
+
 # --- Command Line Interface ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate images from text prompts using Stable Diffusion")
-    parser.add_argument("--prompt", type=str, required=True, help="The main prompt for image generation")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--prompt", type=str, help="The main prompt for image generation")
+    source.add_argument("--script", type=str, help="Comic script (JSON or JSONL pages of scenes) to render in batch mode")
     parser.add_argument("--negative_prompt", type=str, default="bad quality, blurry, deformed, ugly", help="Negative prompt to avoid certain features")
-    parser.add_argument("--output", type=str, required=True, help="Output filename")
+    parser.add_argument("--output", type=str, help="Output filename (single prompt mode)")
+    parser.add_argument("--output_dir", type=str, default="panels", help="Output directory (batch mode, default: panels)")
+    parser.add_argument("--batch_size", type=int, default=4, help="Panels per pipeline call in batch mode (default: 4)")
     parser.add_argument("--steps", type=int, default=35, help="Number of inference steps (default: 35)")
     parser.add_argument("--cfg_scale", type=float, default=7.5, help="Guidance scale (default: 7.5)")
     parser.add_argument("--width", type=int, default=512, help="Width of the output image")
     parser.add_argument("--height", type=int, default=768, help="Height of the output image")
+    parser.add_argument("--memory_profile", choices=["auto", "full", "balanced", "low"], default=MEMORY_PROFILE,
+                        help="Memory optimisations: auto picks from free RAM and panel size (default: auto)")
 
     args = parser.parse_args()
+    MEMORY_PROFILE = args.memory_profile
 
-    # Load model and generate image
-    load_model()
-    success = generate_image(
-        prompt=args.prompt,
-        negative_prompt=args.negative_prompt,
-        output_filename=args.output,
-        num_inference_steps=args.steps,
-        guidance_scale=args.cfg_scale,
-        width=args.width,
-        height=args.height
-    )
+    if args.script:
+        success = render_script(
+            args.script,
+            args.output_dir,
+            negative_prompt=args.negative_prompt,
+            num_inference_steps=args.steps,
+            guidance_scale=args.cfg_scale,
+            width=args.width,
+            height=args.height,
+            batch_size=args.batch_size
+        )
+    else:
+        if not args.output:
+            parser.error("--output is required with --prompt")
+
+        # Load model and generate image
+        load_model(args.width, args.height)
+        success = generate_image(
+            prompt=args.prompt,
+            negative_prompt=args.negative_prompt,
+            output_filename=args.output,
+            num_inference_steps=args.steps,
+            guidance_scale=args.cfg_scale,
+            width=args.width,
+            height=args.height
+        )
 
     if success:
         print("Image generation completed successfully!")
     else:
         print("Image generation failed!")
-        exit(1)
\ No newline at end of file
+        exit(1)
@@ -2,6 +2,8 @@ import subprocess
 import time
 import threading
 import os
+import urllib.request
+import urllib.error
 
 def install_localtunnel():
     """
@@ -52,10 +54,11 @@ def create_tunnel_with_callback(port=5000, on_url_ready=None):
         import re
         
         cmd = ['lt', '--port', str(port)]
+        # lt prints the URL on stdout and errors on stderr, so read both
         process = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             text=True,
             bufsize=1,
             universal_newlines=True
@@ -64,7 +67,7 @@ def create_tunnel_with_callback(port=5000, on_url_ready=None):
         # Wait for the URL to appear in the output
         url_line = None
         while True:
-            output = process.stderr.readline()
+            output = process.stdout.readline()
             if output == '' and process.poll() is not None:
                 break
             if output:
@@ -82,6 +85,55 @@ def create_tunnel_with_callback(port=5000, on_url_ready=None):
     print(f"LocalTunnel thread started for port {port}")
     return tunnel_thread
 
+def open_tunnel(port=5000, timeout=60):
+    """
+    Start localtunnel for `port` and wait until it reports its public URL.
+    Returns (process, url); the tunnel lives as long as the process does.
+    Raises RuntimeError if lt exits first and TimeoutError after `timeout` seconds.
+    """
+    # lt prints the URL on stdout and errors on stderr, so read both
+    process = subprocess.Popen(['lt', '--port', str(port)], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True, bufsize=1)
+    found = {}
+    reported = threading.Event()
+
+    def read_output():
+        # Keeps draining the pipe after the URL, so lt never blocks on a full buffer
+        for line in process.stdout:
+            if 'your url is:' in line.lower() and 'url' not in found:
+                found['url'] = line.split(':', 1)[1].strip()
+                reported.set()
+            elif line.strip():
+                print(f"lt: {line.strip()}")
+        reported.set()
+
+    threading.Thread(target=read_output, name="localtunnel", daemon=True).start()
+    if not reported.wait(timeout):
+        process.terminate()
+        raise TimeoutError(f"localtunnel reported no URL within {timeout}s")
+    if 'url' not in found:
+        raise RuntimeError(f"localtunnel exited with code {process.wait()} before reporting a URL")
+    return process, found['url']
+
+def wait_for_backend(port=5000, path="/health", timeout=120):
+    """
+    Poll the backend until it answers on `path`.
+    The server binds before the model finishes loading, so /health answers
+    right away and reports the load phase; use path="/ready" to also wait
+    for the model.
+    """
+    url = f"http://127.0.0.1:{port}{path}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    return False
+
 def setup_local_backend_with_tunnel(port=5000, backend_start_cmd=['python', 'app.py']):
     """
     Complete setup for backend with localtunnel exposure.
@@ -96,8 +148,9 @@ def setup_local_backend_with_tunnel(port=5000, backend_start_cmd=['python', 'app
     print(f"Starting backend service on port {port}...")
     backend_process = subprocess.Popen(backend_start_cmd)
     
-    # Wait a moment for the backend to start
-    time.sleep(3)
+    # Wait for the backend to bind (the model keeps loading in the background)
+    if not wait_for_backend(port):
+        print(f"Backend did not answer on port {port}, starting the tunnel anyway")
     
     # Start localtunnel to expose the service
     tunnel_thread = create_tunnel_with_callback(port, 
@@ -0,0 +1,151 @@
+import os
+
+import torch
+
+# Approximate weight sizes of a Stable Diffusion 1.5 pipeline (UNet + text encoder + VAE) in MB at 4 bytes/param
+SD15_WEIGHTS_MB_FP32 = 4300
+
+# Profiles from least to most memory saving
+PROFILES = {
+    "full": {"attention_slicing": False, "vae_slicing": False, "vae_tiling": False, "sequential_offload": False},
+    "balanced": {"attention_slicing": True, "vae_slicing": True, "vae_tiling": False, "sequential_offload": False},
+    "low": {"attention_slicing": True, "vae_slicing": True, "vae_tiling": True, "sequential_offload": True}
+}
+
+# Panels with more pixels than this get VAE tiling for the decode, unless the profile is "full"
+VAE_TILING_PIXELS = 768 * 768
+
+
+def available_memory_mb(device):
+    """Free memory on the device the pipeline will run on, in MB"""
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return free / (1 << 20)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Fallback: total physical memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1 << 20)
+
+
+def cpu_supports_bf16():
+    """True when the CPU has native bfloat16 support (AVX512-BF16 or AMX)"""
+    for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        if getattr(torch.cpu, check, lambda: False)():
+            return True
+    return False
+
+
+def sdpa_available():
+    """PyTorch 2's scaled_dot_product_attention never materialises the full score matrix"""
+    return hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
+
+def estimate_memory_mb(width, height, dtype_bytes, attention_slicing, vae_tiling):
+    """
+    Rough peak memory of one classifier-free-guided generation at this size.
+    Counts the weights, the largest self-attention score matrix (latent
+    tokens squared, for 8 heads and both CFG halves, or one head at a time
+    when sliced) and the VAE decoder's full-resolution activations.
+    """
+    weights = SD15_WEIGHTS_MB_FP32 * dtype_bytes / 4
+    tokens = (width // 8) * (height // 8)
+    heads = 1 if attention_slicing else 8
+    attention = tokens * tokens * heads * 2 * dtype_bytes / (1 << 20)
+    decode_pixels = min(width * height, 512 * 512) if vae_tiling else width * height
+    vae = decode_pixels * 128 * 3 * dtype_bytes / (1 << 20)
+    return weights + attention + vae
+
+
+def choose_dtype(device, allow_bf16=True):
+    """Name of the dtype weights are served in on ``device``"""
+    if device == "cuda":
+        return "float16"
+    if allow_bf16 and cpu_supports_bf16():
+        return "bfloat16"
+    return "float32"
+
+
+def choose_profile(device, max_width, max_height, requested="auto", allow_bf16=True, available_mb=None):
+    """
+    Pick dtype and memory optimisations for the largest panel we expect to serve.
+
+    ``requested`` may name a profile ("full", "balanced", "low") to skip
+    the automatic choice. Returns a dict describing the choice.
+    """
+    dtype = choose_dtype(device, allow_bf16)
+    dtype_bytes = 4 if dtype == "float32" else 2
+    # With SDPA attention is already computed in chunks; slicing would swap it for a slower, hungrier kernel
+    sdpa = sdpa_available()
+
+    if available_mb is None:
+        available_mb = available_memory_mb(device)
+    budget_mb = available_mb * 0.8  # Leave headroom for the server itself and the allocator
+
+    if requested in PROFILES:
+        name = requested
+    else:
+        name = "low"
+        for candidate in ("full", "balanced"):
+            flags = PROFILES[candidate]
+            needed = estimate_memory_mb(max_width, max_height, dtype_bytes, flags["attention_slicing"] or sdpa, flags["vae_tiling"])
+            if needed <= budget_mb:
+                name = candidate
+                break
+
+    profile = dict(PROFILES[name])
+    # Offloading only helps when the weights live on a GPU
+    profile["sequential_offload"] = profile["sequential_offload"] and device == "cuda"
+    profile["attention_slicing"] = profile["attention_slicing"] and not sdpa
+    profile.update({
+        "name": name,
+        "attention": "sdpa" if sdpa else ("sliced" if profile["attention_slicing"] else "default"),
+        "device": device,
+        "dtype": dtype,
+        # oneDNN convolutions are faster on NHWC tensors
+        "channels_last": device == "cpu",
+        "max_resolution": [max_width, max_height],
+        "available_mb": round(available_mb),
+        "estimated_mb": round(estimate_memory_mb(
+            max_width, max_height, dtype_bytes, profile["attention_slicing"] or sdpa, profile["vae_tiling"]
+        ))
+    })
+    return profile
+
+
+def profile_dtype(profile):
+    """The torch dtype the profile loads weights in"""
+    return getattr(torch, profile["dtype"])
+
+
+def place_pipeline(pipe, profile):
+    """Move the pipeline to its device (or set up offloading) and apply the profile's optimisations"""
+    if profile["sequential_offload"]:
+        # Weights stay in CPU RAM and are streamed to the GPU layer by layer
+        pipe.enable_sequential_cpu_offload()
+    else:
+        pipe = pipe.to(profile["device"])
+
+    if profile["attention_slicing"]:
+        pipe.enable_attention_slicing("max" if profile["name"] == "low" else "auto")
+    if profile["vae_slicing"]:
+        pipe.vae.enable_slicing()
+    if profile["vae_tiling"]:
+        pipe.vae.enable_tiling()
+    if profile["channels_last"]:
+        pipe.unet.to(memory_format=torch.channels_last)
+    return pipe
+
+
+def configure_for_resolution(pipe, profile, width, height):
+    """Turn VAE tiling on for large panels and back off for small ones (profiles other than "full")"""
+    if profile["name"] == "full" or profile["vae_tiling"]:
+        return
+    if width * height > VAE_TILING_PIXELS:
+        pipe.vae.enable_tiling()
+    else:
+        pipe.vae.disable_tiling()
@@ -1,7 +1,12 @@
 import subprocess
 import threading
-import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bootstrap import (OLLAMA_URL, Progress, http_ok, installed_ollama_models, ollama_model_name,
+                       pull_ollama_model, wait_until)
+
+OLLAMA_START_TIMEOUT = 60  # Seconds to wait for `ollama serve` to answer
 
 def install_ollama():
     """
@@ -37,23 +42,28 @@ def install_ollama():
     return True
 
 
+def ollama_running():
+    """True if an Ollama server answers on OLLAMA_URL"""
+    return http_ok(f"{OLLAMA_URL}/api/version")
+
+
 def start_ollama_server_nohup():
     """
     Start the Ollama server in the background using nohup for better persistence.
-    Returns True if successful.
+    Returns True once it answers, without starting a second one if it is already running.
     """
+    if ollama_running():
+        print("Ollama server is already running")
+        return True
+
     print("Starting Ollama server in background with nohup...")
-    
     # Use nohup to ensure the process continues running even if the session disconnects
-    result = subprocess.run(['nohup', 'ollama', 'serve', '>', 'ollama.log', '2>&1', '&'], 
-                            shell=True, capture_output=True, text=True)
-    
-    # Alternative approach that's more reliable in Colab
-    import os
     os.system("nohup ollama serve > ollama.log 2>&1 &")
-    
-    # Wait for the server to start
-    time.sleep(5)
+
+    # Poll until the server answers instead of sleeping a fixed time
+    if not wait_until(ollama_running, OLLAMA_START_TIMEOUT):
+        print(f"Ollama server did not answer within {OLLAMA_START_TIMEOUT}s, check: !cat ollama.log")
+        return False
     print("Ollama server started with nohup!")
     print("Check status with: !cat ollama.log")
     
@@ -72,9 +82,11 @@ def start_ollama_server():
                                       stderr=subprocess.DEVNULL,
                                       preexec_fn=os.setsid)
     
-    # Wait for the server to start
-    time.sleep(5)
-    print("Ollama server started!")
+    # Wait for the server to answer (raises if it exits first)
+    if not wait_until(ollama_running, OLLAMA_START_TIMEOUT, ollama_process):
+        print(f"Ollama server did not answer within {OLLAMA_START_TIMEOUT}s")
+    else:
+        print("Ollama server started!")
     
     return ollama_process
 
@@ -112,17 +124,35 @@ def pull_models_background(model_list):
     print("All model pulls completed!")
 
 
-def pull_models_nohup(model_list):
+def pull_models(model_list, ollama_url=OLLAMA_URL):
     """
-    Pull multiple models using nohup for better background execution.
+    Pull models concurrently through the running server's API, printing their
+    progress, and wait for all of them. Models already present are skipped.
+    Returns the models that failed to pull.
     """
-    for model in model_list:
-        print(f"Starting to pull {model} with nohup...")
-        # Run each pull in background using nohup
-        os.system(f"nohup ollama pull {model} > pull_{model}.log 2>&1 &")
-        print(f"Pulling {model} started in background, logs in pull_{model}.log")
-        
-    print("All model pulls started with nohup!")
+    installed = installed_ollama_models(ollama_url)
+    progress = Progress()
+    progress.start()
+    failed = []
+
+    def pull(model):
+        if ollama_model_name(model) in installed:
+            print(f"{model} is already pulled")
+            return
+        try:
+            pull_ollama_model(ollama_url, model, progress)
+            print(f"Successfully pulled model: {model}")
+        except Exception as e:
+            print(f"Error pulling model {model}: {e}")
+            failed.append(model)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(model_list))) as pool:
+            list(pool.map(pull, model_list))
+    finally:
+        progress.stop()
+    print("All model pulls completed!" if not failed else f"Failed to pull: {', '.join(failed)}")
+    return failed
 
 
 def setup_ollama_with_models(model_list=['llama3', 'mistral'], use_nohup=True):
@@ -135,25 +165,20 @@ def setup_ollama_with_models(model_list=['llama3', 'mistral'], use_nohup=True):
         return None
 
     # Start Ollama server
+    ollama_process = "nohup"  # Indicates that it's running via nohup
     if use_nohup:
-        success = start_ollama_server_nohup()
-        if not success:
+        if not start_ollama_server_nohup():
             print("Failed to start Ollama with nohup, trying subprocess method...")
             ollama_process = start_ollama_server()
-        else:
-            print("Ollama server running with nohup!")
-            return "nohup"  # Indicate that it's running via nohup
     else:
         ollama_process = start_ollama_server()
-    
-    # Pull models in background
-    if use_nohup:
-        pull_models_nohup(model_list)
+
+    # Pull models concurrently and wait until they are all there
+    if pull_models(model_list):
+        print("Ollama setup finished, but some models are missing.")
     else:
-        pull_models_background(model_list)
-    
-    print("Ollama setup complete with all models!")
-    return ollama_process if not use_nohup else "nohup"
+        print("Ollama setup complete with all models!")
+    return ollama_process
 
 
 if __name__ == "__main__":
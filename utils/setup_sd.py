@@ -1,11 +1,19 @@
 import torch
 from diffusers import AutoPipelineForText2Image
+import argparse
+import time
 import os
 
+from snapshot import SNAPSHOT_DIR, build_snapshot, load_snapshot
+from memory_profile import choose_dtype
+
 # --- Configuration ---
 BASE_MODEL_ID = "runwayml/stable-diffusion-v1-5"
 LOCAL_MODEL_DIR = "../utils/local_base_model"  # Where we will save the model
 LORA_MODEL_DIR = "../models/weights"  # Directory for LORA weights
+LORA_WEIGHT_FILENAME = "pytorch_lora_weights.safetensors"
+LORA_SCALE = 0.8  # Scale the LORA is fused at, must match the generators
+SERVER_CACHE_DIR = "../server/cache"  # The server's default SD_CACHE_DIR
 
 def setup():
     print(f"--- Starting Model Setup ---")
@@ -18,7 +26,7 @@ def setup():
     os.makedirs(LORA_MODEL_DIR, exist_ok=True)
     
     # Check if LORA weights exist
-    lora_weight_path = os.path.join(LORA_MODEL_DIR, "pytorch_lora_weights.safetensors")
+    lora_weight_path = os.path.join(LORA_MODEL_DIR, LORA_WEIGHT_FILENAME)
     if os.path.exists(lora_weight_path):
         print(f"✓ LORA weights found at: {lora_weight_path}")
     else:
@@ -55,5 +63,68 @@ def setup():
     print(f"LORA weights location: {LORA_MODEL_DIR}")
     print(f"You can now run the generator scripts and they will use the local models.")
 
+def snapshot():
+    """
+    Compile once: fuse the comic_style LORA into the base model and save a
+    ready-to-serve snapshot that the generators load without any LORA work.
+    """
+    # Built from the model the server loads, with its safety checker (the
+    # local copy has none), in the dtype this machine serves in
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = choose_dtype(device, os.getenv("SD_CPU_BF16", "1") == "1")
+    print(f"--- Building Fused Snapshot ---")
+    print(f"LORA scale: {LORA_SCALE}")
+    print(f"dtype: {dtype}")
+    print(f"Snapshot path: {SNAPSHOT_DIR}")
+    try:
+        manifest = build_snapshot(
+            BASE_MODEL_ID,
+            BASE_MODEL_ID,
+            LORA_MODEL_DIR,
+            LORA_WEIGHT_FILENAME,
+            LORA_SCALE,
+            SNAPSHOT_DIR,
+            torch_dtype=getattr(torch, dtype),
+            cache_dir=SERVER_CACHE_DIR
+        )
+    except Exception as e:
+        print(f"Error building snapshot: {e}")
+        return False
+
+    print(f"✓ Snapshot built in {manifest['build_seconds']}s")
+    return True
+
+def compare_startup():
+    """Time the current startup path against the snapshot fast path"""
+    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    print("--- Comparing Startup Time ---")
+    started = time.perf_counter()
+    pipe = AutoPipelineForText2Image.from_pretrained(LOCAL_MODEL_DIR, torch_dtype=torch_dtype, safety_checker=None, local_files_only=True)
+    pipe.load_lora_weights(LORA_MODEL_DIR, weight_name=LORA_WEIGHT_FILENAME, adapter_name="comic_style")
+    pipe.to(device)
+    standard_seconds = time.perf_counter() - started
+    del pipe
+
+    started = time.perf_counter()
+    pipe = load_snapshot(SNAPSHOT_DIR, torch_dtype)
+    pipe.to(device)
+    snapshot_seconds = time.perf_counter() - started
+    del pipe
+
+    print(f"Standard (from_pretrained + load_lora_weights): {standard_seconds:.2f}s")
+    print(f"Fused snapshot:                                 {snapshot_seconds:.2f}s")
+    print(f"Speedup: {standard_seconds / snapshot_seconds:.1f}x")
+
 if __name__ == "__main__":
-    setup()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download the base model and optionally build the fused LORA snapshot")
+    parser.add_argument("--snapshot", action="store_true", help="Fuse the LORA into the base model and save a ready-to-serve snapshot")
+    parser.add_argument("--compare", action="store_true", help="Report startup time of the standard path against the snapshot")
+    args = parser.parse_args()
+
+    setup()
+    if args.snapshot and not snapshot():
+        exit(1)
+    if args.compare:
+        compare_startup()
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import time
+
+import torch
+import diffusers
+from diffusers import AutoPipelineForText2Image
+
+# --- Configuration ---
+SNAPSHOT_DIR = "../utils/fused_snapshot"  # Where the fused, ready-to-serve pipeline is written
+MANIFEST_NAME = "snapshot_manifest.json"
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Return the sha256 of a file, or None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(snapshot_dir):
+    """Return the snapshot manifest, or None if there is no snapshot"""
+    manifest_path = os.path.join(snapshot_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def build_snapshot(source, base_model, lora_dir, lora_weight_name, lora_scale, snapshot_dir,
+                   torch_dtype=torch.float16, **from_pretrained_kwargs):
+    """
+    Fuse the LoRA into the UNet/text encoder weights and save the result as safetensors.
+
+    ``source`` is where the base model is loaded from (a local copy or a hub
+    id) and ``base_model`` is the model id recorded in the manifest. The
+    model is loaded in float32 so the fusion happens at full precision, then
+    cast to ``torch_dtype`` for saving; build it in the dtype it will be
+    served in, since loading casts again. All of the model's components are
+    kept, including its safety checker, so the snapshot produces what the
+    standard load path does. The manifest records the inputs so loaders can
+    tell whether the snapshot is still current. Returns the manifest.
+    """
+    started = time.perf_counter()
+    lora_path = os.path.join(lora_dir, lora_weight_name)
+    if not os.path.exists(lora_path):
+        raise FileNotFoundError(f"LoRA weights not found at {lora_path}")
+    if "safety_checker" in from_pretrained_kwargs:
+        raise ValueError("The snapshot keeps the model's own safety checker; it can't be replaced")
+
+    pipe = AutoPipelineForText2Image.from_pretrained(source, torch_dtype=torch.float32, **from_pretrained_kwargs)
+    pipe.load_lora_weights(lora_dir, weight_name=lora_weight_name, adapter_name="comic_style")
+    pipe.fuse_lora(lora_scale=lora_scale)
+    pipe.unload_lora_weights()  # Drop the adapter layers, the fused weights stay
+    pipe.to(torch_dtype)
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    pipe.save_pretrained(snapshot_dir, safe_serialization=True)
+
+    manifest = {
+        "base_model": base_model,
+        "lora_file": lora_weight_name,
+        "lora_sha256": file_sha256(lora_path),
+        "lora_scale": lora_scale,
+        "dtype": str(torch_dtype).replace("torch.", ""),
+        "safety_checker": getattr(pipe, "safety_checker", None) is not None,
+        "diffusers_version": diffusers.__version__,
+        "created_at": time.time(),
+        "build_seconds": round(time.perf_counter() - started, 2)
+    }
+    with open(os.path.join(snapshot_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def snapshot_matches(manifest, base_model, lora_sha256, lora_scale, dtype):
+    """
+    Check that a snapshot was built from the same base model, LoRA file and
+    scale, in the dtype (e.g. "float16") it would be served in, and with the
+    model's safety checker kept (recorded by builds since it was required)
+    """
+    return (
+        manifest is not None
+        and manifest.get("base_model") == base_model
+        and manifest.get("lora_sha256") == lora_sha256
+        and manifest.get("lora_scale") == lora_scale
+        and manifest.get("dtype") == dtype
+        and "safety_checker" in manifest
+    )
+
+
+def load_snapshot(snapshot_dir, torch_dtype, **from_pretrained_kwargs):
+    """
+    Load a fused snapshot. The safetensors files are memory-mapped and read
+    straight into the model skeletons, and no LoRA loading or fusing is needed.
+    """
+    return AutoPipelineForText2Image.from_pretrained(
+        snapshot_dir,
+        torch_dtype=torch_dtype,
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
+        local_files_only=True,
+        **from_pretrained_kwargs
+    )
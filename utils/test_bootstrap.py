@@ -0,0 +1,271 @@
+"""Tests for bootstrap.py against local stand-in HTTP servers. Run with: python -m pytest utils"""
+import argparse
+import hashlib
+import json
+import os
+import stat
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bootstrap
+import localtunnel_setup
+import ollama_setup
+
+
+class StandIn:
+    """An HTTP server on a free local port answering ``routes[(method, path)](handler)``"""
+
+    def __init__(self, routes):
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_one(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                stand_in.requests.append((method, self.path, body))
+                route = routes.get((method, self.path))
+                if route is None:
+                    self.send_error(404)
+                    return
+                route(self, body)
+
+            def do_GET(self):
+                self.handle_one("GET")
+
+            def do_POST(self):
+                self.handle_one("POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def send_json(handler, body, status=200):
+    data = json.dumps(body).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+def stream_lines(handler, events):
+    """Ollama-style streamed NDJSON without a Content-Length"""
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/x-ndjson")
+    handler.send_header("Connection", "close")
+    handler.end_headers()
+    for event in events:
+        handler.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+        handler.wfile.flush()
+
+
+def free_port():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler)
+    port = server.server_port
+    server.server_close()
+    return port
+
+
+@pytest.fixture
+def ollama():
+    """A stand-in Ollama that has ``present`` and fails to pull ``broken``"""
+
+    def pull(handler, body):
+        model = body["model"]
+        if model == "broken":
+            stream_lines(handler, [{"status": "pulling manifest"}, {"error": "file does not exist"}])
+            return
+        stream_lines(handler, [
+            {"status": "pulling manifest"},
+            {"status": "downloading", "completed": 0, "total": 100},
+            {"status": "downloading", "completed": 100, "total": 100},
+            {"status": "success"},
+        ])
+
+    stand_in = StandIn({
+        ("GET", "/api/version"): lambda handler, _: send_json(handler, {"version": "0.0.0"}),
+        ("GET", "/api/tags"): lambda handler, _: send_json(handler, {"models": [{"name": "present:latest", "digest": "abcdef0123456789"}]}),
+        ("POST", "/api/pull"): pull,
+    })
+    yield stand_in
+    stand_in.close()
+
+
+class RecordingProgress(bootstrap.Progress):
+    def __init__(self):
+        super().__init__()
+        self.updates = []
+        self.finished = []
+
+    def update(self, name, status, completed=None, total=None):
+        self.updates.append((name, status, completed, total))
+        super().update(name, status, completed, total)
+
+    def finish(self, name):
+        self.finished.append(name)
+        super().finish(name)
+
+
+def test_service_reuses_a_server_that_already_answers():
+    stand_in = StandIn({("GET", "/health"): lambda handler, _: send_json(handler, {"status": "ok"})})
+    try:
+        service = bootstrap.Service("sd", [sys.executable, "-c", "raise SystemExit(1)"], f"{stand_in.url}/health")
+        assert service.start() is False
+        assert service.process is None
+        service.wait(1)
+    finally:
+        stand_in.close()
+
+
+def test_service_wait_fails_when_the_process_exits(tmp_path):
+    service = bootstrap.Service("dies", [sys.executable, "-c", "raise SystemExit(3)"],
+                                f"http://127.0.0.1:{free_port()}/health", log_dir=str(tmp_path))
+    assert service.start() is True
+    with pytest.raises(RuntimeError, match="code 3"):
+        service.wait(10)
+
+
+def test_service_wait_times_out(tmp_path):
+    service = bootstrap.Service("hangs", [sys.executable, "-c", "import time; time.sleep(30)"],
+                                f"http://127.0.0.1:{free_port()}/health", log_dir=str(tmp_path))
+    service.start()
+    try:
+        with pytest.raises(TimeoutError):
+            service.wait(0.5)
+    finally:
+        service.process.kill()
+        service.process.wait()
+
+
+def test_sd_model_ready_follows_the_load_phase():
+    answers = iter([({"phase": "loading"}, 503), ({"phase": "ready"}, 200), ({"phase": "failed", "error": "out of memory\ntraceback"}, 503)])
+    stand_in = StandIn({("GET", "/ready"): lambda handler, _: send_json(handler, *next(answers))})
+    try:
+        url = f"{stand_in.url}/ready"
+        assert bootstrap.sd_model_ready(url) is False
+        assert bootstrap.sd_model_ready(url) is True
+        with pytest.raises(RuntimeError, match="out of memory$"):
+            bootstrap.sd_model_ready(url)
+    finally:
+        stand_in.close()
+
+
+def test_pull_ollama_model_reports_progress(ollama):
+    progress = RecordingProgress()
+    bootstrap.pull_ollama_model(ollama.url, "gemma:2b", progress)
+    assert ("ollama:gemma:2b", "downloading", 100, 100) in progress.updates
+    assert progress.finished == ["ollama:gemma:2b"]
+
+
+def test_pull_ollama_model_raises_on_a_streamed_error(ollama):
+    progress = RecordingProgress()
+    with pytest.raises(RuntimeError, match="file does not exist"):
+        bootstrap.pull_ollama_model(ollama.url, "broken", progress)
+    assert progress.finished == ["ollama:broken"]
+
+
+def test_ollama_setup_awaits_pulls_and_skips_present_models(ollama):
+    failed = ollama_setup.pull_models(["present", "gemma:2b", "broken"], ollama_url=ollama.url)
+    assert failed == ["broken"]
+    pulled = sorted(body["model"] for method, path, body in ollama.requests if path == "/api/pull")
+    assert pulled == ["broken", "gemma:2b"]
+
+
+def test_verify_hf_blobs_deletes_corrupt_files_and_remembers_good_ones(tmp_path):
+    blobs = tmp_path / "blobs"
+    blobs.mkdir()
+    good = b"weights"
+    (blobs / hashlib.sha256(good).hexdigest()).write_bytes(good)
+    corrupt_name = hashlib.sha256(b"expected").hexdigest()
+    (blobs / corrupt_name).write_bytes(b"truncated")
+    (blobs / "0123abc").write_bytes(b"small git-hashed file")
+
+    assert bootstrap.verify_hf_blobs(str(tmp_path)) == (2, [corrupt_name])
+    assert not (blobs / corrupt_name).exists()
+    # The good blob is not hashed again while its size and mtime are unchanged
+    assert bootstrap.verify_hf_blobs(str(tmp_path)) == (0, [])
+
+
+def make_args(tmp_path, **overrides):
+    args = argparse.Namespace(
+        ollama_url=bootstrap.OLLAMA_URL, ollama_models=[], sd_model=str(tmp_path), sd_cache_dir=str(tmp_path / "cache"),
+        sd_port=free_port(), timeout=10, wait_ready=False, refresh=False, no_verify=False,
+        no_ollama=False, no_sd=False, tunnel=False, log_dir=str(tmp_path / "logs"), report=None
+    )
+    vars(args).update(overrides)
+    return args
+
+
+def test_bootstrap_pulls_missing_models_and_times_every_step(ollama, tmp_path):
+    args = make_args(tmp_path, ollama_url=ollama.url, ollama_models=["present", "gemma:2b"], no_sd=True)
+    timeline, failures, tunnel = bootstrap.bootstrap(args)
+    assert failures == []
+    assert tunnel is None
+    outcomes = {name: outcome for name, _, _, outcome in timeline.steps}
+    assert outcomes["ollama: start"] == "already running"
+    assert outcomes["ollama: pull present"].startswith("skipped, present (abcdef012345")
+    assert outcomes["ollama: pull gemma:2b"] == "ok"
+    assert [step["name"] for step in timeline.to_dict()["steps"]] == [name for name, _, _, _ in timeline.steps]
+
+
+def test_bootstrap_reports_a_failed_pull(ollama, tmp_path):
+    args = make_args(tmp_path, ollama_url=ollama.url, ollama_models=["broken"], no_sd=True)
+    _, failures, _ = bootstrap.bootstrap(args)
+    assert len(failures) == 1 and "file does not exist" in failures[0]
+
+
+@pytest.fixture
+def fake_lt(tmp_path, monkeypatch):
+    """Put an ``lt`` on PATH that runs ``script`` (Python) instead of opening a real tunnel"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def install(script):
+        lt = bin_dir / "lt"
+        lt.write_text(f"#!{sys.executable}\n{script}\n")
+        lt.chmod(lt.stat().st_mode | stat.S_IXUSR)
+
+    return install
+
+
+@pytest.mark.skipif(os.name == "nt", reason="the fake lt is a script with a shebang")
+def test_bootstrap_tunnel_blocks_until_the_url_is_reported(tmp_path, fake_lt):
+    fake_lt("import time\ntime.sleep(0.5)\nprint('your url is: https://comic.loca.lt', flush=True)\ntime.sleep(1)")
+    stand_in = StandIn({("GET", "/health"): lambda handler, _: send_json(handler, {"status": "ok"})})
+    try:
+        args = make_args(tmp_path, no_ollama=True, tunnel=True, sd_port=stand_in.server.server_port)
+        timeline, failures, tunnel = bootstrap.bootstrap(args)
+        assert failures == []
+        process, url = tunnel
+        assert url == "https://comic.loca.lt"
+        assert process.poll() is None  # Still open after bootstrap() returns...
+        assert bootstrap.keep_tunnel_open(process) == 0  # ...until lt exits
+    finally:
+        stand_in.close()
+
+
+@pytest.mark.skipif(os.name == "nt", reason="the fake lt is a script with a shebang")
+def test_open_tunnel_fails_when_lt_exits_without_a_url(fake_lt):
+    fake_lt("import sys\nprint('connection refused', flush=True)\nsys.exit(2)")
+    with pytest.raises(RuntimeError, match="code 2"):
+        localtunnel_setup.open_tunnel(5000, timeout=10)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="the fake lt is a script with a shebang")
+def test_open_tunnel_times_out(fake_lt):
+    fake_lt("import time\ntime.sleep(30)")
+    with pytest.raises(TimeoutError):
+        localtunnel_setup.open_tunnel(5000, timeout=0.5)